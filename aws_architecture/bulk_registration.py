@@ -0,0 +1,172 @@
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
+import logging
+import json
+import time
+import uuid
+import os
+
+from aws_architecture import device_keys
+from aws_architecture import iot_provisioning
+import aws_architecture.tfstates_backup as tfb
+
+
+# IAM role AWS IoT assumes to read the manifest from S3 and to register things, see README
+ROLE_ARN = os.environ.get('WIST_BULK_REGISTRATION_ROLE_ARN')
+POLL_INTERVAL = 5  # seconds
+TASK_TIMEOUT = 60 * 60  # seconds
+_STOP_GRACE_PERIOD = 60  # seconds for stopped task to finish, so its reports are complete
+
+_S3_PREFIX = 'bulk_registration'
+_FINISHED_STATUSES = ('Completed', 'Failed', 'Cancelled')
+
+REPORT_TIMEOUT = (10, 60)  # seconds: connect, read
+_REPORT_RETRIES = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=('GET',), raise_on_status=False)
+_report_session = None
+
+
+class BulkRegistrationError(Exception):
+    """ registered holds devices which the task registered before it failed, they exist in AWS """
+
+    def __init__(self, message: str, registered: dict = None):
+        super().__init__(message)
+        self.registered = registered or {}
+
+
+def make_template(thing_type_name: str, policy_name: str) -> str:
+    """ Provisioning template creating the same resources as modules/iot_core_publisher does for one device """
+    return json.dumps({
+        'Parameters': {
+            'ThingName': {'Type': 'String'},
+            'CSR': {'Type': 'String'},
+        },
+        'Resources': {
+            'thing': {
+                'Type': 'AWS::IoT::Thing',
+                'Properties': {'ThingName': {'Ref': 'ThingName'}, 'ThingTypeName': thing_type_name},
+            },
+            'certificate': {
+                'Type': 'AWS::IoT::Certificate',
+                'Properties': {'CertificateSigningRequest': {'Ref': 'CSR'}, 'Status': 'ACTIVE'},
+            },
+            'policy': {
+                'Type': 'AWS::IoT::Policy',
+                'Properties': {'PolicyName': policy_name},
+            },
+        },
+    })
+
+
+def make_manifest(keys: dict) -> str:
+    """ One JSON line of template parameters per device, device order is kept """
+    return ''.join(json.dumps({'ThingName': device_name, 'CSR': device_key['csr']}) + '\n'
+                   for device_name, device_key in keys.items())
+
+
+def _wait_for_task(iot, task_id: str, timeout: int) -> dict:
+    """ Task is stopped after timeout, and waited for a while longer so devices it registered can be read """
+    deadline = time.time() + timeout
+    stopped = False
+    while True:
+        task = iot.describe_thing_registration_task(taskId=task_id)
+        logging.info(f"Bulk registration task {task_id}: {task['status']}, {task.get('percentageProgress', 0)}% "
+                     f"({task.get('successCount', 0)} registered, {task.get('failureCount', 0)} failed)")
+        if task['status'] in _FINISHED_STATUSES and not stopped:
+            return task
+        if task['status'] in _FINISHED_STATUSES or (stopped and time.time() > deadline):
+            raise BulkRegistrationError(f'Bulk registration task {task_id} did not finish in {timeout}s, stopped it')
+        if not stopped and time.time() > deadline:
+            iot.stop_thing_registration_task(taskId=task_id)
+            stopped = True
+            deadline = time.time() + _STOP_GRACE_PERIOD
+        time.sleep(POLL_INTERVAL)
+
+
+def _get_report_session() -> requests.Session:
+    """ Reports are read one after another, the same session keeps connection and retries throttled requests """
+    global _report_session
+    if _report_session is None:
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(max_retries=_REPORT_RETRIES))
+        _report_session = session
+    return _report_session
+
+
+def _read_reports(iot, task_id: str, report_type: str):
+    """ Yield report lines (dicts). Reports are JSON lines files behind pre-signed URLs """
+    kwargs = {'taskId': task_id, 'reportType': report_type}
+    while True:
+        response = iot.list_thing_registration_task_reports(**kwargs)
+        for link in response.get('resourceLinks', []):
+            report = _get_report_session().get(link, timeout=REPORT_TIMEOUT)
+            report.raise_for_status()
+            for line in report.text.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+        if not response.get('nextToken'):
+            return
+        kwargs['nextToken'] = response['nextToken']
+
+
+def _read_registered(iot, task_id: str, keys: dict, thing_type_name: str, policy_name: str,
+                     private_keys_in_state: bool) -> dict:
+    """ Devices registered by the task, from its reports. Errors of the other devices are logged """
+    registered = {}
+    for result in _read_reports(iot, task_id, 'RESULTS'):
+        response = result['response']
+        thing_arn = response['ResourceArns']['thing']
+        device_name = thing_arn.rsplit('/', 1)[1]
+        registered[device_name] = iot_provisioning.device_resources(
+            device_name, thing_arn, thing_type_name, policy_name, response['ResourceArns']['certificate'],
+            response['CertificatePem'], keys[device_name]['public_key'],
+            keys[device_name]['private_key'] if private_keys_in_state else None)
+    for error in _read_reports(iot, task_id, 'ERRORS'):
+        logging.error(f"Bulk registration failed for line {error.get('lineNumber')}: {error.get('errorMessage')}")
+    return registered
+
+
+def register_devices(device_names, thing_type_name: str, policy_name: str, region=None, role_arn=None,
+                     timeout=TASK_TIMEOUT, private_keys_in_state=True) -> dict:
+    """ Register devices with one bulk registration task.
+
+    Keys are generated locally and only CSRs are sent. Returns device name -> state attributes of created resources
+    (see iot_provisioning.device_resources) for devices that were registered. When the task fails or times out,
+    BulkRegistrationError carries devices it registered until then.
+    """
+    role_arn = role_arn or ROLE_ARN
+    if not role_arn:
+        raise BulkRegistrationError('Role for bulk registration not given. Set WIST_BULK_REGISTRATION_ROLE_ARN')
+    device_names = list(dict.fromkeys(device_names))
+    keys = device_keys.generate_keys(device_names)
+
+    iot = iot_provisioning.get_iot_client(region)
+    manifest_key = f'{_S3_PREFIX}/{uuid.uuid4().hex}/manifest.jsonl'
+    tfb.get_s3_client().put_object(Body=make_manifest(keys).encode('utf-8'), Bucket=tfb.BUCKET, Key=manifest_key)
+    try:
+        start = time.time()
+        task_id = iot.start_thing_registration_task(templateBody=make_template(thing_type_name, policy_name),
+                                                    inputFileBucket=tfb.BUCKET, inputFileKey=manifest_key,
+                                                    roleArn=role_arn)['taskId']
+        logging.info(f'Started bulk registration task {task_id} for {len(device_names)} devices')
+        try:
+            task = _wait_for_task(iot, task_id, timeout)
+            if task['status'] != 'Completed':
+                raise BulkRegistrationError(f"Bulk registration task {task_id} ended with status {task['status']}: "
+                                            f"{task.get('message', '')}")
+        except Exception as e:
+            # devices registered before the failure exist in AWS, caller must record them
+            try:
+                registered = _read_registered(iot, task_id, keys, thing_type_name, policy_name, private_keys_in_state)
+            except Exception:
+                logging.exception(f'Reading reports of bulk registration task {task_id} failed, devices it '
+                                  f'registered are not known')
+                registered = {}
+            raise BulkRegistrationError(str(e), registered) from e
+
+        registered = _read_registered(iot, task_id, keys, thing_type_name, policy_name, private_keys_in_state)
+        logging.info(f'Bulk registered {len(registered)} of {len(device_names)} devices in {time.time() - start:.1f}s')
+        return registered
+    finally:
+        tfb.get_s3_client().delete_object(Bucket=tfb.BUCKET, Key=manifest_key)
@@ -0,0 +1,212 @@
+from concurrent.futures import ProcessPoolExecutor
+import tempfile
+import logging
+import shutil
+import uuid
+import time
+import sys
+import os
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+except ImportError:  # only needed when keys are generated locally (CSR mode, bulk registration)
+    x509 = None
+
+
+KEY_SIZE = 2048
+
+
+
+def _get_user_data_dir():
+    """ Per user data dir, outside of wist install: WIST_DATA_DIR, XDG data dir or LOCALAPPDATA on Windows """
+    if os.environ.get('WIST_DATA_DIR'):
+        return os.environ['WIST_DATA_DIR']
+    if sys.platform.startswith('win32') and os.environ.get('LOCALAPPDATA'):
+        return os.path.join(os.environ['LOCALAPPDATA'], 'wist', 'data')
+    xdg_data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+    return os.path.join(xdg_data_home, 'wist')
+
+
+# keys are never kept inside the package, so they are neither committed nor bundled into executable
+DATA_DIR = _get_user_data_dir()
+# private keys of devices, they never leave this machine (neither state nor S3 backup has them)
+DEVICE_KEYS_DIR = os.path.join(DATA_DIR, 'device_keys')
+# keys generated ahead of time, not assigned to any device yet
+KEY_POOL_DIR = os.path.join(DATA_DIR, 'key_pool')
+KEY_POOL_SIZE = int(os.environ.get('WIST_KEY_POOL_SIZE', 100))
+
+_LEGACY_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')  # where older wist kept keys
+_PRIVATE_KEY_SUFFIX = '.key'
+
+_migrated = False
+
+
+def check_available():
+    if x509 is None:
+        raise Exception('Generating device keys locally requires "cryptography" package: pip install cryptography')
+
+
+def _generate_private_key_pem(_=None) -> bytes:
+    """ Slow part (tens of ms per key), run in worker processes """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=KEY_SIZE)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                             serialization.NoEncryption())
+
+
+def _generate_private_keys(count: int) -> list:
+    if count <= 1:
+        return [_generate_private_key_pem() for _ in range(count)]
+    with ProcessPoolExecutor(max_workers=min(count, os.cpu_count() or 1)) as executor:
+        return list(executor.map(_generate_private_key_pem, range(count), chunksize=max(count // 32, 1)))
+
+
+def _make_dirs(path: str):
+    os.makedirs(path, mode=0o700, exist_ok=True)
+
+
+def _migrate_legacy_dirs():
+    """ Move keys left inside the package by older wist to DATA_DIR, once per process """
+    global _migrated
+    if _migrated:
+        return
+    _migrated = True
+    for directory in (DEVICE_KEYS_DIR, KEY_POOL_DIR):
+        legacy_dir = os.path.join(_LEGACY_DATA_DIR, os.path.basename(directory))
+        try:
+            entries = [entry for entry in os.listdir(legacy_dir) if entry.endswith(_PRIVATE_KEY_SUFFIX)]
+        except FileNotFoundError:
+            continue
+        _make_dirs(directory)
+        for entry in entries:
+            if not os.path.exists(os.path.join(directory, entry)):
+                shutil.move(os.path.join(legacy_dir, entry), os.path.join(directory, entry))
+        logging.info(f'Moved {len(entries)} keys from {legacy_dir} to {directory}')
+
+
+def _write_private_file(path: str, content: bytes):
+    """ Key files are readable only by the owner, and written atomically """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        os.chmod(tmp_path, 0o600)
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _load_private_key(private_key_pem: bytes):
+    try:
+        # keys were generated here, RSA consistency check would cost as much as generating a new key
+        return serialization.load_pem_private_key(private_key_pem, password=None, unsafe_skip_rsa_key_validation=True)
+    except TypeError:  # cryptography < 39
+        return serialization.load_pem_private_key(private_key_pem, password=None)
+
+
+def _key_material(device_name: str, private_key_pem: bytes) -> dict:
+    key = _load_private_key(private_key_pem)
+    csr = x509.CertificateSigningRequestBuilder() \
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, device_name)])) \
+        .sign(key, hashes.SHA256())
+    return {
+        'private_key': private_key_pem.decode('ascii'),
+        'public_key': key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                    serialization.PublicFormat.SubjectPublicKeyInfo).decode('ascii'),
+        'csr': csr.public_bytes(serialization.Encoding.PEM).decode('ascii'),
+    }
+
+
+def get_key_pool_size() -> int:
+    _migrate_legacy_dirs()
+    try:
+        return sum(1 for entry in os.listdir(KEY_POOL_DIR) if entry.endswith(_PRIVATE_KEY_SUFFIX))
+    except FileNotFoundError:
+        return 0
+
+
+def fill_key_pool(size=None) -> int:
+    """ Generate keys in worker processes until pool has given size. Returns number of generated keys """
+    check_available()
+    missing = (size or KEY_POOL_SIZE) - get_key_pool_size()
+    if missing <= 0:
+        return 0
+    start = time.time()
+    _make_dirs(KEY_POOL_DIR)
+    for private_key_pem in _generate_private_keys(missing):
+        _write_private_file(os.path.join(KEY_POOL_DIR, uuid.uuid4().hex + _PRIVATE_KEY_SUFFIX), private_key_pem)
+    logging.info(f'Generated {missing} keys into key pool in {time.time() - start:.1f}s')
+    return missing
+
+
+def _get_device_key_path(device_name: str):
+    _migrate_legacy_dirs()
+    return os.path.join(DEVICE_KEYS_DIR, device_name + _PRIVATE_KEY_SUFFIX)
+
+
+def _take_pool_keys(device_names) -> list:
+    """ Move pool keys to device key store. Rename is atomic, so each pool key goes to exactly one device """
+    taken = []
+    try:
+        entries = sorted(entry for entry in os.listdir(KEY_POOL_DIR) if entry.endswith(_PRIVATE_KEY_SUFFIX))
+    except FileNotFoundError:
+        return taken
+    device_names = iter(device_names)
+    device_name = next(device_names, None)
+    for entry in entries:
+        if device_name is None:
+            break
+        try:
+            os.rename(os.path.join(KEY_POOL_DIR, entry), _get_device_key_path(device_name))
+        except FileNotFoundError:
+            continue  # taken by another process
+        taken.append(device_name)
+        device_name = next(device_names, None)
+    return taken
+
+
+def read_device_key(device_name: str):
+    """ Key pair and CSR of a device generated on this machine, None if there is none """
+    try:
+        with open(_get_device_key_path(device_name), 'rb') as key_file:
+            private_key_pem = key_file.read()
+    except FileNotFoundError:
+        return None
+    check_available()
+    return _key_material(device_name, private_key_pem)
+
+
+def generate_keys(device_names) -> dict:
+    """ Device name -> key pair and CSR. Keys come from the pool, missing ones are generated in worker processes.
+
+    Devices which already have a key on this machine keep it (e.g. retried after failed apply).
+    """
+    check_available()
+    start = time.time()
+    _make_dirs(DEVICE_KEYS_DIR)
+    device_names = list(dict.fromkeys(device_names))
+    without_key = [device_name for device_name in device_names
+                   if not os.path.isfile(_get_device_key_path(device_name))]
+
+    from_pool = _take_pool_keys(without_key)
+    from_pool_set = set(from_pool)
+    missing = [device_name for device_name in without_key if device_name not in from_pool_set]
+    for device_name, private_key_pem in zip(missing, _generate_private_keys(len(missing))):
+        _write_private_file(_get_device_key_path(device_name), private_key_pem)
+
+    keys = {device_name: read_device_key(device_name) for device_name in device_names}
+    logging.info(f'Prepared {len(keys)} device keys in {time.time() - start:.1f}s '
+                 f'({len(from_pool)} from key pool, {len(missing)} generated)')
+    return keys
+
+
+def remove_device_keys(device_names):
+    """ Forget keys of removed devices, so a new device with the same name never reuses them """
+    for device_name in device_names:
+        try:
+            os.remove(_get_device_key_path(device_name))
+        except FileNotFoundError:
+            pass
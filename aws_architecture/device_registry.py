@@ -0,0 +1,207 @@
+import contextlib
+import tempfile
+import logging
+import sqlite3
+import json
+import time
+import os
+
+
+REGISTRY_FILE_NAME = 'registry.sqlite3'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    registry TEXT NOT NULL,
+    name TEXT NOT NULL,
+    device_group TEXT,
+    created REAL NOT NULL,
+    cert_id TEXT,
+    PRIMARY KEY (registry, name)
+);
+CREATE INDEX IF NOT EXISTS devices_by_name ON devices (name);
+CREATE TABLE IF NOT EXISTS registries (
+    registry TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    exported_version INTEGER,
+    exported_mtime_ns INTEGER
+);
+"""
+_BUSY_TIMEOUT = 60  # seconds, shards are updated in parallel threads and share one database
+
+_initialized = set()  # (database path, registry name) already set up by this process
+
+
+class DeviceRegistry():
+    """ Devices of one things file (shard), kept in SQLite next to it: membership checks and changes are indexed
+    and transactional, each device has its group, creation time and certificate id.
+
+    Things file (list of names read by terraform) is generated from the registry, only when registry has changed.
+    On first use devices are imported from existing things file.
+    """
+
+    def __init__(self, devices_file_path: str):
+        self.devices_file_path = devices_file_path
+        self.name = os.path.basename(devices_file_path)
+        self.db_path = os.path.join(os.path.dirname(devices_file_path), REGISTRY_FILE_NAME)
+        if (self.db_path, self.name) not in _initialized:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            with self._transaction() as conn:
+                if conn.execute('SELECT 1 FROM registries WHERE registry = ?', (self.name,)).fetchone() is None:
+                    self._import_devices_file(conn)
+            _initialized.add((self.db_path, self.name))
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=_BUSY_TIMEOUT, isolation_level=None)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """ Write transaction, taken at start so concurrent writers wait instead of failing on upgrade """
+        with contextlib.closing(self._connect()) as conn:
+            if (self.db_path, self.name) not in _initialized:
+                conn.execute('PRAGMA journal_mode=WAL')  # readers do not wait for writers
+                conn.executescript(_SCHEMA)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _import_devices_file(self, conn):
+        try:
+            with open(self.devices_file_path, 'r') as devices_file:
+                names = json.load(devices_file)  # type: list
+        except (OSError, ValueError):
+            names = []
+        created = time.time()
+        conn.executemany('INSERT OR IGNORE INTO devices (registry, name, created) VALUES (?, ?, ?)',
+                         [(self.name, name, created) for name in names])
+        conn.execute('INSERT INTO registries (registry, version) VALUES (?, 1)', (self.name,))
+        if names:
+            logging.info(f'Imported {len(names)} devices from {self.devices_file_path} to devices registry')
+
+    def _changed(self, conn):
+        conn.execute('UPDATE registries SET version = version + 1 WHERE registry = ?', (self.name,))
+
+    def __contains__(self, device_name: str):
+        with contextlib.closing(self._connect()) as conn:
+            return conn.execute('SELECT 1 FROM devices WHERE registry = ? AND name = ?',
+                                (self.name, device_name)).fetchone() is not None
+
+    def names(self) -> list:
+        """ Device names in order they were added """
+        with contextlib.closing(self._connect()) as conn:
+            return [row[0] for row in conn.execute('SELECT name FROM devices WHERE registry = ? ORDER BY rowid',
+                                                   (self.name,))]
+
+    def get(self, device_name: str):
+        """ {'name', 'group', 'created', 'cert_id'} of a device or None """
+        with contextlib.closing(self._connect()) as conn:
+            row = conn.execute('SELECT name, device_group, created, cert_id FROM devices '
+                               'WHERE registry = ? AND name = ?', (self.name, device_name)).fetchone()
+        return None if row is None else dict(zip(('name', 'group', 'created', 'cert_id'), row))
+
+    def add(self, device_names, groups=None) -> list:
+        """ Add devices (group from groups dict: name -> group) in one transaction. Returns names actually added """
+        groups = groups or {}
+        created = time.time()
+        added = []
+        with self._transaction() as conn:
+            for device_name in device_names:
+                cursor = conn.execute('INSERT OR IGNORE INTO devices (registry, name, device_group, created) '
+                                      'VALUES (?, ?, ?, ?)', (self.name, device_name, groups.get(device_name), created))
+                if cursor.rowcount:
+                    added.append(device_name)
+                else:
+                    logging.info(f'Device with name {device_name} already exists in devices registry! '
+                                 f'Not changing anything.')
+            if added:
+                self._changed(conn)
+        return added
+
+    def remove(self, device_names) -> list:
+        """ Remove devices in one transaction. Returns names actually removed """
+        removed = []
+        with self._transaction() as conn:
+            for device_name in device_names:
+                cursor = conn.execute('DELETE FROM devices WHERE registry = ? AND name = ?', (self.name, device_name))
+                if cursor.rowcount:
+                    removed.append(device_name)
+                else:
+                    logging.warning(f"There is no device with such name: [{device_name}]")
+            if removed:
+                self._changed(conn)
+        return removed
+
+    def replace(self, cert_ids: dict) -> bool:
+        """ Make registry hold exactly given devices (name -> certificate id), keeping metadata of the ones
+        already there. Returns True if anything has changed
+        """
+        created = time.time()
+        with self._transaction() as conn:
+            current = dict(conn.execute('SELECT name, cert_id FROM devices WHERE registry = ?', (self.name,)))
+            to_delete = [(self.name, name) for name in current if name not in cert_ids]
+            to_insert = [(self.name, name, created, cert_id) for name, cert_id in cert_ids.items()
+                         if name not in current]
+            to_update = [(cert_id, self.name, name) for name, cert_id in cert_ids.items()
+                         if name in current and current[name] != cert_id]
+            conn.executemany('DELETE FROM devices WHERE registry = ? AND name = ?', to_delete)
+            conn.executemany('INSERT INTO devices (registry, name, created, cert_id) VALUES (?, ?, ?, ?)', to_insert)
+            conn.executemany('UPDATE devices SET cert_id = ? WHERE registry = ? AND name = ?', to_update)
+            if to_delete or to_insert:  # certificate ids are not in things file
+                self._changed(conn)
+        return bool(to_delete or to_insert or to_update)
+
+    def export(self) -> bool:
+        """ Write things file if registry has changed since last export or the file was changed by someone else.
+        Returns True if written
+        """
+        with self._transaction() as conn:
+            version, exported_version, exported_mtime_ns = conn.execute(
+                'SELECT version, exported_version, exported_mtime_ns FROM registries WHERE registry = ?',
+                (self.name,)).fetchone()
+            try:
+                mtime_ns = os.stat(self.devices_file_path).st_mtime_ns
+            except FileNotFoundError:
+                mtime_ns = None
+            if version == exported_version and mtime_ns == exported_mtime_ns:
+                return False
+
+            names = [row[0] for row in conn.execute('SELECT name FROM devices WHERE registry = ? ORDER BY rowid',
+                                                    (self.name,))]
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.devices_file_path), prefix='.tmp_')
+            try:
+                with os.fdopen(fd, 'w') as tmp_file:
+                    json.dump(names, tmp_file)
+                os.replace(tmp_path, self.devices_file_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            conn.execute('UPDATE registries SET exported_version = ?, exported_mtime_ns = ? WHERE registry = ?',
+                         (version, os.stat(self.devices_file_path).st_mtime_ns, self.name))
+        return True
+
+
+def iter_devices(devices_file_paths, prefix=None, pattern=None, offset=0, limit=None):
+    """ Devices of many things files (sharing one database) sorted by name, filtered and paged by the database
+    and read lazily. pattern is a glob (*, ?, [...]), case sensitive. Yields dicts as get() with 'registry' added
+    """
+    registries = [DeviceRegistry(path) for path in devices_file_paths]
+    if not registries:
+        return
+    conditions = [f"registry IN ({', '.join('?' * len(registries))})"]
+    params = [registry.name for registry in registries]
+    if prefix:
+        conditions.append('substr(name, 1, ?) = ?')
+        params += [len(prefix), prefix]
+    if pattern:
+        conditions.append('name GLOB ?')
+        params.append(pattern)
+    params += [-1 if limit is None else limit, offset or 0]
+
+    with contextlib.closing(registries[0]._connect()) as conn:
+        cursor = conn.execute(f"SELECT name, device_group, created, cert_id, registry FROM devices "
+                              f"WHERE {' AND '.join(conditions)} ORDER BY name LIMIT ? OFFSET ?", params)
+        for row in cursor:
+            yield dict(zip(('name', 'group', 'created', 'cert_id', 'registry'), row))
@@ -2,9 +2,22 @@ provider "aws" {
   region = "eu-west-2"
 }
 
+# ---------------------
+# Every shard of the fleet is a separate workspace (with its own state).
+# Shard 0 is the default workspace, so non-sharded setup stays unchanged.
+locals {
+  is_default_shard = terraform.workspace == "default"
+  things_file = local.is_default_shard ? "../../data/things.json" : "../../data/things.${terraform.workspace}.json"
+  # CSRs of devices created in this run (CSR mode), written by wist
+  csrs_file = local.is_default_shard ? "../../data/csrs.json" : "../../data/csrs.${terraform.workspace}.json"
+  shard_suffix = local.is_default_shard ? "" : "_${replace(terraform.workspace, "-", "_")}"
+}
+
 
 module "iot_core_publisher" {
   source = "../../modules/iot_core_publisher"
-  thing_names = jsondecode(file("../../data/things.json"))
-  thing_type_name = "tf_wizzdev_iot_project"
+  thing_names = jsondecode(file(local.things_file))
+  device_csrs = fileexists(local.csrs_file) ? jsondecode(file(local.csrs_file)) : {}
+  thing_type_name = "tf_wizzdev_iot_project${local.shard_suffix}"
+  policy_name = "tf_iot_connect_and_publish_to_topic${local.shard_suffix}"
 }
@@ -0,0 +1,324 @@
+""" Timings and counters of wist operations.
+
+Every phase of an operation (lock, state pull, terraform init/plan/apply, push, certs extraction...) is a span, with
+its duration, status, attributes (e.g. shard) and counters (e.g. bytes transferred, devices written). Spans of one
+operation are exported together when its root span ends:
+
+- WIST_METRICS_FILE - JSON lines, one span per line
+- WIST_METRICS_PROMETHEUS - Prometheus textfile (node_exporter textfile collector), totals of all runs on this station
+- WIST_METRICS_OTEL=1 - spans are also sent to OpenTelemetry (requires 'opentelemetry-api', SDK and exporter are
+  configured as usual, e.g. with opentelemetry-instrument and OTEL_* environment variables)
+"""
+import contextlib
+import functools
+import threading
+import logging
+import json
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows, concurrent runs may then lose an update of Prometheus textfile
+    fcntl = None
+
+METRICS_FILE = os.environ.get('WIST_METRICS_FILE')
+PROMETHEUS_FILE = os.environ.get('WIST_METRICS_PROMETHEUS')
+OPENTELEMETRY = os.environ.get('WIST_METRICS_OTEL', '') not in ('', '0')
+
+STATION = os.environ.get('WIST_STATION')  # tells provisioning stations apart in metrics, host name by default
+
+_DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))  # seconds
+
+_local = threading.local()  # open spans of a thread, innermost last
+_export_lock = threading.Lock()
+_tracer = None
+
+
+def _get_station() -> str:
+    global STATION
+    if not STATION:
+        import socket  # not needed by commands which export nothing, keeps start up fast
+
+        STATION = socket.gethostname()
+    return STATION
+
+
+def _new_id(size: int) -> str:
+    return os.urandom(size).hex()
+
+
+def _stack() -> list:
+    if not hasattr(_local, 'spans'):
+        _local.spans = []
+    return _local.spans
+
+
+class Span():
+    def __init__(self, name: str, parent=None, attributes: dict = None):
+        self.name = name
+        self.parent = parent
+        self.root = parent.root if parent else self
+        self.trace_id = parent.trace_id if parent else _new_id(16)
+        self.span_id = _new_id(8)
+        self.attributes = dict(attributes or {})
+        self.counters = {}
+        self.status = 'ok'
+        self.error = None
+        self.start_time = time.time()
+        self.duration = None
+        self._start = time.perf_counter()
+        self._stack = None
+        self._finished = []  # root only: ended spans of the whole operation
+        self._otel_span = _start_otel_span(self) if OPENTELEMETRY else None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, counter: str, value=1):
+        """ Increase a counter, e.g. bytes or resources. Counters are summed up across runs in Prometheus """
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def fail(self, error):
+        """ Mark span as failed, for errors which are handled and not raised """
+        self.status = 'error'
+        self.error = f'{type(error).__name__}: {error}' if isinstance(error, BaseException) else str(error)
+
+    def end(self, error=None):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start
+        if error is not None:
+            self.fail(error)
+        if self._stack is not None and self in self._stack:
+            self._stack.remove(self)
+        if self._otel_span is not None:
+            _end_otel_span(self)
+
+        if self.root is not self:
+            with _export_lock:
+                self.root._finished.append(self)
+            return
+        _export(self._finished + [self])
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent else None,
+            'operation': self.root.name,
+            'name': self.name,
+            'start': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(self.start_time)) +
+                     f'.{int(self.start_time % 1 * 1e6):06d}+00:00',
+            'duration_s': round(self.duration, 6) if self.duration is not None else None,
+            'status': self.status,
+            'error': self.error,
+            'station': _get_station(),
+            'pid': os.getpid(),
+            'attributes': self.attributes,
+            'counters': self.counters,
+        }
+
+
+def current_span():
+    """ Innermost open span of this thread, None outside of any span """
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+def start_span(name: str, **attributes) -> Span:
+    """ Start span as child of the current one. It is current until end() is called on it """
+    new_span = Span(name, current_span(), attributes)
+    new_span._stack = _stack()
+    new_span._stack.append(new_span)
+    return new_span
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    new_span = start_span(name, **attributes)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.end(e)
+        raise
+    new_span.end()
+
+
+def timed(name: str):
+    """ Decorator, whole call is a span. Function can add counters to it with current_span() """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(function):
+    """ Wrap function to run (e.g. in executor thread) with spans current at bind time as its parents """
+    parent = current_span()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stack = _stack()
+        if parent is not None:
+            stack.append(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if parent is not None and parent in stack:
+                stack.remove(parent)
+    return wrapper
+
+
+def end_all(error=None, **attributes):
+    """ End all open spans of this thread, e.g. before os._exit() which skips finally blocks """
+    stack = _stack()
+    if stack:
+        stack[0].set(**attributes)
+    while stack:
+        stack[-1].end(error)
+
+
+def _export(spans: list):
+    root = spans[-1]
+    logging.debug(f'{root.name} took {root.duration:.2f}s: ' +
+                  ', '.join(f'{span.name} {span.duration:.2f}s' for span in spans[:-1] if span.parent is root))
+    try:
+        with _export_lock:
+            if METRICS_FILE:
+                _write_json_lines(METRICS_FILE, spans)
+            if PROMETHEUS_FILE:
+                _update_prometheus_file(PROMETHEUS_FILE, spans)
+        if OPENTELEMETRY:
+            _flush_otel()
+    except Exception as e:
+        logging.warning(f'Exporting metrics of {root.name} failed: {str(e)}')
+
+
+def _write_json_lines(path: str, spans: list):
+    lines = ''.join(json.dumps(span.to_dict(), default=str) + '\n' for span in spans)
+    with open(path, 'a') as file:
+        file.write(lines)  # single write, so spans of runs on one station are not interleaved
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _metric_name(counter: str) -> str:
+    return ''.join(char if char.isalnum() or char == '_' else '_' for char in counter)
+
+
+def _read_prometheus_file(path: str) -> dict:
+    """ Metric name -> (type, {series: value}), as written by _write_prometheus_file """
+    families, family = {}, None
+    try:
+        with open(path, 'r') as file:
+            for line in file:
+                line = line.strip()
+                if line.startswith('# TYPE '):
+                    _, _, name, metric_type = line.split()
+                    family = families.setdefault(name, (metric_type, {}))
+                elif line and not line.startswith('#') and family is not None:
+                    series, value = line.rsplit(' ', 1)
+                    family[1][series] = float(value)
+    except FileNotFoundError:
+        pass
+    return families
+
+
+def _write_prometheus_file(path: str, families: dict):
+    lines = []
+    for name, (metric_type, series) in sorted(families.items()):
+        lines.append(f'# TYPE {name} {metric_type}')
+        lines.extend(f'{key} {int(value) if float(value).is_integer() else value!r}' for key, value in series.items())
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)  # textfile collector must never read half written file
+
+
+def _update_prometheus_file(path: str, spans: list):
+    """ Add spans to totals kept in the textfile: duration histograms, last durations and counters per span name """
+    with open(path + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # other wist processes on this station update the same file
+        families = _read_prometheus_file(path)
+
+        def family(name, metric_type):
+            return families.setdefault(name, (metric_type, {}))[1]
+
+        for span in spans:
+            labels = f'span="{_escape_label(span.name)}",station="{_escape_label(_get_station())}"'
+            status_labels = f'{labels},status="{span.status}"'
+            durations = family('wist_span_duration_seconds', 'histogram')
+            for bound in _DURATION_BUCKETS:
+                if span.duration <= bound:
+                    le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                    key = f'wist_span_duration_seconds_bucket{{{status_labels},le="{le}"}}'
+                    durations[key] = durations.get(key, 0) + 1
+            for suffix, value in (('sum', span.duration), ('count', 1)):
+                key = f'wist_span_duration_seconds_{suffix}{{{status_labels}}}'
+                durations[key] = durations.get(key, 0) + value
+            family('wist_span_last_duration_seconds', 'gauge')[
+                f'wist_span_last_duration_seconds{{{labels}}}'] = round(span.duration, 6)
+            family('wist_span_last_end_timestamp_seconds', 'gauge')[
+                f'wist_span_last_end_timestamp_seconds{{{labels}}}'] = round(span.start_time + span.duration, 3)
+            for counter, value in span.counters.items():
+                name = f'wist_{_metric_name(counter)}_total'
+                series = family(name, 'counter')
+                series[f'{name}{{{labels}}}'] = series.get(f'{name}{{{labels}}}', 0) + value
+        _write_prometheus_file(path, families)
+
+
+def _get_tracer():
+    global _tracer, OPENTELEMETRY
+    if _tracer is None:
+        try:
+            from opentelemetry import trace  # optional, only imported when enabled
+        except ImportError:
+            logging.warning("WIST_METRICS_OTEL is set, but 'opentelemetry-api' package is not installed")
+            OPENTELEMETRY = False
+            return None
+        _tracer = trace.get_tracer('wist')
+    return _tracer
+
+
+def _otel_value(value):
+    return value if isinstance(value, (str, bool, int, float)) else str(value)
+
+
+def _start_otel_span(span: Span):
+    tracer = _get_tracer()
+    if tracer is None:
+        return None
+    from opentelemetry import trace
+
+    parent = span.parent._otel_span if span.parent is not None else None
+    context = trace.set_span_in_context(parent) if parent is not None else None
+    return tracer.start_span(span.name, context=context, start_time=int(span.start_time * 1e9),
+                             attributes={key: _otel_value(value) for key, value in span.attributes.items()})
+
+
+def _end_otel_span(span: Span):
+    from opentelemetry.trace import Status, StatusCode
+
+    otel_span = span._otel_span
+    otel_span.set_attribute('wist.station', _get_station())
+    for key, value in list(span.attributes.items()) + list(span.counters.items()):
+        otel_span.set_attribute(key, _otel_value(value))
+    if span.status == 'error':
+        otel_span.set_status(Status(StatusCode.ERROR, span.error))
+    otel_span.end()
+
+
+def _flush_otel():
+    """ wist often ends with os._exit(), which skips exit handlers flushing batched spans """
+    from opentelemetry import trace
+
+    provider = trace.get_tracer_provider()
+    if hasattr(provider, 'force_flush'):
+        provider.force_flush()
@@ -0,0 +1,284 @@
+from concurrent.futures import ThreadPoolExecutor
+import botocore.config
+import botocore.exceptions
+import threading
+import tempfile
+import logging
+import boto3
+import json
+import time
+import uuid
+import os
+
+
+# names of resources in modules/iot_core_publisher, state written here must match them exactly
+MODULE_ADDRESS = 'module.iot_core_publisher'
+_THING = ('aws_iot_thing', 'iot_thing')
+_CERT = ('aws_iot_certificate', 'iot_thing_cert')
+_THING_ATTACHMENT = ('aws_iot_thing_principal_attachment', 'attach_cert')
+_POLICY_ATTACHMENT = ('aws_iot_policy_attachment', 'attach_policy')
+_THING_TYPE = ('aws_iot_thing_type', 'iot_thing_type')
+_POLICY = ('aws_iot_policy', 'iot_connect_and_publish_to_topic')
+
+_DEPENDENCIES = {
+    _THING: [_THING_TYPE],
+    _CERT: [],
+    _THING_ATTACHMENT: [_CERT, _THING, _THING_TYPE],
+    _POLICY_ATTACHMENT: [_CERT, _POLICY],
+}
+
+MAX_WORKERS = int(os.environ.get('WIST_PROVISIONING_WORKERS', 16))
+_CLIENT_CONFIG = botocore.config.Config(retries={'mode': 'adaptive', 'max_attempts': 10},
+                                        max_pool_connections=MAX_WORKERS)
+
+_clients = threading.local()  # boto3 sessions are not thread safe, every worker thread gets its own client
+
+# API errors, and connection errors or timeouts which happen before any response
+_AWS_ERRORS = (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError)
+
+
+class ProvisioningError(Exception):
+    pass
+
+
+class PartialProvisioningError(ProvisioningError):
+    """ Provisioning of some devices failed unexpectedly, provisioned holds devices which were created """
+
+    def __init__(self, message: str, provisioned: dict):
+        super().__init__(message)
+        self.provisioned = provisioned
+
+
+def get_iot_client(region=None):
+    clients = getattr(_clients, 'by_region', None)
+    if clients is None:
+        clients = _clients.by_region = {}
+    if region not in clients:
+        clients[region] = boto3.session.Session().client('iot', region_name=region, config=_CLIENT_CONFIG)
+    return clients[region]
+
+
+def _address(resource):
+    return f'{MODULE_ADDRESS}.{resource[0]}.{resource[1]}'
+
+
+def _find_resource(state: dict, resource):
+    for state_resource in state.get('resources', []):
+        if state_resource.get('module') == MODULE_ADDRESS and state_resource.get('mode') == 'managed' \
+                and (state_resource.get('type'), state_resource.get('name')) == resource:
+            return state_resource
+    return None
+
+
+def _get_single_instance_attributes(state: dict, resource):
+    state_resource = _find_resource(state, resource)
+    if state_resource is None or not state_resource.get('instances'):
+        return None
+    return state_resource['instances'][0]['attributes']
+
+
+def get_shared_resources(state_file_path: str):
+    """ Thing type and policy the devices are attached to. None when terraform did not create them yet """
+    with open(state_file_path, 'r') as file:
+        state = json.load(file)
+    thing_type = _get_single_instance_attributes(state, _THING_TYPE)
+    policy = _get_single_instance_attributes(state, _POLICY)
+    if thing_type is None or policy is None:
+        return None
+    return {'thing_type_name': thing_type['name'], 'policy_name': policy['name'],
+            'region': thing_type['arn'].split(':')[3]}
+
+
+def _rollback(iot, created: dict, policy_name: str):
+    """ Best effort removal of what was created for a device that failed half way """
+    cert = created.get('certificate')
+    thing_name = created.get('thing', {}).get('name')
+    steps = []
+    if cert is not None:
+        steps.append(lambda: iot.detach_policy(policyName=policy_name, target=cert['arn']))
+        if thing_name is not None:
+            steps.append(lambda: iot.detach_thing_principal(thingName=thing_name, principal=cert['arn']))
+        steps.append(lambda: iot.update_certificate(certificateId=cert['id'], newStatus='INACTIVE'))
+        steps.append(lambda: iot.delete_certificate(certificateId=cert['id']))
+    for step in steps:
+        try:
+            step()
+        except _AWS_ERRORS as e:
+            logging.debug(f'Rollback step failed: {str(e)}')
+    if thing_name is not None:
+        try:
+            # create_thing succeeds for already existing thing, do not delete one that is in use
+            if not iot.list_thing_principals(thingName=thing_name)['principals']:
+                iot.delete_thing(thingName=thing_name)
+        except _AWS_ERRORS as e:
+            logging.debug(f'Rollback step failed: {str(e)}')
+
+
+def _thing_attributes(device_name: str, thing_arn: str, thing_type_name: str):
+    return {'id': device_name, 'name': device_name, 'arn': thing_arn, 'attributes': {},
+            'default_client_id': device_name, 'thing_type_name': thing_type_name, 'version': 1}
+
+
+def _certificate_attributes(certificate_arn: str, certificate_pem: str, public_key: str, private_key: str):
+    return {'id': certificate_arn.rsplit('/', 1)[1], 'arn': certificate_arn, 'active': True, 'csr': None,
+            'certificate_pem': certificate_pem, 'public_key': public_key, 'private_key': private_key}
+
+
+def _attachments_attributes(device_name: str, certificate_arn: str, policy_name: str):
+    return {'thing_attachment': {'id': f'{device_name}|{certificate_arn}', 'principal': certificate_arn,
+                                 'thing': device_name},
+            'policy_attachment': {'id': f'{policy_name}|{certificate_arn}', 'policy': policy_name,
+                                  'target': certificate_arn}}
+
+
+def device_resources(device_name: str, thing_arn: str, thing_type_name: str, policy_name: str, certificate_arn: str,
+                     certificate_pem: str, public_key: str, private_key: str) -> dict:
+    """ State attributes of all resources of a device, the same terraform would have """
+    return dict(thing=_thing_attributes(device_name, thing_arn, thing_type_name),
+                certificate=_certificate_attributes(certificate_arn, certificate_pem, public_key, private_key),
+                **_attachments_attributes(device_name, certificate_arn, policy_name))
+
+
+def provision_device(device_name: str, thing_type_name: str, policy_name: str, region=None, key=None) -> dict:
+    """ Create thing, certificate and keys, and attach certificate to the thing and to the policy.
+
+    With key (see device_keys) certificate is created from its CSR and private key is not put into state.
+    Returns state attributes of created resources, the same terraform would have.
+    """
+    iot = get_iot_client(region)
+    created = {}
+    try:
+        thing = iot.create_thing(thingName=device_name, thingTypeName=thing_type_name)
+        created['thing'] = _thing_attributes(device_name, thing['thingArn'], thing_type_name)
+
+        if key is not None:
+            cert = iot.create_certificate_from_csr(certificateSigningRequest=key['csr'], setAsActive=True)
+            created['certificate'] = _certificate_attributes(cert['certificateArn'], cert['certificatePem'],
+                                                             key['public_key'], None)
+        else:
+            cert = iot.create_keys_and_certificate(setAsActive=True)
+            created['certificate'] = _certificate_attributes(cert['certificateArn'], cert['certificatePem'],
+                                                             cert['keyPair']['PublicKey'],
+                                                             cert['keyPair']['PrivateKey'])
+
+        iot.attach_thing_principal(thingName=device_name, principal=cert['certificateArn'])
+        iot.attach_policy(policyName=policy_name, target=cert['certificateArn'])
+        created.update(_attachments_attributes(device_name, cert['certificateArn'], policy_name))
+    except _AWS_ERRORS as e:
+        _rollback(iot, created, policy_name)
+        raise ProvisioningError(f'Provisioning of {device_name} failed: {str(e)}') from e
+    return created
+
+
+def provision_devices(device_names, thing_type_name: str, policy_name: str, region=None, keys=None) -> dict:
+    """ Provision devices concurrently. Returns device name -> created resources for devices that succeeded.
+
+    Devices which failed with AWS error are left out (and can be retried by terraform). Any other error is raised as
+    PartialProvisioningError once all devices are done, with devices that succeeded, so they can still be recorded.
+    """
+    start = time.time()
+    device_names = list(dict.fromkeys(device_names))
+    keys = keys or {}
+    provisioned, errors, unexpected = {}, [], {}
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, max(len(device_names), 1))) as executor:
+        futures = {name: executor.submit(provision_device, name, thing_type_name, policy_name, region, keys.get(name))
+                   for name in device_names}
+    for name, future in futures.items():
+        try:
+            provisioned[name] = future.result()
+        except ProvisioningError as e:
+            logging.error(str(e))
+            errors.append(name)
+        except Exception as e:
+            logging.error(f'Provisioning of {name} failed unexpectedly', exc_info=e)
+            unexpected[name] = e
+    failed = len(errors) + len(unexpected)
+    logging.info(f'Provisioned {len(provisioned)} devices directly in {time.time() - start:.1f}s'
+                 + (f', {failed} failed' if failed else ''))
+    if unexpected:
+        raise PartialProvisioningError(
+            f'Provisioning of {len(unexpected)} devices failed unexpectedly: '
+            + ', '.join(f'{name}: {str(error)}' for name, error in unexpected.items()), provisioned)
+    return provisioned
+
+
+def _get_or_create_resource(state: dict, resource, provider: str):
+    state_resource = _find_resource(state, resource)
+    if state_resource is None:
+        state_resource = {'module': MODULE_ADDRESS, 'mode': 'managed', 'type': resource[0], 'name': resource[1],
+                          'each': 'map', 'provider': provider, 'instances': []}
+        state.setdefault('resources', []).append(state_resource)
+    return state_resource
+
+
+def _write_state(state_file_path: str, state: dict):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(state_file_path)), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(state, tmp_file, indent=2)
+        os.replace(tmp_path, state_file_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_devices_to_state(state_file_path: str, provisioned: dict):
+    """ Record directly provisioned devices in terraform state, so following plans see them as already created """
+    with open(state_file_path, 'r') as file:
+        state = json.load(file)
+    provider = _find_resource(state, _THING_TYPE)['provider']
+
+    for resource, key in ((_THING, 'thing'), (_CERT, 'certificate'), (_THING_ATTACHMENT, 'thing_attachment'),
+                          (_POLICY_ATTACHMENT, 'policy_attachment')):
+        state_resource = _get_or_create_resource(state, resource, provider)
+        instances = {instance.get('index_key'): instance for instance in state_resource['instances']}
+        for device_name, created in provisioned.items():
+            instances[device_name] = {'index_key': device_name, 'schema_version': 0, 'attributes': created[key],
+                                      'dependencies': [_address(dependency) for dependency in _DEPENDENCIES[resource]]}
+        state_resource['instances'] = list(instances.values())
+    state['serial'] = state.get('serial', 0) + 1
+
+    _write_state(state_file_path, state)
+    logging.info(f'Wrote {len(provisioned)} devices to state file {state_file_path} (serial {state["serial"]})')
+
+
+def move_devices_between_states(source_path: str, destination_path: str, device_names) -> int:
+    """ Move all resources of devices from one state file to another (created when missing), the same as
+    terraform state mv of each of their addresses, but reading and writing each file once.
+    Returns number of moved resource instances.
+    """
+    device_names = set(device_names)
+    with open(source_path, 'r') as file:
+        source = json.load(file)
+    if os.path.isfile(destination_path):
+        with open(destination_path, 'r') as file:
+            destination = json.load(file)
+    else:
+        destination = {'version': source.get('version', 4), 'terraform_version': source.get('terraform_version'),
+                       'serial': 0, 'lineage': str(uuid.uuid4()), 'outputs': {}, 'resources': []}
+
+    moved = 0
+    for resource in _DEPENDENCIES:
+        source_resource = _find_resource(source, resource)
+        if source_resource is None:
+            continue
+        moving = [instance for instance in source_resource['instances'] if instance.get('index_key') in device_names]
+        if not moving:
+            continue
+        source_resource['instances'] = [instance for instance in source_resource['instances']
+                                        if instance.get('index_key') not in device_names]
+        if not source_resource['instances']:
+            source['resources'].remove(source_resource)  # state mv drops resources left without instances
+        destination_resource = _get_or_create_resource(destination, resource, source_resource['provider'])
+        instances = {instance.get('index_key'): instance for instance in destination_resource['instances']}
+        instances.update((instance['index_key'], instance) for instance in moving)
+        destination_resource['instances'] = list(instances.values())
+        moved += len(moving)
+
+    if moved:
+        source['serial'] = source.get('serial', 0) + 1
+        destination['serial'] = destination.get('serial', 0) + 1
+        # destination first: interrupted move leaves devices in both states, never in neither
+        _write_state(destination_path, destination)
+        _write_state(source_path, source)
+    return moved
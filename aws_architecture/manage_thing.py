@@ -1,15 +1,28 @@
 import argparse
 import logging
-import json
+import tempfile
 import shutil
 import time
 import os
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+try:
+    from aws_architecture import state_index, device_registry, instrumentation
+except ImportError:  # running as a script from aws_architecture/
+    import state_index
+    import device_registry
+    import instrumentation
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 DEVICES_FILE = os.path.join(DATA_DIR, 'things.json')
 
+# per device resources created by modules/iot_core_publisher, all keyed by device name (for_each)
+_MODULE_ADDRESS = 'module.iot_core_publisher'
+_DEVICE_RESOURCES = ('aws_iot_thing.iot_thing', 'aws_iot_certificate.iot_thing_cert',
+                     'aws_iot_thing_principal_attachment.attach_cert', 'aws_iot_policy_attachment.attach_policy')
+
+CERT_FILES = ('certificate_pem', 'private_key', 'public_key')
+_CERT_ID_FILE = '.cert_id'  # id (fingerprint) of certificate currently extracted to device dir
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -23,101 +36,188 @@ def parse_args():
 
 
 def add_device(device_name):
-    with open(DEVICES_FILE, 'r') as devices_file:
-        devices = json.load(devices_file)  # type: list
-    #devices = list(set(devices + [device_name]))
-    if device_name in devices:
-        logging.info(f'Device with name {device_name} already exists in devices registry! Not changing anything.')
-    else:
-        devices.append(device_name)
-        with open(DEVICES_FILE, 'w') as devices_file:
-            json.dump(devices, devices_file)
-        logging.info(f"Added [{device_name}] to devices registry")
+    add_devices([device_name])
 
 
 def remove_device(device_name):
-    with open(DEVICES_FILE, 'r') as devices_file:
-        devices = json.load(devices_file)  # type: list
-    if device_name in devices:
-        devices.remove(device_name)
-        with open(DEVICES_FILE, 'w') as devices_file:
-            json.dump(devices, devices_file)
-        logging.info(f"Removed [{device_name}] from devices registry")
-    else:
-        logging.warning(f"There is no device with such name: [{device_name}]")
+    remove_devices([device_name])
 
 
-def get_devices():
-    with open(DEVICES_FILE, 'r') as devices_file:
-        devices = json.load(devices_file)  # type: list
-    return devices
+@instrumentation.timed('manage_thing.add_devices')
+def add_devices(device_names, devices_file_path=None, groups=None):
+    """ Add many devices to registry in one transaction. Returns names that were actually added """
+    registry = device_registry.DeviceRegistry(devices_file_path or DEVICES_FILE)
+    added = registry.add(device_names, groups)
+    registry.export()
+    instrumentation.current_span().add('devices_added', len(added))
+    if added:
+        logging.info(f"Added {added} to devices registry")
+    return added
 
-def show_devices():
-    devices = get_devices()
-    for i, device in enumerate(devices):
-        print(i + 1, device)
 
-def extract_certs_from_state_file(state_file_path):
-    devices_dir = os.path.join(DATA_DIR, 'iot_certs')
-    last_read_file = os.path.join(devices_dir, '.read')
+@instrumentation.timed('manage_thing.remove_devices')
+def remove_devices(device_names, devices_file_path=None):
+    """ Remove many devices from registry in one transaction. Returns names that were actually removed """
+    registry = device_registry.DeviceRegistry(devices_file_path or DEVICES_FILE)
+    removed = registry.remove(device_names)
+    registry.export()
+    instrumentation.current_span().add('devices_removed', len(removed))
+    if removed:
+        logging.info(f"Removed {removed} from devices registry")
+    return removed
 
-    if os.path.isfile(last_read_file) and os.stat(last_read_file).st_mtime_ns > os.stat(state_file_path).st_mtime_ns:
-        return
 
-    if os.path.isdir(devices_dir):
-        shutil.rmtree(devices_dir, ignore_errors=True)
-    os.mkdir(devices_dir)
+def get_device_resource_addresses(device_names):
+    """ Terraform addresses of all resources that belong to given devices, usable with -target """
+    return [f'{_MODULE_ADDRESS}.{resource}["{device_name}"]'
+            for device_name in device_names for resource in _DEVICE_RESOURCES]
 
-    with open(state_file_path, 'r') as file:
-        state_file_data = json.load(file)
 
-        devices_entry = [entry for entry in state_file_data['resources'] if entry['type'] == 'aws_iot_thing']
-        if not devices_entry:
-            logging.error("Cannot get certs. There are no devices blocks")
-            return
+def get_devices(devices_file_path=None):
+    return device_registry.DeviceRegistry(devices_file_path or DEVICES_FILE).names()
 
-        certs_entry = [entry for entry in state_file_data['resources'] if entry['type'] == 'aws_iot_certificate']
-        if not certs_entry:
-            logging.error("Cannot get certs. There are no certs blocks")
-            return
 
-        devices = devices_entry[0]['instances']
-        certs = certs_entry[0]['instances']
+def get_device_info(device_name, devices_file_path=None):
+    """ Registry metadata of a device: group, created (timestamp) and cert_id, None if not registered """
+    return device_registry.DeviceRegistry(devices_file_path or DEVICES_FILE).get(device_name)
 
-        if len(devices) != len(certs):
-            logging.error("Cannot get certs. Amount of devices isn't equal to amount of certs.")
 
-        for i, device in enumerate(devices):
-            device_dir_path = os.path.join(devices_dir, device['attributes']['name'])
-            if not os.path.isdir(device_dir_path):
-                os.mkdir(device_dir_path)
-            for key in ['certificate_pem', 'private_key', 'public_key']:
-                with open(os.path.join(device_dir_path, key), 'w') as cert_file:
-                    cert_file.write(certs[i]['attributes'][key])
+def iter_devices(devices_file_paths, prefix=None, pattern=None, offset=0, limit=None):
+    """ Registry entries of many things files sorted by name, read lazily (see device_registry.iter_devices) """
+    return device_registry.iter_devices(devices_file_paths, prefix, pattern, offset, limit)
 
-    with open(last_read_file, 'w') as last_read:
-        last_read.write(str(time.time()))
 
+def export_devices_file(devices_file_path=None):
+    """ Make sure things file read by terraform matches the registry """
+    device_registry.DeviceRegistry(devices_file_path or DEVICES_FILE).export()
 
-def extract_things_from_state_file(state_file_path):
-    with open(state_file_path, 'r') as file:
-        state_file_data = json.load(file)
+def show_devices():
+    devices = get_devices()
+    for i, device in enumerate(devices):
+        print(i + 1, device)
+
+def _write_file_atomic(path, content):
+    """ Write to temp file in the same dir and rename it, so readers never see half-written file """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_extracted_cert_id(device_dir_path):
+    try:
+        with open(os.path.join(device_dir_path, _CERT_ID_FILE), 'r') as cert_id_file:
+            return cert_id_file.read()
+    except FileNotFoundError:
+        return None
+
+
+def _read_local_device_key(device_name):
+    try:  # imported only here, it loads cryptography which is slow to import and rarely needed
+        from aws_architecture import device_keys
+    except ImportError:
+        import device_keys
+    return device_keys.read_device_key(device_name)
+
+
+def _get_cert_files(device_name, cert):
+    files = {key: cert.get(key) for key in CERT_FILES}
+    if not files['private_key']:
+        # certificate created from CSR (CSR mode), keys are only on the machine which generated them
+        local_key = _read_local_device_key(device_name)
+        if local_key is not None:
+            files['private_key'] = local_key['private_key']
+            files['public_key'] = files['public_key'] or local_key['public_key']
+        else:
+            logging.warning(f"Private key of [{device_name}] is not in state file nor on this machine")
+    return {key: content for key, content in files.items() if content}
+
+
+def _extract_device_certs(device_dir_path, cert):
+    """ Write cert files of one device unless the same certificate is already there. Returns True if written """
+    if _read_extracted_cert_id(device_dir_path) == cert['id'] and \
+            os.path.isfile(os.path.join(device_dir_path, 'certificate_pem')):
+        return False
+
+    os.makedirs(device_dir_path, exist_ok=True)
+    for key, content in _get_cert_files(os.path.basename(device_dir_path), cert).items():
+        _write_file_atomic(os.path.join(device_dir_path, key), content)
+    _write_file_atomic(os.path.join(device_dir_path, _CERT_ID_FILE), cert['id'])
+    return True
+
+
+def _remove_stale_device_dirs(devices_dir, device_names):
+    removed = 0
+    for entry in os.listdir(devices_dir):
+        entry_path = os.path.join(devices_dir, entry)
+        if entry not in device_names and not entry.startswith('.') and os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+@instrumentation.timed('manage_thing.extract_certs')
+def extract_certs_from_state_file(state_file_path, devices_dir=None):
+    devices_dir = devices_dir or os.path.join(DATA_DIR, 'iot_certs')
+    last_read_file = os.path.join(devices_dir, '.read')
+    metrics = instrumentation.current_span()
+
+    if os.path.isfile(last_read_file) and os.stat(last_read_file).st_mtime_ns > os.stat(state_file_path).st_mtime_ns:
+        metrics.set(up_to_date=True)
+        return
+    metrics.set(up_to_date=False)
+
+    os.makedirs(devices_dir, exist_ok=True)
+
+    index = state_index.get_state_index(state_file_path)
+    removed = _remove_stale_device_dirs(devices_dir, index.devices)
 
-        devices_entry = [entry for entry in state_file_data['resources'] if entry['type'] == 'aws_iot_thing']
-        if not devices_entry:
-            logging.error("Cannot get things. There is no devices blocks")
-            return
+    if not index.has_resource(state_index.THING_RESOURCE_TYPE):
+        logging.error("Cannot get certs. There are no devices blocks")
+        return
+    if not index.has_resource(state_index.CERT_RESOURCE_TYPE):
+        logging.error("Cannot get certs. There are no certs blocks")
+        return
 
-        devices = devices_entry[0]['instances']
-        devices_names = []
-        for device in devices:
-            devices_names.append(device['attributes']['name'])
+    index.report_orphans()
+
+    written = unchanged = 0
+    for device_name, device in index.devices.items():
+        cert = device['certificate']
+        if cert is None:
+            continue
+        if _extract_device_certs(os.path.join(devices_dir, device_name), cert):
+            written += 1
+        else:
+            unchanged += 1
+
+    metrics.add('certs_written', written)
+    metrics.add('certs_removed', removed)
+    metrics.add('certs_unchanged', unchanged)
+    logging.info(f"Certs extracted: {written} written, {removed} removed, {unchanged} unchanged")
+    _write_file_atomic(last_read_file, str(time.time()))
+
+
+@instrumentation.timed('manage_thing.extract_things')
+def extract_things_from_state_file(state_file_path, devices_file_path=None):
+    index = state_index.get_state_index(state_file_path)
+    instrumentation.current_span().set(devices=len(index.devices))
+    if not index.has_resource(state_index.THING_RESOURCE_TYPE):
+        logging.error("Cannot get things. There is no devices blocks")
+        return
 
-        with open(os.path.join(DATA_DIR, 'things.json'), 'w') as things_registry_file:
-            json.dump(devices_names, things_registry_file)
+    registry = device_registry.DeviceRegistry(devices_file_path or DEVICES_FILE)
+    registry.replace({device_name: device['certificate']['id'] if device['certificate'] else None
+                      for device_name, device in index.devices.items()})
+    registry.export()
 
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     args = parse_args()
     if args.add:
         logging.info("Adding device to registry")
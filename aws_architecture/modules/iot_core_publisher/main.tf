@@ -25,6 +25,13 @@ resource "aws_iot_thing_type" "iot_thing_type" {
 resource "aws_iot_certificate" "iot_thing_cert" {
   for_each = var.thing_names
   active = true
+  # with CSR the private key is generated locally and never lands in state, otherwise AWS generates keys
+  csr = lookup(var.device_csrs, each.key, null)
+
+  lifecycle {
+    # CSR is only needed to create certificate, it is not kept once device exists
+    ignore_changes = [csr]
+  }
 }
 
 # ---------------------
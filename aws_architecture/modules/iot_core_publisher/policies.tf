@@ -1,5 +1,5 @@
 resource "aws_iot_policy" "iot_connect_and_publish_to_topic" {
-  name = "tf_iot_connect_and_publish_to_topic"
+  name = var.policy_name
   policy = <<EOF
 {
   "Version": "2012-10-17",
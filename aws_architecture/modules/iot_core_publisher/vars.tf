@@ -2,6 +2,16 @@ variable thing_names {
   type = set(string)
 }
 
+variable device_csrs {
+  type = map(string)
+  default = {}
+}
+
 variable thing_type_name {
   type = string
 }
+
+variable policy_name {
+  type = string
+  default = "tf_iot_connect_and_publish_to_topic"
+}
@@ -0,0 +1,217 @@
+import logging
+import json
+import re
+import os
+
+try:
+    import ijson
+except ImportError:  # streaming parser is optional, plain json is used instead
+    ijson = None
+
+
+THING_RESOURCE_TYPE = 'aws_iot_thing'
+CERT_RESOURCE_TYPE = 'aws_iot_certificate'
+ATTACHMENT_RESOURCE_TYPE = 'aws_iot_thing_principal_attachment'
+
+# only those attributes are kept in the index, everything else in the state is skipped while parsing
+_KEPT_ATTRIBUTES = {
+    THING_RESOURCE_TYPE: ('id', 'name', 'arn', 'thing_type_name'),
+    CERT_RESOURCE_TYPE: ('id', 'arn', 'certificate_pem', 'private_key', 'public_key'),
+    ATTACHMENT_RESOURCE_TYPE: ('id', 'principal', 'thing'),
+}
+_ALL_KEPT_ATTRIBUTES = {key for keys in _KEPT_ATTRIBUTES.values() for key in keys}
+
+_SCALAR_EVENTS = {'string', 'number', 'boolean', 'null'}
+_HEADER_SIZE = 4096
+
+_cache = {}  # state file path -> (file stat key, StateIndex)
+
+
+class StateIndex():
+    """ Compact view of terraform state: device name -> {'thing': ..., 'certificate': ..., 'attachment': ...} """
+
+    def __init__(self, serial=None, lineage=None):
+        self.serial = serial
+        self.lineage = lineage
+        self.resources = {resource_type: {} for resource_type in _KEPT_ATTRIBUTES}  # type -> index_key -> attrs
+        self.resource_types = set()  # all resource types seen in state, even when instances were filtered out
+        self.devices = {}
+        self.orphaned_things = []
+        self.orphaned_certificates = []
+
+    @property
+    def version(self):
+        return self.lineage, self.serial
+
+    def has_resource(self, resource_type: str):
+        return bool(self.resources[resource_type])
+
+    def thing_names(self) -> list:
+        return list(self.devices)
+
+    def get(self, device_name: str):
+        return self.devices.get(device_name)
+
+    def add_instance(self, resource_type: str, index_key, attributes: dict):
+        if resource_type not in self.resources:
+            return
+        kept = {key: attributes.get(key) for key in _KEPT_ATTRIBUTES[resource_type]}
+        self.resources[resource_type][index_key] = kept
+
+    def build(self):
+        """ Hash join things with certificates through principal attachments (thing name -> cert arn -> cert) """
+        things = self.resources[THING_RESOURCE_TYPE]
+        certs = self.resources[CERT_RESOURCE_TYPE]
+        attachments = self.resources[ATTACHMENT_RESOURCE_TYPE]
+
+        certs_by_arn = {cert['arn']: cert for cert in certs.values()}
+        attachments_by_thing = {attachment['thing']: attachment for attachment in attachments.values()}
+
+        self.devices = {}
+        attached_cert_arns = set()
+        for index_key, thing in things.items():
+            attachment = attachments_by_thing.get(thing['name'])
+            if attachment is not None:
+                cert = certs_by_arn.get(attachment['principal'])
+            elif ATTACHMENT_RESOURCE_TYPE not in self.resource_types:
+                # state without attachment resources, fall back to the shared for_each key
+                cert = certs.get(index_key)
+            else:
+                cert = None
+            if cert is not None:
+                attached_cert_arns.add(cert['arn'])
+            self.devices[thing['name']] = {'thing': thing, 'certificate': cert, 'attachment': attachment}
+
+        self.orphaned_things = [name for name, device in self.devices.items() if device['certificate'] is None]
+        self.orphaned_certificates = [arn for arn in certs_by_arn if arn not in attached_cert_arns]
+        return self
+
+    def report_orphans(self):
+        for name in self.orphaned_things:
+            logging.warning(f"Thing [{name}] has no certificate attached in state file")
+        for arn in self.orphaned_certificates:
+            logging.warning(f"Certificate {arn} is not attached to any thing in state file")
+
+
+def _add_resource(index: StateIndex, resource: dict, index_key=None):
+    if resource.get('mode', 'managed') != 'managed':
+        return
+    index.resource_types.add(resource.get('type'))
+    for instance in resource.get('instances', []):
+        if index_key is not None and instance.get('index_key') != index_key:
+            continue
+        index.add_instance(resource.get('type'), instance.get('index_key'), instance.get('attributes', {}))
+
+
+def _parse_with_json(file, index_key=None) -> StateIndex:
+    state = json.load(file)
+    index = StateIndex(serial=state.get('serial'), lineage=state.get('lineage'))
+    for resource in state.get('resources', []):
+        _add_resource(index, resource, index_key)
+    return index
+
+
+def _parse_with_ijson(file, index_key=None) -> StateIndex:
+    """ Walk parser events and keep only resource fields the index needs, so whole state is never in memory """
+    index = StateIndex()
+    resource = None
+    instance = None
+    for prefix, event, value in ijson.parse(file):
+        if prefix == 'serial' and event == 'number':
+            index.serial = int(value)
+        elif prefix == 'lineage' and event == 'string':
+            index.lineage = value
+        elif prefix == 'resources.item':
+            if event == 'start_map':
+                resource = {'instances': []}
+            elif event == 'end_map':
+                _add_resource(index, resource, index_key)
+                resource = None
+        elif prefix in ('resources.item.mode', 'resources.item.type'):
+            resource[prefix.rsplit('.', 1)[1]] = value
+        elif prefix == 'resources.item.instances.item' and event == 'start_map':
+            instance = {'attributes': {}}
+            resource['instances'].append(instance)
+        elif prefix == 'resources.item.instances.item.index_key' and event in _SCALAR_EVENTS:
+            instance['index_key'] = value
+        elif prefix.startswith('resources.item.instances.item.attributes.') and event in _SCALAR_EVENTS \
+                and (index_key is None or instance.get('index_key') == index_key):
+            key = prefix[len('resources.item.instances.item.attributes.'):]
+            if key in _ALL_KEPT_ATTRIBUTES:
+                instance['attributes'][key] = value
+    return index
+
+
+def _read_state_version(state_file_path: str):
+    """ Read (lineage, serial) from the top of the state file without parsing resources """
+    with open(state_file_path, 'r') as file:
+        header = file.read(_HEADER_SIZE)
+    serial = re.search(r'"serial"\s*:\s*(\d+)', header)
+    lineage = re.search(r'"lineage"\s*:\s*"([^"]*)"', header)
+    if serial is None or lineage is None:
+        return None
+    return lineage.group(1), int(serial.group(1))
+
+
+def _stat_key(state_file_path: str):
+    stat = os.stat(state_file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def parse_state_file(state_file_path: str, index_key=None) -> StateIndex:
+    """ Parse state file into index. With index_key given only instances with that for_each key are kept """
+    if ijson is not None:
+        with open(state_file_path, 'rb') as file:
+            index = _parse_with_ijson(file, index_key)
+    else:
+        with open(state_file_path, 'r') as file:
+            index = _parse_with_json(file, index_key)
+    logging.debug(f"Parsed state file {state_file_path} (serial {index.serial}, {len(index.resources[THING_RESOURCE_TYPE])} things)")
+    return index.build()
+
+
+def _get_cached_index(state_file_path: str):
+    key = os.path.abspath(state_file_path)
+    stat_key = _stat_key(state_file_path)
+    cached = _cache.get(key)
+    if cached is None:
+        return None
+    cached_stat_key, cached_index = cached
+    if cached_stat_key == stat_key:
+        return cached_index
+    if cached_index.serial is not None and _read_state_version(state_file_path) == cached_index.version:
+        _cache[key] = (stat_key, cached_index)
+        return cached_index
+    return None
+
+
+def get_state_index(state_file_path: str) -> StateIndex:
+    """ Return index of the state file, parsing it only when its lineage/serial changed since last call """
+    index = _get_cached_index(state_file_path)
+    if index is None:
+        stat_key = _stat_key(state_file_path)
+        index = parse_state_file(state_file_path)
+        _cache[os.path.abspath(state_file_path)] = (stat_key, index)
+    return index
+
+
+def find_device(state_file_path: str, device_name: str):
+    """ Look up a single device without indexing the whole fleet when there is no up to date index yet """
+    index = _get_cached_index(state_file_path)
+    if index is not None:
+        return index.get(device_name)
+
+    # thing, cert and attachments of a device share its for_each key, which is the thing name
+    index = parse_state_file(state_file_path, index_key=device_name)
+    device = index.get(device_name)
+    if device is not None and device['certificate'] is None:
+        # attached certificate lives under another key, full join is needed
+        device = get_state_index(state_file_path).get(device_name)
+    return device
+
+
+def invalidate(state_file_path: str = None):
+    if state_file_path is None:
+        _cache.clear()
+    else:
+        _cache.pop(os.path.abspath(state_file_path), None)
@@ -1,32 +1,84 @@
 import botocore.exceptions
+import threading
 import datetime
 import argparse
+import hashlib
 import pathlib
 import logging
-import boto3
+import socket
+import random
+import json
+import gzip
+import time
+import uuid
 import os
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+try:
+    from aws_architecture import instrumentation
+except ImportError:  # running as a script from aws_architecture/
+    import instrumentation
+
 s3 = None
+_s3_lock = threading.Lock()
 
 
 def init_aws_client():
     global s3
+    import boto3  # takes a while to import, only commands which talk to S3 pay for it
+
     s3 = boto3.client('s3')
 
 
+def get_s3_client():
+    """ S3 client is created on first use, so after AWS credentials are set up and only when needed """
+    with _s3_lock:
+        if s3 is None:
+            init_aws_client()
+    return s3
+
+
 BUCKET = "tfstates.backup"
 
+COMPRESSION_FORMATS = ('none', 'gzip', 'zstd')
+_COMPRESSION_METADATA_KEY = 'wist-compression'
+compression = os.environ.get('WIST_TFSTATE_COMPRESSION', 'none')  # format used by push
+
+LOCK_TTL = 5 * 60  # seconds, lock is renewed by heartbeat while it is held
+LOCK_WAIT = 0  # seconds, how long lock() waits for lock held by someone else
+_LOCK_BACKOFF_BASE = 1
+_LOCK_BACKOFF_MAX = 30
+_MAX_RENEWAL_FAILURES = 3  # renewals run every ttl/3, after that many failures in a row the lease has expired
+
+# identifies this process as lock owner
+LOCK_OWNER = f"{os.environ.get('USER', os.environ.get('USERNAME', 'unknown'))}@{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_held_locks = {}  # s3 lock name -> _LockHeartbeat
+_not_uploaded = set()  # s3 lock names of files whose last upload failed, their locks are not released
+
+_MB = 1024 * 1024
+_MULTIPART_THRESHOLD = 8 * _MB  # larger states are uploaded in parts, in parallel
+_MULTIPART_CHUNKSIZE = 8 * _MB
+_MAX_CONCURRENCY = 8
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--timeout', help="Time in minutes how long lock on tfstate file will work", default=30)
+    parser.add_argument('--timeout', help="Time in minutes how long lock on tfstate file will work", default=30, type=int)
+    parser.add_argument('--wait', help="Time in seconds how long to wait for lock held by someone else", default=LOCK_WAIT,
+                        type=int)
     parser.add_argument('--path', required=True, help="Path to tfstate file")
     parser.add_argument('--push', help="Upload tfstate file to S3", action='store_true')
     parser.add_argument('--pull', help="Download tfstate file backup from S3", action='store_true')
     parser.add_argument('--lock', help="Lock tfstate file", action='store_true')
     parser.add_argument('--unlock', help="Unlock tfstate file", action='store_true')
     parser.add_argument('--is_locked', help="Check if file is locked", action='store_true')
+    parser.add_argument('--compression', help="Compression used for uploaded backup", choices=COMPRESSION_FORMATS,
+                        default=compression)
     parse_args.print_help = parser.print_help
     return parser.parse_args()
 
@@ -41,78 +93,384 @@ def _get_s3_name_and_s3_lock_name(file_path: str):
     return s3_name, s3_name + ".lock"
 
 
-def lock(state_terraform_file_path: str):
-    """ Lock tfstate file """
+class LockError(Exception):
+    pass
+
+
+class LockLostError(LockError):
+    """ Lock held by this process expired or was taken over, state must not be uploaded """
+    pass
+
+
+class BackupError(Exception):
+    """ State was not uploaded, S3 still has the previous one """
+    pass
+
+
+def _get_error_code(error: botocore.exceptions.ClientError):
+    return error.response.get('Error', {}).get('Code')
+
+
+def _lock_body(ttl: int):
+    now = time.time()
+    return json.dumps({'owner': LOCK_OWNER,
+                       'acquired': datetime.datetime.fromtimestamp(now, datetime.timezone.utc).isoformat(),
+                       'expires': now + ttl}).encode('utf-8')
+
+
+def _read_lock(s3_lock_name: str, timeout=30):
+    """ Return (lock info, etag) or (None, None) when there is no lock """
+    try:
+        lock_object = get_s3_client().get_object(Bucket=BUCKET, Key=s3_lock_name)
+    except botocore.exceptions.ClientError as e:
+        if _get_error_code(e) in ('NoSuchKey', '404'):
+            return None, None
+        raise
+    try:
+        lock_info = json.loads(lock_object['Body'].read())
+    except ValueError:
+        # lock created by older version, it only has its creation time
+        expires = lock_object['LastModified'] + datetime.timedelta(minutes=timeout)
+        lock_info = {'owner': 'unknown', 'expires': expires.timestamp()}
+    return lock_info, lock_object['ETag']
+
+
+def _put_lock(s3_lock_name: str, ttl: int, etag=None):
+    """ Conditionally write lock. Without etag lock must not exist, with etag it must not have changed since read """
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    try:
+        response = get_s3_client().put_object(Body=_lock_body(ttl), Bucket=BUCKET, Key=s3_lock_name, **condition)
+    except botocore.exceptions.ClientError as e:
+        if _get_error_code(e) in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            return None
+        raise
+    return response['ETag']
+
+
+class _LockHeartbeat(threading.Thread):
+    """ Renews lease of a held lock until stopped """
+
+    def __init__(self, s3_lock_name: str, etag: str, ttl: int):
+        super().__init__(name=f'lock-heartbeat-{s3_lock_name}', daemon=True)
+        self.s3_lock_name = s3_lock_name
+        self.etag = etag
+        self.ttl = ttl
+        self.lost_event = threading.Event()  # set when lease is lost, e.g. to interrupt running terraform
+        self._stopped = threading.Event()
+
+    @property
+    def lost(self):
+        return self.lost_event.is_set()
+
+    def run(self):
+        failures = 0
+        while not self._stopped.wait(self.ttl / 3):
+            try:
+                etag = _put_lock(self.s3_lock_name, self.ttl, self.etag)
+            except Exception:
+                failures += 1
+                if failures < _MAX_RENEWAL_FAILURES:
+                    logging.exception(f"Failed to renew lock {self.s3_lock_name}, will retry")
+                    continue
+                logging.exception(f"Failed to renew lock {self.s3_lock_name} {failures} times in a row, "
+                                  f"it has expired!")
+                self.lost_event.set()
+                return
+            if etag is None:
+                logging.error(f"Lock {self.s3_lock_name} was taken over by someone else!")
+                self.lost_event.set()
+                return
+            failures = 0
+            self.etag = etag
+
+    def stop(self):
+        self._stopped.set()
+
+
+def try_lock(state_terraform_file_path: str, ttl: int = LOCK_TTL):
+    """ Single attempt to lock tfstate file. Expired locks are taken over. Returns True when lock is held """
     s3_name, s3_lock_name = _get_s3_name_and_s3_lock_name(state_terraform_file_path)
-    s3.put_object(Body=b'-', Bucket=BUCKET, Key=s3_lock_name)
+    if s3_lock_name in _held_locks:
+        return True
+
+    etag = _put_lock(s3_lock_name, ttl)
+    if etag is None:
+        lock_info, lock_etag = _read_lock(s3_lock_name)
+        if lock_info is None:
+            return False  # released in the meantime, next attempt will get it
+        if lock_info['expires'] > time.time():
+            logging.info(f"{s3_name} file is locked by {lock_info['owner']}")
+            return False
+        logging.warning(f"Taking over expired lock of {lock_info['owner']} on {s3_name} file")
+        etag = _put_lock(s3_lock_name, ttl, lock_etag)
+        if etag is None:
+            return False
+
+    heartbeat = _LockHeartbeat(s3_lock_name, etag, ttl)
+    heartbeat.start()
+    _held_locks[s3_lock_name] = heartbeat
     logging.info(f"Locked {s3_name} file")
+    return True
+
+
+@instrumentation.timed('tfstates_backup.lock')
+def lock(state_terraform_file_path: str, ttl: int = LOCK_TTL, wait: int = None):
+    """ Lock tfstate file, waiting with bounded exponential backoff up to `wait` seconds for other owner """
+    wait = LOCK_WAIT if wait is None else wait
+    deadline = time.time() + wait
+    attempt = 0
+    while not try_lock(state_terraform_file_path, ttl):
+        instrumentation.current_span().add('lock_retries')
+        delay = min(_LOCK_BACKOFF_MAX, _LOCK_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+        if time.time() + delay > deadline:
+            raise LockError(f'Could not lock terraform backup state file {state_terraform_file_path}!')
+        logging.info(f"Waiting {delay:.1f}s for lock on tfstate file")
+        time.sleep(delay)
+        attempt += 1
+
+
+def get_lock_lost_event(state_terraform_file_path: str):
+    """ Event set when lock of tfstate file held by this process is lost, None when it is not held """
+    s3_name, s3_lock_name = _get_s3_name_and_s3_lock_name(state_terraform_file_path)
+    heartbeat = _held_locks.get(s3_lock_name)
+    return heartbeat.lost_event if heartbeat is not None else None
 
 
+def check_lock(state_terraform_file_path: str):
+    """ Raise LockLostError when lock of tfstate file held by this process was lost """
+    s3_name, s3_lock_name = _get_s3_name_and_s3_lock_name(state_terraform_file_path)
+    heartbeat = _held_locks.get(s3_lock_name)
+    if heartbeat is not None and heartbeat.lost:
+        raise LockLostError(f'Lock on {s3_name} file was lost, someone else may be changing it')
+
+
+@instrumentation.timed('tfstates_backup.unlock')
 def unlock(state_terraform_file_path: str):
-    """ Unlock tfstate file """
+    """ Unlock tfstate file, if it is locked by this process. Returns True when lock was released """
     s3_name, s3_lock_name = _get_s3_name_and_s3_lock_name(state_terraform_file_path)
-    s3.delete_object(Bucket=BUCKET, Key=s3_lock_name)
+    heartbeat = _held_locks.pop(s3_lock_name, None)
+    if heartbeat is not None:
+        heartbeat.stop()
+        heartbeat.join()  # renewal in progress would change etag
+    if s3_lock_name in _not_uploaded:
+        # next owner would pull stale state, lock expires after its TTL unless state is uploaded first
+        logging.error(f"Not unlocking {s3_name} file, its state was not uploaded to S3. Upload "
+                      f"{state_terraform_file_path} (tfstates_backup.py --push) and remove the lock (--unlock)")
+        return False
+    if heartbeat is not None:
+        if heartbeat.lost:
+            logging.warning(f"Not unlocking {s3_name} file, lock held by this process was lost")
+            return False
+        etag = heartbeat.etag
+    else:
+        lock_info, etag = _read_lock(s3_lock_name)
+        if lock_info is None:
+            return False
+        if lock_info['owner'] != LOCK_OWNER:
+            logging.warning(f"Not unlocking {s3_name} file, it is locked by {lock_info['owner']}")
+            return False
+    try:
+        # only the lock written by this process, it could have been taken over since it was last renewed
+        get_s3_client().delete_object(Bucket=BUCKET, Key=s3_lock_name, IfMatch=etag)
+    except botocore.exceptions.ClientError as e:
+        if _get_error_code(e) in ('PreconditionFailed', '412', 'NoSuchKey', '404'):
+            logging.warning(f"Not unlocking {s3_name} file, lock is no longer held by this process")
+            return False
+        raise
     logging.info(f"Unlocked {s3_name} file")
+    return True
+
+
+def force_unlock(state_terraform_file_path: str):
+    """ Remove lock regardless of its owner """
+    s3_name, s3_lock_name = _get_s3_name_and_s3_lock_name(state_terraform_file_path)
+    get_s3_client().delete_object(Bucket=BUCKET, Key=s3_lock_name)
+    logging.info(f"Force unlocked {s3_name} file")
 
 
 def is_locked(state_terraform_file_path: str, timeout=30):
-    """ Check if tfstate file is locked or timeout passed """
+    """ Check if tfstate file is locked and lock has not expired. Timeout (minutes) applies to old style locks """
     s3_name, s3_lock_name = _get_s3_name_and_s3_lock_name(state_terraform_file_path)
-    try:
-        tfstate_file_head = s3.head_object(Bucket=BUCKET, Key=s3_name)
-        lock_file_head = s3.head_object(Bucket=BUCKET, Key=s3_lock_name)
-    except botocore.exceptions.ClientError:
+    lock_info, _ = _read_lock(s3_lock_name, timeout)
+    if lock_info is None:
         logging.debug("Lock file doesn't exist")
         return False
-    if lock_file_head['LastModified'] < tfstate_file_head['LastModified']:
-        logging.debug("Lock file is older than tfstate file")
-        return False
-    lock_datetime_and_timeout = (lock_file_head['LastModified'] + datetime.timedelta(minutes=timeout)).replace(
-        tzinfo=None)
-    now_datetime = datetime.datetime.utcnow().replace(tzinfo=None)
-    if lock_datetime_and_timeout < now_datetime:
+    if lock_info['expires'] < time.time():
         logging.debug("Timeout passed")
         return False
     return True
 
 
+def _get_pull_cache_path(state_terraform_file_path: str):
+    return state_terraform_file_path + '.s3cache'
+
+
+def _compute_sha256(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read_pull_cache(state_terraform_file_path: str):
+    """ Return remembered S3 ETag if local tfstate file is still exactly what was downloaded/uploaded last time """
+    try:
+        with open(_get_pull_cache_path(state_terraform_file_path), 'r') as cache_file:
+            cache = json.load(cache_file)
+        stat = os.stat(state_terraform_file_path)
+    except (OSError, ValueError):
+        return None
+
+    if (stat.st_mtime_ns, stat.st_size) != (cache.get('mtime_ns'), cache.get('size')):
+        # file was touched locally, it is still valid if content did not change
+        with open(state_terraform_file_path, 'rb') as file:
+            if _compute_sha256(file.read()) != cache.get('sha256'):
+                return None
+    return cache.get('ETag')
+
+
+def _write_pull_cache(state_terraform_file_path: str, etag: str, last_modified, sha256: str):
+    stat = os.stat(state_terraform_file_path)
+    cache = {'ETag': etag,
+             'LastModified': last_modified.isoformat() if last_modified else None,
+             'sha256': sha256,
+             'mtime_ns': stat.st_mtime_ns,
+             'size': stat.st_size}
+    with open(_get_pull_cache_path(state_terraform_file_path), 'w') as cache_file:
+        json.dump(cache, cache_file)
+
+
+def _is_not_modified_error(error: botocore.exceptions.ClientError):
+    return error.response.get('Error', {}).get('Code') in ('304', 'NotModified')
+
+
+def _compress(data: bytes, compression_format: str):
+    if compression_format == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if compression_format == 'zstd':
+        if zstandard is None:
+            raise Exception("zstd compression requires 'zstandard' package")
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return data
+
+
+def _decompress(data: bytes, compression_format: str):
+    if compression_format == 'gzip':
+        return gzip.decompress(data)
+    if compression_format == 'zstd':
+        if zstandard is None:
+            raise Exception("Backup is zstd compressed, 'zstandard' package is required to read it")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+@instrumentation.timed('tfstates_backup.pull')
 def pull(state_terraform_file_path: str):
-    """ Download tfstate file backup from S3 """
+    """ Download tfstate file backup from S3, unless local copy is the same as backup """
     s3_name, s3_lock_name = _get_s3_name_and_s3_lock_name(state_terraform_file_path)
-    file = s3.get_object(Bucket=BUCKET, Key=s3_name)
-    with open(state_terraform_file_path, 'wb') as terraform_file:
-        terraform_file.write(file['Body'].read())
-    logging.info("Backup downloaded from AWS S3 without problems")
+    request = {'Bucket': BUCKET, 'Key': s3_name}
+    cached_etag = _read_pull_cache(state_terraform_file_path)
+    if cached_etag:
+        request['IfNoneMatch'] = cached_etag
+    start = time.time()
+    try:
+        file = get_s3_client().get_object(**request)
+    except botocore.exceptions.ClientError as e:
+        if cached_etag and _is_not_modified_error(e):
+            logging.info("Backup on AWS S3 not changed, using local tfstate file")
+            instrumentation.current_span().set(not_modified=True)
+            return
+        raise
+
+    raw_body = file['Body'].read()
+    compression_format = file.get('Metadata', {}).get(_COMPRESSION_METADATA_KEY, 'none')
+    body = _decompress(raw_body, compression_format)
+    tmp_path = state_terraform_file_path + '.tmp'
+    with open(tmp_path, 'wb') as terraform_file:
+        terraform_file.write(body)
+    os.replace(tmp_path, state_terraform_file_path)
+    _write_pull_cache(state_terraform_file_path, file['ETag'], file.get('LastModified'), _compute_sha256(body))
+    metrics = instrumentation.current_span()
+    metrics.set(not_modified=False, compression=compression_format)
+    metrics.add('bytes_transferred', len(raw_body))
+    metrics.add('state_bytes', len(body))
+    logging.info(f"Backup downloaded from AWS S3 without problems ({len(raw_body)} bytes transferred, "
+                 f"{len(body)} bytes of state, compression: {compression_format}, took {time.time() - start:.2f}s)")
+
 
+def _upload_part(s3_name: str, upload_id: str, part_number: int, chunk: bytes):
+    response = get_s3_client().upload_part(Bucket=BUCKET, Key=s3_name, UploadId=upload_id, PartNumber=part_number,
+                                           Body=chunk)
+    return {'PartNumber': part_number, 'ETag': response['ETag']}
 
-def push(state_terraform_file_path: str):
-    """ Upload tfstate file to S3 """
+
+def _upload(s3_name: str, body: bytes, metadata: dict):
+    """ Write object in one request, or in parts when it is large. Returns ETag of exactly the written version """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if len(body) <= _MULTIPART_THRESHOLD:
+        return get_s3_client().put_object(Bucket=BUCKET, Key=s3_name, Body=body, Metadata=metadata)['ETag']
+
+    upload_id = get_s3_client().create_multipart_upload(Bucket=BUCKET, Key=s3_name, Metadata=metadata)['UploadId']
+    try:
+        chunks = [body[offset:offset + _MULTIPART_CHUNKSIZE] for offset in range(0, len(body), _MULTIPART_CHUNKSIZE)]
+        with ThreadPoolExecutor(max_workers=min(_MAX_CONCURRENCY, len(chunks))) as executor:
+            parts = list(executor.map(lambda numbered: _upload_part(s3_name, upload_id, *numbered),
+                                      enumerate(chunks, start=1)))
+        return get_s3_client().complete_multipart_upload(Bucket=BUCKET, Key=s3_name, UploadId=upload_id,
+                                                         MultipartUpload={'Parts': parts})['ETag']
+    except BaseException:
+        try:
+            get_s3_client().abort_multipart_upload(Bucket=BUCKET, Key=s3_name, UploadId=upload_id)
+        except botocore.exceptions.ClientError:
+            logging.debug(f"Could not abort multipart upload of {s3_name}, bucket lifecycle rule removes it")
+        raise
+
+
+@instrumentation.timed('tfstates_backup.push')
+def push(state_terraform_file_path: str, compression_format: str = None):
+    """ Upload tfstate file to S3, optionally compressed. Raises BackupError when upload fails, lock of the file
+    is then kept by unlock(), so nobody else works with the stale state in S3 """
+    check_lock(state_terraform_file_path)  # state of process which lost its lock would overwrite new owner's changes
+    compression_format = compression_format or compression
     s3_name, s3_lock_name = _get_s3_name_and_s3_lock_name(state_terraform_file_path)
     with open(state_terraform_file_path, 'rb') as file_obj:
-        try:
-            s3.upload_fileobj(file_obj, Bucket=BUCKET, Key=s3_name)
-            logging.info("Backup is safe on AWS S3")
-        except:
-            logging.exception("Backup upload fails")
+        data = file_obj.read()
+    start = time.time()
+    try:
+        body = _compress(data, compression_format)
+        etag = _upload(s3_name, body, {_COMPRESSION_METADATA_KEY: compression_format})
+        metrics = instrumentation.current_span()
+        metrics.set(compression=compression_format)
+        metrics.add('bytes_transferred', len(body))
+        metrics.add('state_bytes', len(data))
+        logging.info(f"Backup is safe on AWS S3 ({len(body)} bytes transferred, {len(data)} bytes of state, "
+                     f"compression: {compression_format}, took {time.time() - start:.2f}s)")
+    except Exception as e:
+        logging.exception("Backup upload fails")
+        _not_uploaded.add(s3_lock_name)
+        raise BackupError(f'Uploading {s3_name} to S3 failed: {str(e)}') from e
+    _not_uploaded.discard(s3_lock_name)
+
+    # remember uploaded version, so next pull does not download it back. ETag comes from the write itself, a later
+    # read could already see somebody else's upload (LastModified is not returned by writes)
+    _write_pull_cache(state_terraform_file_path, etag, None, _compute_sha256(data))
 
 
 if __name__ == '__main__':
-    init_aws_client()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     args = parse_args()
     if args.push:
         logging.info("Uploading .tfstate file to S3")
-        push(args.path)
+        push(args.path, args.compression)
     elif args.pull:
         logging.info("Downloading .tfstate backup from S3")
         pull(args.path)
     elif args.lock:
         logging.info("Creating lock on .tfstate backup from S3")
-        lock(args.path)
+        lock(args.path, ttl=args.timeout * 60, wait=args.wait)
     elif args.unlock:
         logging.info("Removing lock on .tfstate backup from S3")
-        unlock(args.path)
+        force_unlock(args.path)
     elif args.is_locked:
-        if is_locked(args.path):
+        if is_locked(args.path, args.timeout):
             logging.info(".tfstate file is locked")
         else:
             logging.info(".tfstate file isn't locked")
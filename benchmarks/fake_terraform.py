@@ -0,0 +1,144 @@
+""" Stand-in for terraform binary used by benchmarks: no providers, no AWS calls.
+
+Supports version, init, plan and apply of environments/things_management: apply makes state hold resources of
+exactly the devices in things file, the same way iot_core_publisher module would. state mv moves resource instances
+between -state and -state-out files. Time spent is reading and writing state, so it still grows with the fleet like
+real terraform does. Output is the same as of Terraform 0.12.
+"""
+import json
+import uuid
+import sys
+import re
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import synthetic_state
+from aws_architecture import manage_thing
+
+_ADDRESS = re.compile(r'^(?P<module>module\.[^.]+)\.(?P<type>[^.]+)\.(?P<name>[^.\[]+)\["(?P<key>[^"]+)"\]$')
+
+
+def _paths():
+    workspace = os.environ.get('TF_WORKSPACE', 'default')
+    if workspace == 'default':
+        return 'terraform.tfstate', os.path.join('..', '..', 'data', 'things.json')
+    return (os.path.join('terraform.tfstate.d', workspace, 'terraform.tfstate'),
+            os.path.join('..', '..', 'data', f'things.{workspace}.json'))
+
+
+def _changes():
+    """ Devices to add and to remove """
+    state_path, things_path = _paths()
+    with open(things_path, 'r') as file:
+        wanted = json.load(file)
+    if not os.path.isfile(state_path):
+        os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+        with open(state_path, 'w') as file:
+            json.dump(synthetic_state.empty_state(), file)
+    with open(state_path, 'r') as file:
+        state = json.load(file)
+    existing = {instance['index_key'] for resource in state['resources'] if resource['type'] == 'aws_iot_thing'
+                for instance in resource['instances']}
+    return [name for name in wanted if name not in existing], existing.difference(wanted)
+
+
+def _load_state(path: str, default=None):
+    if default is not None and not os.path.isfile(path):
+        return default
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+def _state_mv(args) -> int:
+    """ terraform state mv -state=<source> -state-out=<destination> <address> <address>, instances of for_each
+    resources only. Both states are read and written on every call, like terraform does
+    """
+    options = dict(arg[1:].split('=', 1) for arg in args if arg.startswith('-'))
+    addresses = [arg for arg in args if not arg.startswith('-')]
+    source_path = options.get('state', 'terraform.tfstate')
+    destination_path = options.get('state-out', source_path)
+    if len(addresses) != 2 or addresses[0] != addresses[1] or not _ADDRESS.match(addresses[0]):
+        print(f'fake terraform supports only moving an instance to the same address: {" ".join(addresses)}',
+              file=sys.stderr)
+        return 1
+    address = _ADDRESS.match(addresses[0])
+
+    source = _load_state(source_path)
+    destination = source if destination_path == source_path else _load_state(destination_path, {
+        'version': 4, 'terraform_version': '0.12.24', 'serial': 0, 'lineage': str(uuid.uuid4()), 'outputs': {},
+        'resources': []})
+
+    def find(state):
+        return next((resource for resource in state['resources'] if resource.get('module') == address['module']
+                     and resource['type'] == address['type'] and resource['name'] == address['name']), None)
+
+    source_resource = find(source)
+    instance = next((instance for instance in (source_resource or {}).get('instances', ())
+                     if instance.get('index_key') == address['key']), None)
+    if instance is None:
+        print(f'Error: Invalid source address: no resource instance {addresses[0]}', file=sys.stderr)
+        return 1
+    source_resource['instances'].remove(instance)
+    if not source_resource['instances']:
+        source['resources'].remove(source_resource)
+    destination_resource = find(destination)
+    if destination_resource is None:
+        destination_resource = dict(source_resource, instances=[])
+        destination['resources'].append(destination_resource)
+    destination_resource['instances'].append(instance)
+
+    for path, state in {destination_path: destination, source_path: source}.items():
+        state['serial'] = state.get('serial', 0) + 1
+        with open(path, 'w') as file:
+            json.dump(state, file)
+    print(f'Move "{addresses[0]}" to "{addresses[1]}"')
+    print('Successfully moved 1 object(s).')
+    return 0
+
+
+def main(args):
+    if args[0] == 'version':
+        print('Terraform v0.12.24')
+    elif args[0] == 'init':
+        os.makedirs(os.environ.get('TF_DATA_DIR') or '.terraform', exist_ok=True)
+    elif args[0] == 'plan':
+        to_add, to_remove = _changes()
+        for arg in args:
+            if arg.startswith('-out='):
+                with open(arg[len('-out='):], 'w') as file:
+                    json.dump({'add': to_add, 'remove': sorted(to_remove)}, file)
+        for address in manage_thing.get_device_resource_addresses(to_add):
+            print(f'  # {address} will be created')
+        for address in manage_thing.get_device_resource_addresses(sorted(to_remove)):
+            print(f'  # {address} will be destroyed')
+        resources = len(manage_thing.get_device_resource_addresses(['']))
+        print(f'Plan: {len(to_add) * resources} to add, 0 to change, {len(to_remove) * resources} to destroy.')
+        return 2 if to_add or to_remove else 0
+    elif args[0] == 'apply':
+        state_path, _ = _paths()
+        with open(args[-1], 'r') as file:
+            plan = json.load(file)
+        for address in manage_thing.get_device_resource_addresses(plan['remove']):
+            print(f'{address}: Destroying...')
+        synthetic_state.remove_devices(state_path, plan['remove'])
+        for address in manage_thing.get_device_resource_addresses(plan['remove']):
+            print(f'{address}: Destruction complete after 0s')
+        for address in manage_thing.get_device_resource_addresses(plan['add']):
+            print(f'{address}: Creating...')
+        synthetic_state.add_devices(state_path, plan['add'])
+        for address in manage_thing.get_device_resource_addresses(plan['add']):
+            print(f'{address}: Creation complete after 0s [id={address}]')
+        resources = len(manage_thing.get_device_resource_addresses(['']))
+        print(f"Apply complete! Resources: {len(plan['add']) * resources} added, 0 changed, "
+              f"{len(plan['remove']) * resources} destroyed.")
+    elif args[:2] == ['state', 'mv']:
+        return _state_mv(args[2:])
+    else:
+        print(f'fake terraform does not support: {" ".join(args)}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,396 @@
+""" Benchmarks of state processing and provisioning hot paths on synthetic fleets of 10 to 50k devices.
+
+Everything runs in a scratch directory: wist data dir, Terraform environment and cache are pointed there, S3 and IoT
+are mocked with moto (benchmarks which need AWS are skipped when moto is not installed, see requirements.txt here)
+and terraform is a fake binary (fake_terraform.py), so no AWS account is needed and nothing in the repository is
+touched.
+
+    python benchmarks/hot_paths.py                                  # all benchmarks, all sizes
+    python benchmarks/hot_paths.py --sizes 10 1000 --only registry
+    python benchmarks/hot_paths.py --save                           # append run to benchmarks/results/<host>.jsonl
+    python benchmarks/hot_paths.py --compare --max_slowdown 1.5     # exit 1 if slower than last saved run
+"""
+import statistics
+import argparse
+import tempfile
+import platform
+import logging
+import shutil
+import socket
+import json
+import time
+import sys
+import os
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'wist_config_tool')]
+
+import synthetic_state
+
+try:
+    from moto import mock_aws
+    _MOCKS_IOT = True
+except ImportError:
+    _MOCKS_IOT = False
+    try:
+        from moto import mock_s3 as mock_aws  # moto < 5
+    except ImportError:  # S3 benchmarks are optional
+        mock_aws = None
+
+
+DEFAULT_SIZES = (10, 1000, 10000, 50000)
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+GROUPS = ('state', 'registry', 'certs', 's3', 'terraform', 'boto3', 'rebalance')
+_MOTO_GROUPS = ('s3', 'boto3', 'rebalance')
+_IOT_GROUPS = ('boto3',)  # need moto >= 5, mock_aws
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="Fleet sizes (number of devices)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of every benchmark, median is reported")
+    parser.add_argument('--only', choices=GROUPS, nargs='+', default=GROUPS, help="Run only these groups")
+    parser.add_argument('--save', action='store_true', help="Append results to the history file")
+    parser.add_argument('--compare', action='store_true',
+                        help="Compare with last run saved in the history file, exit 1 on regression")
+    parser.add_argument('--history', default=os.path.join(RESULTS_DIR, f'{socket.gethostname()}.jsonl'),
+                        help="History of saved runs, one JSON per line (default: benchmarks/results/<host>.jsonl)")
+    parser.add_argument('--max_slowdown', type=float, default=1.5,
+                        help="Benchmark slower than this many times its saved median is a regression")
+    parser.add_argument('--keep', action='store_true', help="Do not remove scratch directory")
+    return parser.parse_args()
+
+
+def _measure(function, setup=None, repeat=3) -> list:
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _fake_terraform_command(root: str) -> str:
+    """ Executable which runs fake_terraform.py with this interpreter, used as terraform binary """
+    fake = os.path.join(BENCHMARKS_DIR, 'fake_terraform.py')
+    root = os.path.join(root, 'bin')
+    os.makedirs(root, exist_ok=True)
+    if sys.platform.startswith('win32'):
+        path = os.path.join(root, 'terraform.bat')
+        with open(path, 'w') as file:
+            file.write(f'@"{sys.executable}" "{fake}" %*\n')
+    else:
+        path = os.path.join(root, 'terraform')
+        with open(path, 'w') as file:
+            file.write(f'#!/bin/sh\nexec "{sys.executable}" "{fake}" "$@"\n')
+        os.chmod(path, 0o755)
+    return path
+
+
+def setup_sandbox(root: str):
+    """ Point wist at scratch directory instead of the repository and user cache """
+    os.environ['WIST_CACHE_DIR'] = os.path.join(root, 'cache')
+    os.environ['TF_DATA_DIR'] = os.path.join(root, 'cache', 'terraform_data')
+    for name, value in (('AWS_ACCESS_KEY_ID', 'benchmark'), ('AWS_SECRET_ACCESS_KEY', 'benchmark'),
+                        ('AWS_DEFAULT_REGION', synthetic_state.REGION)):
+        os.environ[name] = value  # moto only, real credentials must never be used here
+
+    from wist import common
+    common.setup_config()
+    from wist import shards, aws_tools, terraform_management, cert_bundles
+    from aws_architecture import manage_thing
+
+    env_dir = os.path.join(root, 'environments', 'things_management')
+    data_dir = os.path.join(root, 'data')
+    for path in (env_dir, data_dir, os.path.join(root, 'terraform')):
+        os.makedirs(path, exist_ok=True)
+
+    manage_thing.DATA_DIR = data_dir
+    manage_thing.DEVICES_FILE = os.path.join(data_dir, 'things.json')
+    shards.TERRAFORM_ENVIRONMENT_DIR = env_dir
+    shards.SHARDS_CONFIG_FILE_PATH = os.path.join(data_dir, 'shards.json')
+    aws_tools._TERRAFORM_STATE_LOCAL_DIR = env_dir
+    aws_tools._DEFAULT_SHARD = shards.Shard(0)
+    aws_tools.TERRAFORM_STATE_FILE_PATH_LOCAL = aws_tools._DEFAULT_SHARD.state_file_path
+    terraform_management.get_terraform_dir = lambda: os.path.join(root, 'terraform')
+    common.cfg.terraform_exec_path = _fake_terraform_command(root)
+    cert_bundles._root_ca = synthetic_state._pem('CERTIFICATE', 'root-ca', 860)  # nothing is downloaded
+
+
+def _reset_registry():
+    from aws_architecture import manage_thing, device_registry, state_index
+    state_index.invalidate()
+    device_registry._initialized.clear()
+    for file_name in os.listdir(manage_thing.DATA_DIR):
+        if file_name.startswith(device_registry.REGISTRY_FILE_NAME) or file_name.startswith('things'):
+            os.remove(os.path.join(manage_thing.DATA_DIR, file_name))
+
+
+def _install_state(state_file_path: str):
+    """ Make given synthetic state the local state of shard 0 with matching registry """
+    from wist import aws_tools
+    from aws_architecture import manage_thing
+    _reset_registry()
+    shutil.copyfile(state_file_path, aws_tools.TERRAFORM_STATE_FILE_PATH_LOCAL)
+    manage_thing.extract_things_from_state_file(aws_tools.TERRAFORM_STATE_FILE_PATH_LOCAL)
+    return aws_tools.TERRAFORM_STATE_FILE_PATH_LOCAL
+
+
+def bench_state(state_file_path: str, size: int, repeat: int) -> dict:
+    from aws_architecture import manage_thing, state_index
+    path = _install_state(state_file_path)
+    return {
+        'parse_state_file': _measure(lambda: state_index.parse_state_file(path), repeat=repeat),
+        # new process: state not indexed yet, registry has to be filled
+        'extract_things_from_state_file (cold)': _measure(lambda: manage_thing.extract_things_from_state_file(path),
+                                                          _reset_registry, repeat),
+        # same process, state not changed (wist serve)
+        'extract_things_from_state_file (warm)': _measure(lambda: manage_thing.extract_things_from_state_file(path),
+                                                          repeat=repeat),
+    }
+
+
+def bench_registry(state_file_path: str, size: int, repeat: int) -> dict:
+    from aws_architecture import manage_thing
+    _install_state(state_file_path)
+    new_device = 'benchmark-new-device'
+    return {
+        'add_device': _measure(lambda: manage_thing.add_device(new_device),
+                               lambda: manage_thing.get_device_info(new_device) and manage_thing.remove_device(new_device),
+                               repeat),
+        'remove_device': _measure(lambda: manage_thing.remove_device(new_device),
+                                  lambda: manage_thing.add_devices([new_device]), repeat),
+        'get_devices': _measure(manage_thing.get_devices, repeat=repeat),
+    }
+
+
+def bench_certs(state_file_path: str, size: int, repeat: int) -> dict:
+    from aws_architecture import manage_thing, state_index
+    path = _install_state(state_file_path)
+    certs_dir = os.path.join(manage_thing.DATA_DIR, 'iot_certs')
+
+    def remove_certs():
+        shutil.rmtree(certs_dir, ignore_errors=True)
+        state_index.invalidate()
+
+    def touch_state():  # state newer than last extraction, but with the same certificates
+        os.utime(path, (time.time() + 1, time.time() + 1))
+
+    return {
+        'extract_certs_from_state_file (all new)': _measure(
+            lambda: manage_thing.extract_certs_from_state_file(path, certs_dir), remove_certs, repeat),
+        'extract_certs_from_state_file (unchanged)': _measure(
+            lambda: manage_thing.extract_certs_from_state_file(path, certs_dir), touch_state, repeat),
+    }
+
+
+def bench_s3(state_file_path: str, size: int, repeat: int) -> dict:
+    from wist import aws_tools
+    from aws_architecture import state_index
+    import aws_architecture.tfstates_backup as tfb
+    path = _install_state(state_file_path)
+    tfb.push(path)
+    dest_dir = os.path.join(os.path.dirname(os.path.dirname(path)), 'bundle')
+    device_name = synthetic_state.device_name(size - 1)
+
+    def remove_local_state():
+        os.remove(path)
+
+    return {
+        'tfstates_backup.push': _measure(lambda: tfb.push(path), repeat=repeat),
+        'tfstates_backup.pull (download)': _measure(lambda: tfb.pull(path), remove_local_state, repeat),
+        'tfstates_backup.pull (unchanged)': _measure(lambda: tfb.pull(path), repeat=repeat),
+        # new process: backup unchanged, state not indexed yet
+        'copy_device_certs_to': _measure(lambda: aws_tools.copy_device_certs_to(device_name, dest_dir),
+                                         state_index.invalidate, repeat),
+    }
+
+
+def bench_terraform(state_file_path: str, size: int, repeat: int) -> dict:
+    from wist import aws_tools
+    from aws_architecture import manage_thing
+    _install_state(state_file_path)
+    added = []
+
+    def add_to_registry():
+        added.append(f'benchmark-apply-{len(added)}')
+        manage_thing.add_devices(added[-1:])
+        with open(aws_tools._get_full_reconcile_marker_path(aws_tools._DEFAULT_SHARD), 'w') as file:
+            file.write(str(time.time()))  # full reconcile not due, targeted apply as in add_device
+
+    def apply():
+        aws_tools.apply_changes_in_terraform(upload_backup=False,
+                                             targets=manage_thing.get_device_resource_addresses(added[-1:]))
+
+    return {'apply_changes_in_terraform (add 1 device)': _measure(apply, add_to_registry, repeat)}
+
+
+def _create_shared_iot_resources():
+    """ Thing type and policy of synthetic state, as created by the first terraform apply """
+    import boto3
+    iot = boto3.client('iot', region_name=synthetic_state.REGION)
+    iot.create_thing_type(thingTypeName=synthetic_state.THING_TYPE_NAME)
+    iot.create_policy(policyName=synthetic_state.POLICY_NAME, policyDocument=json.dumps({
+        'Version': '2012-10-17', 'Statement': [{'Effect': 'Allow', 'Action': 'iot:Connect', 'Resource': '*'}]}))
+
+
+def bench_boto3(state_file_path: str, size: int, repeat: int) -> dict:
+    """ Adding devices with boto3 engine: lock, pull, IoT API calls (moto), state update, push, unlock """
+    from wist import aws_tools
+    from aws_architecture import iot_provisioning
+    import aws_architecture.tfstates_backup as tfb
+    iot_provisioning.MAX_WORKERS = 1  # moto backends are not thread safe, and mocked calls have no latency to hide
+    added = []
+
+    def install_state():
+        _install_state(state_file_path)
+        tfb.push(aws_tools.TERRAFORM_STATE_FILE_PATH_LOCAL)
+
+    def add(count: int):
+        new_devices = [f'benchmark-boto3-{len(added) + i}' for i in range(count)]
+        added.extend(new_devices)
+        aws_tools.add_new_devices_to_aws(new_devices, engine='boto3')
+
+    return {
+        'add_new_devices_to_aws boto3 (add 1 device)': _measure(lambda: add(1), install_state, repeat),
+        'add_new_devices_to_aws boto3 (add 10 devices)': _measure(lambda: add(10), install_state, repeat),
+    }
+
+
+def bench_rebalance(state_file_path: str, size: int, repeat: int) -> dict:
+    from wist import aws_tools, shards
+    import aws_architecture.tfstates_backup as tfb
+
+    def single_shard():
+        _install_state(state_file_path)
+        for shard in (shards.Shard(0), shards.Shard(1)):
+            shutil.rmtree(shard.certs_dir, ignore_errors=True)
+        shard_1_state = shards.Shard(1).state_file_path
+        if os.path.isfile(shard_1_state):
+            os.remove(shard_1_state)
+        tfb.get_s3_client().delete_object(Bucket=tfb.BUCKET, Key=tfb._get_s3_name_and_s3_lock_name(shard_1_state)[0])
+        with open(shards.SHARDS_CONFIG_FILE_PATH, 'w') as file:
+            json.dump(shards.ShardsConfig().to_dict(), file)
+        tfb.push(shards.SHARDS_CONFIG_FILE_PATH)
+        tfb.push(aws_tools.TERRAFORM_STATE_FILE_PATH_LOCAL)
+        shards.Shard(1).prepare()
+
+    moving = [synthetic_state.device_name(i) for i in range(size)
+              if shards.ShardsConfig(2).shard_index_for(synthetic_state.device_name(i)) == 1]
+
+    def move():  # what rebalance does with states, without locks, S3 and apply
+        aws_tools._move_devices_between_shards(shards.Shard(0), shards.Shard(1), moving)
+
+    return {
+        # about half of the devices move to the new shard
+        'move_devices_between_shards (1 -> 2 shards)': _measure(move, single_shard, repeat),
+        'rebalance_shards (1 -> 2 shards)': _measure(lambda: aws_tools.rebalance_shards(2), single_shard, repeat),
+    }
+
+
+_BENCHMARKS = {'state': bench_state, 'registry': bench_registry, 'certs': bench_certs, 's3': bench_s3,
+               'terraform': bench_terraform, 'boto3': bench_boto3, 'rebalance': bench_rebalance}
+
+
+def run(sizes, groups, repeat: int, root: str) -> list:
+    setup_sandbox(root)
+    mock = None
+    if not _MOCKS_IOT and any(group in _IOT_GROUPS for group in groups):
+        logging.warning('moto >= 5 is not installed, skipping boto3 engine benchmarks: '
+                        'pip install -r benchmarks/requirements.txt')
+        groups = [group for group in groups if group not in _IOT_GROUPS]
+    if any(group in _MOTO_GROUPS for group in groups):
+        if mock_aws is None:
+            logging.warning('moto is not installed, skipping S3, boto3 engine and rebalance benchmarks: '
+                            'pip install -r benchmarks/requirements.txt')
+            groups = [group for group in groups if group not in _MOTO_GROUPS]
+        else:
+            import boto3
+            import aws_architecture.tfstates_backup as tfb
+            mock = mock_aws()
+            mock.start()
+            boto3.client('s3').create_bucket(Bucket=tfb.BUCKET, CreateBucketConfiguration={
+                'LocationConstraint': synthetic_state.REGION})
+            if 'boto3' in groups:
+                _create_shared_iot_resources()
+
+    results = []
+    try:
+        for size in sizes:
+            start = time.perf_counter()
+            state_file_path = synthetic_state.write_state(os.path.join(root, f'fleet_{size}.tfstate'),
+                                                          map(synthetic_state.device_name, range(size)))
+            print(f'--- {size} devices (state {os.path.getsize(state_file_path) / 2 ** 20:.1f} MB, '
+                  f'generated in {time.perf_counter() - start:.1f}s)')
+            for group in groups:
+                for name, durations in _BENCHMARKS[group](state_file_path, size, repeat).items():
+                    result = {'benchmark': name, 'group': group, 'size': size,
+                              'median_s': statistics.median(durations), 'min_s': min(durations), 'runs': durations}
+                    results.append(result)
+                    print(f"{name:45} {result['median_s'] * 1000:10.1f} ms  (min {result['min_s'] * 1000:.1f})")
+    finally:
+        if mock is not None:
+            mock.stop()
+    return results
+
+
+def _read_last_run(history_path: str):
+    try:
+        with open(history_path, 'r') as file:
+            lines = [line for line in file.read().splitlines() if line.strip()]
+    except FileNotFoundError:
+        return None
+    return json.loads(lines[-1]) if lines else None
+
+
+def compare(results: list, previous: dict, max_slowdown: float) -> list:
+    """ Benchmarks slower than max_slowdown times the previous run, as printable lines """
+    previous_medians = {(result['benchmark'], result['size']): result['median_s'] for result in previous['results']}
+    regressions = []
+    for result in results:
+        before = previous_medians.get((result['benchmark'], result['size']))
+        # tiny durations are mostly noise
+        if before and result['median_s'] > before * max_slowdown and result['median_s'] - before > 0.005:
+            regressions.append(f"{result['benchmark']} ({result['size']} devices): "
+                               f"{before * 1000:.1f} ms -> {result['median_s'] * 1000:.1f} ms")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    root = tempfile.mkdtemp(prefix='wist_benchmark_')
+    try:
+        results = run(args.sizes, args.only, args.repeat, root)
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    failed = False
+    if args.compare:
+        previous = _read_last_run(args.history)
+        if previous is None:
+            print(f'No saved run in {args.history} to compare with')
+        else:
+            regressions = compare(results, previous, args.max_slowdown)
+            print(f"Compared with run of {previous['time']}: "
+                  f"{len(regressions) or 'no'} regressions (slower than {args.max_slowdown}x)")
+            for line in regressions:
+                print(f'    {line}')
+            failed = bool(regressions)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, 'a') as file:
+            file.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                                   'platform': platform.platform(), 'repeat': args.repeat,
+                                   'results': results}) + '\n')
+        print(f'Results saved to {args.history}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
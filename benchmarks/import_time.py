@@ -0,0 +1,110 @@
+""" Import time of wist CLI start paths, measured with python -X importtime in fresh interpreters.
+
+Fails (exit code 1) when a path imports modules it must not need (boto3, requests, cryptography...), or when its
+median import time is over budget. Run from anywhere:
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --runs 10 --budget_scale 2 --json import_time.json
+"""
+import subprocess
+import statistics
+import argparse
+import json
+import sys
+import os
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WIST_DIR = os.path.join(REPO_DIR, 'wist_config_tool')
+
+_HEAVY_MODULES = ('boto3', 'botocore.client', 'requests', 'cryptography', 's3transfer')
+
+# name -> (modules imported, modules which must not be imported, budget in ms)
+SCENARIOS = {
+    # everything loaded before a command is dispatched: --version, --help, setup_aws, --server client
+    'startup': (['wist.__main__'], _HEAVY_MODULES + ('botocore', 'aws_architecture.tfstates_backup', 'wist.aws_tools'),
+                60),
+    # list_devices --cached, get_all_available_aws_devices, server: S3 client and downloads are not created yet
+    'aws_tools': (['wist.__main__', 'wist.aws_tools'], _HEAVY_MODULES, 150),
+    'server': (['wist.__main__', 'wist.server'], _HEAVY_MODULES + ('wist.aws_tools',), 80),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per scenario, median is reported")
+    parser.add_argument('--budget_scale', type=float, default=1.0,
+                        help="Multiply all budgets, e.g. 3 on slow machines (or CI) - forbidden imports still fail")
+    parser.add_argument('--json', metavar='PATH', help="Also write results as JSON")
+    parser.add_argument('--top', type=int, default=5, help="Show this many slowest top level imports")
+    return parser.parse_args()
+
+
+def _run_importtime(modules: list) -> dict:
+    """ Module name -> (self us, cumulative us, nesting) as reported by -X importtime for a fresh interpreter """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, WIST_DIR,
+                                                                      os.environ.get('PYTHONPATH')])))
+    code = '; '.join(f'import {module}' for module in modules) or 'pass'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, cwd=WIST_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise Exception(f'Importing {modules} failed:\n{result.stderr}')
+
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us), len(name) - len(name.lstrip()))
+    return timings
+
+
+def measure(name: str, runs: int) -> dict:
+    modules, forbidden, budget_ms = SCENARIOS[name]
+    interpreter_modules = set(_run_importtime([]))  # site, encodings, .pth files of installed packages
+    totals, timings = [], {}
+    for _ in range(runs):
+        timings = {module: timing for module, timing in _run_importtime(modules).items()
+                   if module not in interpreter_modules}
+        # only imports done by the scenario itself, interpreter start up (site, encodings) is not counted
+        totals.append(sum(timings[module][1] for module in modules if module in timings) / 1000)
+    top_level = sorted(((cumulative, module) for module, (_, cumulative, depth) in timings.items()
+                        if depth <= 3 and module not in modules), reverse=True)
+    return {
+        'scenario': name,
+        'median_ms': round(statistics.median(totals), 1),
+        'min_ms': round(min(totals), 1),
+        'budget_ms': budget_ms,
+        'modules_imported': len(timings),
+        'forbidden_imported': sorted(package for package in forbidden if package in timings
+                                     or any(module.startswith(package + '.') for module in timings)),
+        'slowest': [(module, round(cumulative / 1000, 1)) for cumulative, module in top_level],
+    }
+
+
+def main():
+    args = parse_args()
+    results, failed = [], False
+    for name in SCENARIOS:
+        result = measure(name, args.runs)
+        budget_ms = result['budget_ms'] * args.budget_scale
+        over_budget = result['median_ms'] > budget_ms
+        status = 'FAIL' if over_budget or result['forbidden_imported'] else 'ok'
+        failed = failed or status == 'FAIL'
+        results.append(dict(result, status=status))
+
+        print(f"{name:10} {status:4} median {result['median_ms']:7.1f} ms (min {result['min_ms']:.1f}, "
+              f"budget {budget_ms:.0f}), {result['modules_imported']} modules")
+        for module, cumulative_ms in result['slowest'][:args.top]:
+            print(f"{'':16}{cumulative_ms:7.1f} ms  {module}")
+        if result['forbidden_imported']:
+            print(f"{'':16}must not import: {', '.join(result['forbidden_imported'])}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'python': sys.version.split()[0], 'results': results}, file, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+""" Terraform states of synthetic fleets, with the same structure and about the same size as real ones """
+import hashlib
+import base64
+import json
+import uuid
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aws_architecture import iot_provisioning
+
+
+REGION = 'eu-west-2'
+ACCOUNT_ID = '123456789012'
+THING_TYPE_NAME = 'wist_sensor'
+POLICY_NAME = 'wist_connect_and_publish'
+_PROVIDER = 'provider.aws'
+
+
+def device_name(index: int) -> str:
+    return f'sensor-{index:06d}'
+
+
+def _pem(label: str, seed: str, size: int) -> str:
+    """ PEM block of given body size, content derived from seed so states are reproducible """
+    body, counter = b'', 0
+    while len(body) < size:
+        body += hashlib.sha256(f'{seed}:{counter}'.encode('utf-8')).digest()
+        counter += 1
+    encoded = base64.b64encode(body[:size]).decode('ascii')
+    lines = [encoded[i:i + 64] for i in range(0, len(encoded), 64)]
+    return '\n'.join([f'-----BEGIN {label}-----'] + lines + [f'-----END {label}-----']) + '\n'
+
+
+def device_resources(name: str) -> dict:
+    certificate_id = hashlib.sha256(name.encode('utf-8')).hexdigest()
+    return iot_provisioning.device_resources(
+        name, f'arn:aws:iot:{REGION}:{ACCOUNT_ID}:thing/{name}', THING_TYPE_NAME, POLICY_NAME,
+        f'arn:aws:iot:{REGION}:{ACCOUNT_ID}:cert/{certificate_id}', _pem('CERTIFICATE', name, 860),
+        _pem('PUBLIC KEY', name + 'pub', 294), _pem('RSA PRIVATE KEY', name + 'key', 1190))
+
+
+def _shared_resource(resource_type: str, name: str, attributes: dict) -> dict:
+    return {'module': iot_provisioning.MODULE_ADDRESS, 'mode': 'managed', 'type': resource_type, 'name': name,
+            'provider': _PROVIDER, 'instances': [{'schema_version': 0, 'attributes': attributes}]}
+
+
+def empty_state() -> dict:
+    """ State after the first apply with no devices: endpoint, thing type and policy only """
+    return {
+        'version': 4, 'terraform_version': '0.12.24', 'serial': 1, 'lineage': str(uuid.uuid4()), 'outputs': {},
+        'resources': [
+            {'mode': 'data', 'type': 'aws_iot_endpoint', 'name': 'iot_endpoint', 'provider': _PROVIDER,
+             'instances': [{'schema_version': 0, 'attributes': {
+                 'endpoint_address': f'a1b2c3d4e5f6g7-ats.iot.{REGION}.amazonaws.com', 'endpoint_type': 'iot:Data-ATS',
+                 'id': '2020-01-01 00:00:00 +0000 UTC'}}]},
+            _shared_resource('aws_iot_thing_type', 'iot_thing_type', {
+                'id': THING_TYPE_NAME, 'name': THING_TYPE_NAME, 'deprecated': False, 'properties': [],
+                'arn': f'arn:aws:iot:{REGION}:{ACCOUNT_ID}:thingtype/{THING_TYPE_NAME}'}),
+            _shared_resource('aws_iot_policy', 'iot_connect_and_publish_to_topic', {
+                'id': POLICY_NAME, 'name': POLICY_NAME, 'default_version_id': '1', 'policy': '{}',
+                'arn': f'arn:aws:iot:{REGION}:{ACCOUNT_ID}:policy/{POLICY_NAME}'}),
+        ],
+    }
+
+
+def write_state(state_file_path: str, device_names) -> str:
+    """ Write state holding all resources of given devices """
+    with open(state_file_path, 'w') as file:
+        json.dump(empty_state(), file)
+    add_devices(state_file_path, device_names)
+    return state_file_path
+
+
+def add_devices(state_file_path: str, device_names):
+    device_names = list(device_names)
+    if device_names:
+        iot_provisioning.write_devices_to_state(state_file_path, {name: device_resources(name) for name in device_names})
+
+
+def remove_devices(state_file_path: str, device_names):
+    device_names = set(device_names)
+    with open(state_file_path, 'r') as file:
+        state = json.load(file)
+    for resource in state['resources']:
+        if resource.get('module') == iot_provisioning.MODULE_ADDRESS and 'each' in resource:
+            resource['instances'] = [instance for instance in resource['instances']
+                                     if instance.get('index_key') not in device_names]
+    state['serial'] += 1
+    with open(state_file_path, 'w') as file:
+        json.dump(state, file, indent=2)
@@ -10,6 +10,9 @@ if _running_from_source():
 
 
 if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()  # device keys are generated in worker processes, also in frozen executable
+
     from wist.__main__ import main
     main()
     
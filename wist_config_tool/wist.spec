@@ -5,11 +5,23 @@ block_cipher = None
 spec_root = os.path.abspath(SPECPATH)
 
 
+def aws_architecture_datas():
+    """ aws_architecture files, without device private keys and key pool which older wist kept in its data dir """
+    root = os.path.join(spec_root, '..', 'aws_architecture')
+    excluded = {os.path.join(root, 'data', 'device_keys'), os.path.join(root, 'data', 'key_pool')}
+    datas = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = [name for name in dir_names if os.path.join(dir_path, name) not in excluded]
+        dest_dir = os.path.normpath(os.path.join('aws_architecture', os.path.relpath(dir_path, root)))
+        datas.extend((os.path.join(dir_path, file_name), dest_dir) for file_name in file_names)
+    return datas
+
+
 
 a = Analysis(['run_wist.py'],
              pathex=[spec_root, 'spec_root/../'],
              binaries=[],
-             datas=[('../aws_architecture', 'aws_architecture')],
+             datas=aws_architecture_datas(),
              hiddenimports=['configparser'],
              hookspath=[],
              runtime_hooks=[],
@@ -1,5 +1,6 @@
 import os
 import sys
+import csv
 import enum
 import json
 import time
@@ -10,7 +11,9 @@ import argparse
 from wist import _version
 from wist.common import setup_config, setup_logger
 from wist.aws_credentials import save_aws_config, aws_credentials_available, read_aws_credentials
-from wist.aws_tools import init_aws_client
+from aws_architecture import instrumentation
+# everything else (boto3, requests, Terraform handling) is imported by the commands which need it, AWS clients are
+# created on first use - keeps start of the (frozen) executable fast
 
 _PROGRAM_NAME = "wist"
 
@@ -24,6 +27,15 @@ class RecognizedCommands(enum.Enum):
     ADD_DEVICE = enum.auto()
     REMOVE_DEVICE = enum.auto()
     GET_CERT = enum.auto()
+    ADD_DEVICES = enum.auto()
+    REMOVE_DEVICES = enum.auto()
+    SERVE = enum.auto()
+    UPGRADE_TERRAFORM = enum.auto()
+    RECONCILE = enum.auto()
+    REBALANCE = enum.auto()
+    BULK_REGISTER = enum.auto()
+    WARM_KEY_POOL = enum.auto()
+    GET_CERTS = enum.auto()
 
 
 _commands_help = {RecognizedCommands.SETUP_AWS: "Setup your AWS credentials",
@@ -31,14 +43,32 @@ _commands_help = {RecognizedCommands.SETUP_AWS: "Setup your AWS credentials",
                   RecognizedCommands.ADD_DEVICE: "Add new device to your AWS IoT service. All required certificates for that device will be created, and permissions granted",
                   RecognizedCommands.REMOVE_DEVICE: "Remove specified device from your AWS IoT service",
                   RecognizedCommands.GET_CERT: "Get certificate and keys for a specified device id, and copy them to output directory",
+                  RecognizedCommands.ADD_DEVICES: "Add many devices to your AWS IoT service in a single Terraform apply",
+                  RecognizedCommands.REMOVE_DEVICES: "Remove many devices from your AWS IoT service in a single Terraform apply",
+                  RecognizedCommands.UPGRADE_TERRAFORM: "Download latest (or given) Terraform version and pin it for all further commands",
+                  RecognizedCommands.RECONCILE: "Check all devices against AWS and fix any drift (full Terraform apply)",
+                  RecognizedCommands.REBALANCE: "Change number of Terraform state shards the fleet is split into, and move devices accordingly",
+                  RecognizedCommands.BULK_REGISTER: "Register a large batch of devices (e.g. a manufacturing run) with AWS IoT bulk registration, without Terraform apply",
+                  RecognizedCommands.WARM_KEY_POOL: "Generate device keys ahead of time for adding devices with WIST_CERT_MODE=csr",
+                  RecognizedCommands.GET_CERTS: "Write certificate, key and root CA bundles of many devices (or the whole fleet), optionally as tar/zip archives",
+                  RecognizedCommands.SERVE: "Run wist server, which keeps everything warm and runs commands sent with --server",
                   }
 
 
-_commands_with_no_additional_parameters = {RecognizedCommands.LIST_DEVICES, RecognizedCommands.SETUP_AWS}   # set!
+_commands_with_no_additional_parameters = {RecognizedCommands.SETUP_AWS, RecognizedCommands.RECONCILE}   # set!
 _commands_with_additional_parameters = set(RecognizedCommands).difference(_commands_with_no_additional_parameters)
 
 _commands_with_device_name_arg = {RecognizedCommands.ADD_DEVICE, RecognizedCommands.REMOVE_DEVICE, RecognizedCommands.GET_CERT}
 
+_commands_with_many_device_names_arg = {RecognizedCommands.ADD_DEVICES, RecognizedCommands.REMOVE_DEVICES,
+                                        RecognizedCommands.BULK_REGISTER, RecognizedCommands.GET_CERTS}
+
+_LIST_FORMATS = ('text', 'json', 'jsonl', 'csv')
+_LIST_FIELDS = ('name', 'group', 'created', 'cert_id', 'shard')
+
+_commands_run_by_server = {RecognizedCommands.LIST_DEVICES, RecognizedCommands.ADD_DEVICE, RecognizedCommands.REMOVE_DEVICE,
+                           RecognizedCommands.GET_CERT, RecognizedCommands.ADD_DEVICES, RecognizedCommands.REMOVE_DEVICES}
+
 
 
 
@@ -46,6 +76,8 @@ def parse_command_line_arguments():
     parser = argparse.ArgumentParser(_PROGRAM_NAME)
 
     parser.add_argument('-V', '--version', action='version', version='WIST version {}'.format(_version.__version__))
+    parser.add_argument('--server', default=os.environ.get('WIST_SERVER'), metavar='HOST:PORT',
+                        help="Send command to running 'wist serve' instead of running it here (env: WIST_SERVER)")
 
     commands_parser = parser.add_subparsers(title='COMMANDS', metavar='COMMAND [ARGS]', dest='subcommand')
 
@@ -53,9 +85,59 @@ def parse_command_line_arguments():
         subparser = commands_parser.add_parser(command_name.lower(), help=_commands_help[command])
         if command in _commands_with_device_name_arg:
             subparser.add_argument("--dev_name", nargs=1, help="Device name", type=str, required=True)
+        if command in _commands_with_many_device_names_arg:
+            subparser.add_argument("--dev_name", action='append', default=[], type=str,
+                                   help="Device name. May be given many times")
+            subparser.add_argument("--dev_file", type=str,
+                                   help="File with device names, one per line. Use '-' to read from stdin")
         if command == RecognizedCommands.GET_CERT:
             subparser.add_argument("--dest_dir", nargs=1, help="Destination directory for certificate and key files.",
                                    type=str, required=True)
+        if command in (RecognizedCommands.ADD_DEVICE, RecognizedCommands.ADD_DEVICES, RecognizedCommands.BULK_REGISTER):
+            subparser.add_argument("--group", type=str,
+                                   help="Group of new devices. Devices of one group are kept in the same state shard")
+        if command == RecognizedCommands.BULK_REGISTER:
+            subparser.add_argument("--role_arn", type=str,
+                                   help="IAM role used by AWS IoT to read registration manifest from S3 "
+                                        "(env: WIST_BULK_REGISTRATION_ROLE_ARN)")
+        if command in (RecognizedCommands.ADD_DEVICE, RecognizedCommands.ADD_DEVICES):
+            subparser.add_argument("--engine", choices=('terraform', 'boto3'), default=None,
+                                   help="How devices are created: terraform apply, or direct IoT API calls recorded "
+                                        "in Terraform state (env: WIST_PROVISIONING_ENGINE, default: terraform)")
+        if command == RecognizedCommands.LIST_DEVICES:
+            subparser.add_argument("--prefix", type=str, help="Only devices with names starting with this prefix")
+            subparser.add_argument("--pattern", type=str, help="Only devices with names matching this glob, e.g. 'lot42-*'")
+            subparser.add_argument("--offset", type=int, default=0, help="Skip this many devices (sorted by name)")
+            subparser.add_argument("--limit", type=int, default=None, help="List at most this many devices")
+            subparser.add_argument("--format", choices=_LIST_FORMATS, default='text', dest='output_format',
+                                   help="Output format. json, jsonl and csv also have group, creation time, "
+                                        "certificate id and shard of every device")
+            subparser.add_argument("--cached", action='store_true',
+                                   help="Answer from local devices registry as synced by the last command, "
+                                        "without downloading state from S3")
+        if command == RecognizedCommands.REBALANCE:
+            subparser.add_argument("--shards", type=int, required=True, help="New number of shards")
+        if command == RecognizedCommands.GET_CERTS:
+            subparser.add_argument("--all", action='store_true', help="Bundles of all devices in the fleet")
+            subparser.add_argument("--dest_dir", type=str, required=True,
+                                   help="Destination directory, every device gets its own subdirectory or archive")
+            subparser.add_argument("--archive", choices=('tar', 'zip'), default=None,
+                                   help="Write bundles as archives (.tar.gz or .zip) instead of directories")
+            subparser.add_argument("--archive_per", choices=('device', 'batch'), default='device',
+                                   help="One archive per device (default) or one archive with all devices")
+        if command == RecognizedCommands.WARM_KEY_POOL:
+            subparser.add_argument("--size", type=int, default=None,
+                                   help="Number of keys to keep in the pool (env: WIST_KEY_POOL_SIZE, default: 100)")
+        if command == RecognizedCommands.UPGRADE_TERRAFORM:
+            subparser.add_argument("--tf_version", type=str, help="Terraform version to install, latest if not given")
+        if command == RecognizedCommands.SERVE:
+            subparser.add_argument("--address", default='127.0.0.1:8765', metavar='HOST:PORT',
+                                   help="Address to listen on (default: 127.0.0.1:8765)")
+            subparser.add_argument("--apply_window", default=5, type=float,
+                                   help="Seconds to collect add/remove requests into a single Terraform apply")
+            subparser.add_argument("--certs_root", default=None, type=str,
+                                   help="get_cert requests may copy certificates only into this directory "
+                                        "(env: WIST_SERVER_CERTS_ROOT, default: current directory)")
 
     parsed_args = parser.parse_args()
     if parsed_args.subcommand is None:
@@ -65,6 +147,95 @@ def parse_command_line_arguments():
     return parsed_args
 
 
+def read_device_names(args) -> list:
+    """ Collect device names from repeated --dev_name flags and from --dev_file (or stdin), keeping order """
+    device_names = list(args.dev_name)
+
+    if args.dev_file:
+        if args.dev_file == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.dev_file, 'r') as file:
+                lines = file.read().splitlines()
+        device_names.extend(line.strip() for line in lines if line.strip() and not line.strip().startswith('#'))
+
+    return list(dict.fromkeys(device_names))  # drop duplicates
+
+
+def run_on_server(args):
+    """ Thin client: send command to wist server and print its result """
+    from wist import server
+
+    if args.subcommand in (RecognizedCommands.ADD_DEVICE.name.lower(), RecognizedCommands.ADD_DEVICES.name.lower()):
+        command = server.ADD_DEVICES
+    elif args.subcommand in (RecognizedCommands.REMOVE_DEVICE.name.lower(), RecognizedCommands.REMOVE_DEVICES.name.lower()):
+        command = server.REMOVE_DEVICES
+    else:
+        command = args.subcommand
+
+    if command == server.LIST_DEVICES:
+        params = _list_devices_params(args)
+    elif command in (server.ADD_DEVICES, server.REMOVE_DEVICES):
+        params = {'dev_names': read_device_names(args) if hasattr(args, 'dev_file') else args.dev_name}
+        if getattr(args, 'group', None):
+            params['group'] = args.group
+        if getattr(args, 'engine', None):
+            params['engine'] = args.engine
+    elif command == server.GET_CERT:
+        params = {'dev_name': args.dev_name[0], 'dest_dir': os.path.abspath(args.dest_dir[0])}
+    else:
+        params = {}
+
+    logging.info(f'Sending {command} to wist server at {args.server}')
+    result = server.send_job(args.server, command, params)
+
+    if command == server.LIST_DEVICES:
+        print_devices(result['devices'], args.output_format, args.offset)
+    elif command == server.GET_CERT:
+        logging.info(f"Certificates copied to {result['dest_dir']}")
+    else:
+        logging.info(f"Added: {result['added']}, removed: {result['removed']}")
+
+
+def _list_devices_params(args) -> dict:
+    return {'prefix': args.prefix, 'pattern': args.pattern, 'offset': args.offset, 'limit': args.limit,
+            'cached': args.cached}
+
+
+def print_devices(devices, output_format='text', offset=0):
+    """ Write devices to stdout one by one as they come, without building the whole output first """
+    out = sys.stdout
+    try:
+        if output_format == 'csv':
+            writer = csv.DictWriter(out, fieldnames=_LIST_FIELDS, extrasaction='ignore', lineterminator='\n')
+            writer.writeheader()
+        elif output_format == 'json':
+            out.write('[')
+        for lp, device in enumerate(devices, offset):
+            if device.get('created') is not None:
+                device = dict(device, created=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(device['created'])))
+            if output_format == 'text':
+                out.write(f"{lp}: {device['name']}\n")
+            elif output_format == 'csv':
+                writer.writerow(device)
+            elif output_format == 'jsonl':
+                out.write(json.dumps(device) + '\n')
+            else:
+                out.write((',\n ' if lp > offset else '\n ') + json.dumps(device))
+        if output_format == 'json':
+            out.write('\n]\n')
+        out.flush()  # program ends with os._exit, which does not flush
+    except BrokenPipeError:  # e.g. piped to head
+        sys.stderr.close()
+        _exit(0)
+
+
+def _exit(code: int, error: Exception = None):
+    """ os._exit skips finally blocks, so spans of the command are ended and exported first """
+    instrumentation.end_all(error or (f'exit code {code}' if code else None), exit_code=code)
+    os._exit(code)
+
+
 def get_aws_config():
     print('Setting up AWS configuration')
 
@@ -84,30 +255,46 @@ def main():
     setup_config()
     setup_logger()
 
-    init_aws_client()
-
     try:
 
         args = parse_command_line_arguments()
+        instrumentation.start_span(f'wist.{args.subcommand}', server=bool(args.server))
+
+        if args.server and RecognizedCommands[args.subcommand.upper()] in _commands_run_by_server:
+            run_on_server(args)
+            logging.info('Program finished')
+            _exit(0)
 
         if args.subcommand == RecognizedCommands.SETUP_AWS.name.lower():
             logging.info('Setup AWS')
             get_aws_config()
 
+        elif args.subcommand == RecognizedCommands.WARM_KEY_POOL.name.lower():
+            from wist.aws_tools import warm_key_pool
+
+            warm_key_pool(args.size)
+            logging.info('Program finished')
+            _exit(0)
+
+        elif args.subcommand == RecognizedCommands.UPGRADE_TERRAFORM.name.lower():
+            from wist.terraform_management import upgrade_terraform
+
+            upgrade_terraform(args.tf_version)
+            logging.info('Program finished')
+            _exit(0)
+
         elif not aws_credentials_available():
             # check if credntials exists if not - exit with info!
             logging.info("AWS credentials not set up! Please run 'wist setup_aws' first.")
-            os._exit(1)
+            _exit(1)
 
         read_aws_credentials()
 
         if args.subcommand == RecognizedCommands.LIST_DEVICES.name.lower():
             logging.info('List devices')
-            from wist.aws_tools import get_all_available_aws_devices
+            from wist.aws_tools import iter_aws_devices
 
-            devices_list = get_all_available_aws_devices()
-            for lp, device in enumerate(devices_list):
-                print(f'{lp}: {device}')
+            print_devices(iter_aws_devices(**_list_devices_params(args)), args.output_format, args.offset)
 
         elif args.subcommand == RecognizedCommands.ADD_DEVICE.name.lower():
             device_name = args.dev_name[0]
@@ -115,7 +302,7 @@ def main():
 
             from wist.aws_tools import add_new_device_to_aws
 
-            add_new_device_to_aws(device_name)
+            add_new_device_to_aws(device_name, group=args.group, engine=args.engine)
 
         elif args.subcommand == RecognizedCommands.REMOVE_DEVICE.name.lower():
             device_name = args.dev_name[0]
@@ -125,6 +312,28 @@ def main():
 
             delete_device_from_aws(device_name)
 
+        elif args.subcommand == RecognizedCommands.ADD_DEVICES.name.lower():
+            device_names = read_device_names(args)
+            if not device_names:
+                logging.error('No device names given! Use --dev_name or --dev_file.')
+                _exit(2)
+            logging.info(f'Adding {len(device_names)} devices')
+
+            from wist.aws_tools import add_new_devices_to_aws
+
+            add_new_devices_to_aws(device_names, group=args.group, engine=args.engine)
+
+        elif args.subcommand == RecognizedCommands.REMOVE_DEVICES.name.lower():
+            device_names = read_device_names(args)
+            if not device_names:
+                logging.error('No device names given! Use --dev_name or --dev_file.')
+                _exit(2)
+            logging.info(f'Removing {len(device_names)} devices')
+
+            from wist.aws_tools import delete_devices_from_aws
+
+            delete_devices_from_aws(device_names)
+
         elif args.subcommand == RecognizedCommands.GET_CERT.name.lower():
             logging.info("Copying certificates")
             device_name = args.dev_name[0]
@@ -134,6 +343,45 @@ def main():
 
             copy_device_certs_to(device_name, dest_dir)
 
+        elif args.subcommand == RecognizedCommands.GET_CERTS.name.lower():
+            device_names = None if args.all else read_device_names(args)
+            if device_names is not None and not device_names:
+                logging.error('No device names given! Use --dev_name, --dev_file or --all.')
+                _exit(2)
+            logging.info(f"Copying certificates of {'all' if args.all else len(device_names)} devices")
+
+            from wist.aws_tools import copy_devices_certs_to
+
+            copy_devices_certs_to(device_names, args.dest_dir, args.archive, args.archive_per)
+
+        elif args.subcommand == RecognizedCommands.RECONCILE.name.lower():
+            logging.info('Reconciling all devices')
+            from wist.aws_tools import reconcile_devices_in_aws
+
+            reconcile_devices_in_aws()
+
+        elif args.subcommand == RecognizedCommands.REBALANCE.name.lower():
+            logging.info(f'Rebalancing fleet to {args.shards} shards')
+            from wist.aws_tools import rebalance_shards
+
+            rebalance_shards(args.shards)
+
+        elif args.subcommand == RecognizedCommands.BULK_REGISTER.name.lower():
+            device_names = read_device_names(args)
+            if not device_names:
+                logging.error('No device names given! Use --dev_name or --dev_file.')
+                _exit(2)
+            logging.info(f'Bulk registering {len(device_names)} devices')
+
+            from wist.aws_tools import bulk_register_devices
+
+            bulk_register_devices(device_names, group=args.group, role_arn=args.role_arn)
+
+        elif args.subcommand == RecognizedCommands.SERVE.name.lower():
+            from wist.server import serve
+
+            serve(args.address, args.apply_window, args.certs_root)
+
         '''
         Another command can be added here to configure your IoT device using this tool (along with generating certificates etc)
         The implementation will depend on the manner in which the credentials should be downloaded to the device
@@ -141,12 +389,12 @@ def main():
         '''
 
         logging.info('Program finished')
-        os._exit(0)
+        _exit(0)
 
     except Exception as e:
         msg = f'Error! during program start: "{e}"'
         logging.exception(msg)
-        os._exit(1)
+        _exit(1, e)
 
 
 if __name__ == '__main__':
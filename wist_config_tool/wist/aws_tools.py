@@ -1,33 +1,55 @@
 import os
-import sys
+import json
+import time
 import shutil
 import logging
-import subprocess
-import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import botocore.exceptions
 
-from wist.common import _running_from_source
 import wist.common as common
-from wist.terraform_management import check_tf_latest_version
-from wist.terraform_management import get_terraform
+from wist import shards
+from wist import terraform_runner
+from wist.shards import Shard
 
 from aws_architecture import manage_thing
+from aws_architecture import state_index
+from aws_architecture import instrumentation
 import aws_architecture.tfstates_backup as tfb
 
+# modules which pull in boto3, requests or cryptography are imported by functions that need them, so commands
+# which do not use them start fast
+
+
+_TERRAFORM_STATE_LOCAL_DIR = shards.TERRAFORM_ENVIRONMENT_DIR
+AWS_CERTS_DIRECTORY = os.path.join(manage_thing.DATA_DIR, 'iot_certs')
 
-AWS_ROOT_CA_CERTIFICATE_URL = "https://www.amazontrust.com/repository/AmazonRootCA1.pem"
+_DEFAULT_SHARD = Shard(0)
+TERRAFORM_STATE_FILE_PATH_LOCAL = _DEFAULT_SHARD.state_file_path
 
-_TERRAFORM_STATE_FILE_NAME = 'terraform.tfstate'
-_this_file_path = os.path.dirname(os.path.abspath(__file__))
+FULL_RECONCILE_INTERVAL = int(os.environ.get('WIST_FULL_RECONCILE_INTERVAL', 24 * 60 * 60))  # seconds
+_MAX_TARGETS = 400  # above that full plan is cheaper, and command line could get too long (Windows)
+_MAX_PARALLEL_SHARDS = 8
 
-if _running_from_source():
-    _TERRAFORM_STATE_LOCAL_DIR = os.path.join(_this_file_path, '..', '..', 'aws_architecture', 'environments', 'things_management')
-    AWS_CERTS_DIRECTORY = os.path.join(_this_file_path, '..', '..', 'aws_architecture', 'data', 'iot_certs')
+# 'terraform' - every change is a terraform plan and apply
+# 'boto3' - new devices are created with direct IoT API calls and written to state, removals still go through terraform
+PROVISIONING_ENGINES = ('terraform', 'boto3')
+PROVISIONING_ENGINE = os.environ.get('WIST_PROVISIONING_ENGINE', 'terraform')
 
-else:
-    _TERRAFORM_STATE_LOCAL_DIR = os.path.join(sys._MEIPASS, 'aws_architecture', 'environments', 'things_management')
-    AWS_CERTS_DIRECTORY = os.path.join(sys._MEIPASS, 'aws_architecture', 'data', 'iot_certs')
+# 'aws' - AWS generates device keys, private keys are kept in Terraform state
+# 'csr' - keys are generated locally (from pre-warmed key pool), only CSRs are sent and state has no private keys
+CERT_MODES = ('aws', 'csr')
+CERT_MODE = os.environ.get('WIST_CERT_MODE', 'aws')
 
-TERRAFORM_STATE_FILE_PATH_LOCAL = os.path.join(_TERRAFORM_STATE_LOCAL_DIR, _TERRAFORM_STATE_FILE_NAME)
+LOCK_WAIT = int(os.environ.get('WIST_LOCK_WAIT', 10 * 60))  # seconds to queue for state lock held by another operator
+
+TERRAFORM_TIMEOUT = int(os.environ.get('WIST_TERRAFORM_TIMEOUT', 0))  # seconds for one terraform command, 0 - no limit
+THROTTLING_RETRIES = int(os.environ.get('WIST_THROTTLING_RETRIES', 3))  # plan and apply again when AWS throttled them
+_THROTTLING_BACKOFF_BASE = 15  # seconds, doubled with every retry
+
+_terraform_setup_lock = threading.Lock()  # shards run in parallel threads, but share terraform binary and working dir
+_terraform_cancel = threading.Event()  # set to interrupt running terraform commands and not start new ones
 
 
 class WrongAwsKeysError(Exception):
@@ -44,206 +66,725 @@ def init_aws_client():
     tfb.init_aws_client()
 
 
-def get_all_available_aws_devices(download_backup=True) -> list:
+def _run_on_shards(function, shards_args: dict) -> list:
+    """ Call function(shard, *args) for every shard in parallel, each shard has its own state and lock """
+    if len(shards_args) == 1:
+        (shard, args), = shards_args.items()
+        return [function(shard, *args)]
+
+    with ThreadPoolExecutor(max_workers=min(len(shards_args), _MAX_PARALLEL_SHARDS)) as executor:
+        futures = {shard: executor.submit(instrumentation.bind(function), shard, *args)
+                   for shard, args in shards_args.items()}
+        try:
+            wait(list(futures.values()))
+        except KeyboardInterrupt:
+            cancel_terraform_runs()  # terraform runs in its own process group, Ctrl+C does not reach it
+            raise
+    results, errors = [], []
+    for shard, future in futures.items():
+        try:
+            results.append(future.result())
+        except Exception as e:
+            errors.append(f'{shard.workspace}: {str(e)}')
+    if errors:
+        raise Exception('; '.join(errors))
+    return results
+
+
+def _pull_state(shard: Shard):
+    """ Download state of a shard. Returns False when shard has no state yet (new shard) """
+    shard.prepare()
+    try:
+        tfb.pull(shard.state_file_path)
+    except botocore.exceptions.ClientError as e:
+        if shard.index != 0 and e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return False
+        raise
+    return True
+
+
+def _sync_registry_from_state(shard: Shard):
+    shard.prepare()
+    if shard.has_state():
+        manage_thing.extract_things_from_state_file(shard.state_file_path, shard.devices_file_path)  # get json from state file
+
+
+@instrumentation.timed('aws_tools.refresh_registry')
+def _refresh_shard_registry(shard: Shard, download_backup=True):
+    instrumentation.current_span().set(shard=shard.workspace)
     if download_backup:
         try:
-            tfb.pull(TERRAFORM_STATE_FILE_PATH_LOCAL)
+            _pull_state(shard)
         except Exception as e:
             if 'InvalidAccessKeyId' in str(e):
-                raise WrongAwsKeysError(f'Failed to pull file {TERRAFORM_STATE_FILE_PATH_LOCAL}') from e
+                raise WrongAwsKeysError(f'Failed to pull file {shard.state_file_path}') from e
             elif '' in str(e):
-                raise NoInternetConnection(f'Failed to pull file {TERRAFORM_STATE_FILE_PATH_LOCAL}.') from e
+                raise NoInternetConnection(f'Failed to pull file {shard.state_file_path}.') from e
             else:
-                logging.error(f'Failed to pull file {TERRAFORM_STATE_FILE_PATH_LOCAL}. Reason: {str(e)}')
+                logging.error(f'Failed to pull file {shard.state_file_path}. Reason: {str(e)}')
                 raise Exception(f'Failed to update devices list. Reason: {str(e)}')
-    manage_thing.extract_things_from_state_file(TERRAFORM_STATE_FILE_PATH_LOCAL)  # get json from state file
-    devices = manage_thing.get_devices()
-    return devices
+    _sync_registry_from_state(shard)
+
+
+def _get_shard_devices(shard: Shard, download_backup=True) -> list:
+    _refresh_shard_registry(shard, download_backup)
+    return manage_thing.get_devices(shard.devices_file_path)
+
+
+def iter_aws_devices(prefix=None, pattern=None, offset=0, limit=None, cached=False):
+    """ Devices of the whole fleet sorted by name: {'name', 'group', 'created', 'cert_id', 'shard'}.
+
+    Filtering and paging is done by the devices registry and results are read lazily, so listing a page of a large
+    fleet does not build the full list. With cached=True registry is used as synced by the last command, without
+    any S3 call.
+    """
+    config = shards.load_config(download_backup=not cached)
+    if not cached:
+        _run_on_shards(_refresh_shard_registry, {shard: () for shard in config.shards()})
+    workspaces = {shard.devices_file_path: shard.workspace for shard in config.shards()}
+    by_registry = {os.path.basename(path): workspace for path, workspace in workspaces.items()}
+    for device in manage_thing.iter_devices(list(workspaces), prefix, pattern, offset, limit):
+        device['shard'] = by_registry[device.pop('registry')]
+        yield device
+
+
+def get_all_available_aws_devices(download_backup=True) -> list:
+    config = shards.load_config(download_backup)
+    per_shard = _run_on_shards(_get_shard_devices, {shard: (download_backup,) for shard in config.shards()})
+    return [device for devices in per_shard for device in devices]
+
+
+def _get_terraform_data_dir():
+    return os.environ.get('TF_DATA_DIR') or os.path.join(_TERRAFORM_STATE_LOCAL_DIR, '.terraform')
 
 
 def _is_terraform_initialized():
-    if '.terraform' in os.listdir(_TERRAFORM_STATE_LOCAL_DIR):
-        return True
-    else:
-        return False
+    return os.path.isdir(_get_terraform_data_dir())
 
 
-def apply_changes_in_terraform(upload_backup=True):
+def cancel_terraform_runs():
+    """ Interrupt running terraform commands (they stop gracefully, saving state) and fail new ones """
+    _terraform_cancel.set()
 
-    cwd = os.getcwd()
-    os.chdir(_TERRAFORM_STATE_LOCAL_DIR)
 
-    up_to_date = False
-    while not up_to_date:
-        # loop because first time can download older version
-        up_to_date, version = check_tf_latest_version()
-        if not up_to_date:
-            get_terraform(version)
+def _terraform_json_output() -> bool:
+    from wist.terraform_management import read_version_lock
 
-    if not _is_terraform_initialized():
-        logging.info('Initializing Terraform environment...')
-        rc = subprocess.call([common.cfg.terraform_exec_path, "init", "-input=false"])
-        if rc != 0:
-            raise Exception(f'Calling terraform init ended with an error: {rc}.')
-        logging.info('Terraform environment initialized.')
+    return terraform_runner.supports_json_output(read_version_lock().get('installed'))
+
+
+def _log_terraform_progress(shard: Shard, total: int = None):
+    """ Default progress callback: a line for every resource done, with count of those done so far """
+    done = 0
 
-    logging.info(f'Testing changes terraform (plan)...')
-    my_env = os.environ.copy()
-    rc = subprocess.call([common.cfg.terraform_exec_path, "plan", "-input=false"], env=my_env)
-    if rc != 0:
-        raise Exception(f'Calling terraform plan ended with an error: {rc}.')
+    def progress(event: dict):
+        nonlocal done
+        if event['type'] in ('apply_complete', 'apply_errored'):
+            done += 1
+            status = 'done' if event['type'] == 'apply_complete' else 'FAILED'
+            elapsed = f" in {event['elapsed']:.1f}s" if event.get('elapsed') is not None else ''
+            logging.info(f"[{shard.workspace}] {done}/{total or '?'} {event.get('action')} {event.get('address')} "
+                         f"{status}{elapsed}")
+        elif event['type'] == 'plan_summary':
+            changes = event['changes']
+            logging.info(f"[{shard.workspace}] Plan: {changes['add']} to add, {changes['change']} to change, "
+                         f"{changes['remove']} to destroy")
+    return progress
 
-    logging.info(f'Applying changes to terraform...')
-    rc = subprocess.call([common.cfg.terraform_exec_path, "apply", "-auto-approve", "-input=false"])
-    if rc != 0:
-        raise Exception(f'Calling terraform apply ended with an error: {rc}.')
 
-    if upload_backup:
-        tfb.push(TERRAFORM_STATE_FILE_PATH_LOCAL)
-        if tfb.is_locked(TERRAFORM_STATE_FILE_PATH_LOCAL):
-            tfb.unlock(TERRAFORM_STATE_FILE_PATH_LOCAL)
+def _timed_call(step: str, cmd: list, timings: dict, shard: Shard = _DEFAULT_SHARD, progress=None) -> dict:
+    """ Run terraform command with streamed output, see terraform_runner.run for the result.
 
-    os.chdir(cwd)
+    Command is interrupted when lock of the shard state held by this process is lost, its state must not be changed.
+    """
+    tfb.check_lock(shard.state_file_path)
+    start = time.time()
+    with instrumentation.span(f'terraform.{step}', shard=shard.workspace) as metrics:
+        try:
+            result = terraform_runner.run(cmd, _TERRAFORM_STATE_LOCAL_DIR, shard.terraform_env(), step,
+                                          '-json' in cmd, progress, TERRAFORM_TIMEOUT or None,
+                                          [_terraform_cancel, tfb.get_lock_lost_event(shard.state_file_path)])
+        except terraform_runner.TerraformCancelled:
+            tfb.check_lock(shard.state_file_path)  # report lost lock rather than cancellation
+            raise
+        metrics.set(returncode=result['returncode'], throttled=result['throttled'], **(result['changes'] or {}))
+        metrics.add('resources_done', sum(1 for resource in result['resources'].values()
+                                          if resource.get('status') == 'complete'))
+        metrics.add('errors', sum(1 for diagnostic in result['diagnostics'] if diagnostic.get('severity') == 'error'))
+    timings[step] = time.time() - start
+    logging.info(f'terraform {step} took {timings[step]:.1f}s')
+    return result
+
+
+def _prepare_terraform(timings: dict):
+    from wist.terraform_management import ensure_terraform
+
+    with _terraform_setup_lock:
+        start = time.time()
+        ensure_terraform()  # pinned version, upgrades are done explicitly with 'wist upgrade_terraform'
+        timings['version check'] = time.time() - start
+
+        if not _is_terraform_initialized():
+            logging.info('Initializing Terraform environment...')
+            rc = _timed_call('init', [common.cfg.terraform_exec_path, "init", "-input=false"], timings)['returncode']
+            if rc != 0:
+                raise Exception(f'Calling terraform init ended with an error: {rc}.')
+            logging.info('Terraform environment initialized.')
+
+
+def _get_full_reconcile_marker_path(shard: Shard):
+    suffix = '' if shard.workspace == shards.DEFAULT_WORKSPACE else f'.{shard.workspace}'
+    return os.path.join(_TERRAFORM_STATE_LOCAL_DIR, f'.wist_full_reconcile{suffix}')
+
+
+def _is_full_reconcile_due(shard: Shard):
+    try:
+        return time.time() - os.path.getmtime(_get_full_reconcile_marker_path(shard)) > FULL_RECONCILE_INTERVAL
+    except OSError:
+        return True
+
+
+@instrumentation.timed('aws_tools.apply_changes')
+def apply_changes_in_terraform(upload_backup=True, targets=None, shard: Shard = None, progress=None):
+    """ Plan and apply. With targets only those resources (and their dependencies) are refreshed and changed.
 
+    progress(event) is called with events of terraform output as they come (see terraform_runner), by default
+    every finished resource is logged. Plan and apply failed because of AWS throttling are retried.
+    """
+    shard = shard or _DEFAULT_SHARD
+    if targets is not None and (len(targets) > _MAX_TARGETS or _is_full_reconcile_due(shard)):
+        logging.info('Running full reconcile of all resources instead of targeted apply')
+        targets = None
+    metrics = instrumentation.current_span()
+    metrics.set(shard=shard.workspace, full_reconcile=targets is None, targets=len(targets or ()))
 
-def add_new_device_to_aws(device_name, download_backup=True):
+    timings = {}
+    plan_path = os.path.join(_TERRAFORM_STATE_LOCAL_DIR, f'wist.{shard.workspace}.tfplan')
+    shard.prepare()
 
+    applied = False
     try:
+        _prepare_terraform(timings)
+
+        # plan is saved and exactly that plan is applied, so resources are refreshed only once
+        target_args = [f"-target={target}" for target in targets] if targets else []
+        json_args = ['-json'] if _terraform_json_output() else []
+        for attempt in range(THROTTLING_RETRIES + 1):
+            logging.info(f'Testing changes terraform (plan)...')
+            step, result = 'plan', _timed_call(
+                'plan', [common.cfg.terraform_exec_path, "plan", "-input=false", "-detailed-exitcode",
+                         f"-out={plan_path}"] + json_args + target_args, timings, shard,
+                progress or _log_terraform_progress(shard))
+            rc = result['returncode']
+            metrics.set(changes=rc == 2)
+            if rc == 0:
+                logging.info('No changes in infrastructure. Skipping terraform apply.')
+                break
+            elif rc == 2:
+                logging.info(f'Applying changes to terraform...')
+                total = sum((result['changes'] or {}).values()) or None
+                applied = True
+                step, result = 'apply', _timed_call(
+                    'apply', [common.cfg.terraform_exec_path, "apply", "-input=false"] + json_args + [plan_path],
+                    timings, shard, progress or _log_terraform_progress(shard, total))
+                rc = result['returncode']
+                if rc == 0:
+                    break
+
+            if not result['throttled'] or attempt == THROTTLING_RETRIES:
+                raise Exception(f'Calling terraform {step} ended with an error: {rc}.')
+            delay = _THROTTLING_BACKOFF_BASE * 2 ** attempt
+            metrics.add('throttling_retries')
+            logging.warning(f'Terraform {step} was throttled by AWS, retrying in {delay}s '
+                            f'({attempt + 1}/{THROTTLING_RETRIES})')
+            time.sleep(delay)
+
+        if targets is None:
+            with open(_get_full_reconcile_marker_path(shard), 'w') as file:
+                file.write(str(time.time()))
+        metrics.set(state_bytes=os.path.getsize(shard.state_file_path) if shard.has_state() else 0)
+
+        if upload_backup:
+            start = time.time()
+            tfb.push(shard.state_file_path)
+            tfb.unlock(shard.state_file_path)
+            timings['backup upload'] = time.time() - start
+
+    except BaseException:
+        if applied and upload_backup:
+            try:
+                tfb.push(shard.state_file_path)  # resources created before failure or interrupt are in state
+            except tfb.BackupError:
+                pass  # logged, lock of the shard is kept
+        raise
+    finally:
+        if os.path.isfile(plan_path):
+            os.remove(plan_path)  # plan holds secrets, like new private keys
+
+    logging.info(f'Terraform timings ({shard.workspace}): ' +
+                 ', '.join(f'{step} {duration:.1f}s' for step, duration in timings.items()))
+
+
+def add_new_device_to_aws(device_name, download_backup=True, group=None, engine=None):
+    add_new_devices_to_aws([device_name], download_backup=download_backup, group=group, engine=engine)
+
+
+def delete_device_from_aws(device_name, download_backup=True):
+    delete_devices_from_aws([device_name], download_backup=download_backup)
+
+
+def add_new_devices_to_aws(device_names, download_backup=True, group=None, engine=None):
+    """ Add all given devices under a single lock and a single terraform apply (per shard) """
+    groups = {device_name: group for device_name in device_names} if group else None
+    added, _ = update_devices_in_aws(to_add=device_names, download_backup=download_backup, groups=groups,
+                                     engine=engine)
+    return added
+
+
+def delete_devices_from_aws(device_names, download_backup=True):
+    """ Remove all given devices under a single lock and a single terraform apply (per shard) """
+    _, removed = update_devices_in_aws(to_remove=device_names, download_backup=download_backup)
+    return removed
+
+
+def _pin_new_devices_to_groups(config: shards.ShardsConfig, groups: dict, download_backup=True):
+    """ Put new devices into shard of their group. Existing devices stay where they are until rebalance """
+    new_pins = {}
+    for device_name, group in groups.items():
+        if not group or config.groups.get(device_name) == group:
+            continue
+        current_shard = config.shard_for(device_name)
         if download_backup:
-            if tfb.is_locked(TERRAFORM_STATE_FILE_PATH_LOCAL):
-                logging.error(f'Could not lock terraform backup state file!')
-                return
+            _pull_state(current_shard)
+        if current_shard.has_state() and state_index.find_device(current_shard.state_file_path, device_name):
+            logging.warning(f'Device {device_name} already exists in {current_shard.workspace}, '
+                            f'not moving it to group {group}')
+            continue
+        new_pins[device_name] = group
+    if new_pins:
+        return shards.update_config(groups=new_pins)
+    return config
+
+
+def update_devices_in_aws(to_add=(), to_remove=(), download_backup=True, groups=None, engine=None):
+    """ Add and remove devices, with a single lock and a single terraform apply per shard. Returns (added, removed) """
+    engine = engine or PROVISIONING_ENGINE
+    if engine not in PROVISIONING_ENGINES:
+        raise Exception(f'Unknown provisioning engine {engine}. Use one of: {", ".join(PROVISIONING_ENGINES)}')
+    if CERT_MODE not in CERT_MODES:
+        raise Exception(f'Unknown WIST_CERT_MODE {CERT_MODE}. Use one of: {", ".join(CERT_MODES)}')
+    config = shards.load_config(download_backup)
+    if groups:
+        config = _pin_new_devices_to_groups(config, groups, download_backup)
+
+    adds_by_shard = config.route(to_add)
+    removes_by_shard = config.route(to_remove)
+    touched_shards = list(dict.fromkeys(list(adds_by_shard) + list(removes_by_shard))) or [_DEFAULT_SHARD]
+
+    results = _run_on_shards(_update_shard_devices, {
+        shard: (adds_by_shard.get(shard, []), removes_by_shard.get(shard, []), download_backup, engine, config.groups)
+        for shard in touched_shards})
+    added = [device for shard_added, _ in results for device in shard_added]
+    removed = [device for _, shard_removed in results for device in shard_removed]
+    return added, removed
+
+
+@instrumentation.timed('aws_tools.provision_directly')
+def _provision_devices_directly(shard: Shard, device_names: list, keys=None) -> list:
+    """ Create devices with IoT API and record them in state. Returns names that still need terraform """
+    from aws_architecture import iot_provisioning
+
+    shared = iot_provisioning.get_shared_resources(shard.state_file_path) if shard.has_state() else None
+    if shared is None:
+        logging.info(f'Thing type and policy of {shard.workspace} not created yet, provisioning with terraform')
+        return device_names
+
+    try:
+        provisioned = iot_provisioning.provision_devices(device_names, shared['thing_type_name'],
+                                                         shared['policy_name'], shared['region'], keys)
+    except iot_provisioning.PartialProvisioningError as e:
+        if e.provisioned:  # devices exist in AWS, they must not be lost from state
+            iot_provisioning.write_devices_to_state(shard.state_file_path, e.provisioned)
+            tfb.push(shard.state_file_path)
+            instrumentation.current_span().add('devices_provisioned', len(e.provisioned))
+        raise
+    if provisioned:
+        iot_provisioning.write_devices_to_state(shard.state_file_path, provisioned)
+    instrumentation.current_span().add('devices_provisioned', len(provisioned))
+    return [device_name for device_name in device_names if device_name not in provisioned]
+
+
+def _write_csrs_file(shard: Shard, csrs: dict):
+    """ CSRs of devices created in next apply. Empty file once done, CSR does not matter after device exists """
+    if not csrs and not os.path.isfile(shard.csrs_file_path):
+        return
+    with open(shard.csrs_file_path, 'w') as file:
+        json.dump(csrs, file)
 
-            tfb.pull(TERRAFORM_STATE_FILE_PATH_LOCAL)
-            tfb.lock(TERRAFORM_STATE_FILE_PATH_LOCAL)  # lock state file on cloud
-            manage_thing.extract_things_from_state_file(TERRAFORM_STATE_FILE_PATH_LOCAL)  # get json from state file
-        manage_thing.add_device(device_name)
 
-        apply_changes_in_terraform()
+@instrumentation.timed('aws_tools.update_shard_devices')
+def _update_shard_devices(shard: Shard, to_add, to_remove, download_backup=True, engine=None, groups=None):
+    from aws_architecture import device_keys
 
-        manage_thing.extract_certs_from_state_file(TERRAFORM_STATE_FILE_PATH_LOCAL)
+    instrumentation.current_span().set(shard=shard.workspace, to_add=len(to_add), to_remove=len(to_remove))
+    try:
+        if download_backup:
+            tfb.lock(shard.state_file_path, wait=LOCK_WAIT)  # lock state file on cloud before reading it
+            _pull_state(shard)
+        _sync_registry_from_state(shard)
+        added = manage_thing.add_devices(to_add, shard.devices_file_path, groups) if to_add else []
+        removed = manage_thing.remove_devices(to_remove, shard.devices_file_path) if to_remove else []
+
+        keys = None
+        if added and CERT_MODE == 'csr':
+            with instrumentation.span('device_keys.generate_keys', devices=len(added)):
+                keys = device_keys.generate_keys(added)
+
+        for_terraform = added
+        if added and (engine or PROVISIONING_ENGINE) == 'boto3':
+            for_terraform = _provision_devices_directly(shard, added, keys)  # failed ones are retried by terraform
+
+        if for_terraform or removed:
+            _write_csrs_file(shard, {device_name: keys[device_name]['csr'] for device_name in for_terraform}
+                             if keys else {})
+            try:
+                apply_changes_in_terraform(targets=manage_thing.get_device_resource_addresses(for_terraform + removed),
+                                           shard=shard)
+            finally:
+                _write_csrs_file(shard, {})
+            manage_thing.extract_certs_from_state_file(shard.state_file_path, shard.certs_dir)
+        elif added:
+            tfb.push(shard.state_file_path)  # same as after terraform apply
+            tfb.unlock(shard.state_file_path)
+            manage_thing.extract_certs_from_state_file(shard.state_file_path, shard.certs_dir)
+        else:
+            logging.info('No changes in devices registry. Skipping terraform apply.')
+            if download_backup:
+                tfb.unlock(shard.state_file_path)
 
         # some additional action can be taken here e.g. registering device in DynamoDB
 
     except Exception as e:
-        tfb.unlock(TERRAFORM_STATE_FILE_PATH_LOCAL)
-        logging.error(f'Adding new device to AWS failed. Reason: {str(e)}')
-        raise Exception(f'Adding new device to AWS failed. Reason: {str(e)}')
+        tfb.unlock(shard.state_file_path)
+        logging.error(f'Updating devices in AWS failed. Reason: {str(e)}')
+        raise Exception(f'Updating devices in AWS failed. Reason: {str(e)}')
 
-    else:
-        logging.info(f'Device {device_name} added successfully!')
+    if removed:
+        device_keys.remove_device_keys(removed)
 
+    if added:
+        logging.info(f'Devices {added} added successfully!')
+    if removed:
+        logging.info(f'Devices {removed} removed successfully!')
+    return added, removed
 
-def delete_device_from_aws(device_name, download_backup=True):
-    try:
-        if download_backup:
-            if tfb.is_locked(TERRAFORM_STATE_FILE_PATH_LOCAL):
-                logging.error(f'Could not lock terraform backup state file!')
-                return
 
-            tfb.pull(TERRAFORM_STATE_FILE_PATH_LOCAL)
-            tfb.lock(TERRAFORM_STATE_FILE_PATH_LOCAL)  # lock state file on cloud
-        manage_thing.extract_things_from_state_file(TERRAFORM_STATE_FILE_PATH_LOCAL)  # get json from state file
-        manage_thing.remove_device(device_name)
+def warm_key_pool(size=None):
+    """ Generate device keys ahead of time, so adding devices in CSR mode does not wait for key generation """
+    from aws_architecture import device_keys
 
-        apply_changes_in_terraform()
+    generated = device_keys.fill_key_pool(size)
+    logging.info(f'Key pool has {device_keys.get_key_pool_size()} keys ({generated} generated now)')
 
-        manage_thing.extract_certs_from_state_file(TERRAFORM_STATE_FILE_PATH_LOCAL)
 
-    except Exception as e:
-        tfb.unlock(TERRAFORM_STATE_FILE_PATH_LOCAL)
-        logging.error(f'Removing device {device_name} from AWS failed. Reason: {str(e)}')
-        raise Exception(f'Removing device {device_name} from AWS failed. Reason: {str(e)}')
-    else:
-        logging.info(f'Device {device_name} removed successfully!')
+def _bulk_register_shard_devices(shard: Shard, device_names, role_arn=None):
+    from aws_architecture import iot_provisioning, bulk_registration
 
+    def record(registered: dict):
+        iot_provisioning.write_devices_to_state(shard.state_file_path, registered)
+        manage_thing.add_devices(list(registered), shard.devices_file_path)
+        tfb.push(shard.state_file_path)
+        manage_thing.extract_certs_from_state_file(shard.state_file_path, shard.certs_dir)
 
-def copy_device_certs_to(device_name: str, dest_dir: str):
     try:
-        tfb.pull(TERRAFORM_STATE_FILE_PATH_LOCAL)
+        tfb.lock(shard.state_file_path, wait=LOCK_WAIT)
+        _pull_state(shard)
+        _sync_registry_from_state(shard)
+        known_devices = set(manage_thing.get_devices(shard.devices_file_path))
+        new_devices = [device_name for device_name in device_names if device_name not in known_devices]
+        shared = iot_provisioning.get_shared_resources(shard.state_file_path) if shard.has_state() else None
+        if shared is None:
+            raise Exception(f'Thing type and policy of {shard.workspace} not created yet. Add one device with '
+                            f'"wist add_device" first')
+
+        registered = {}
+        if new_devices:
+            try:
+                registered = bulk_registration.register_devices(new_devices, shared['thing_type_name'],
+                                                                shared['policy_name'], shared['region'], role_arn,
+                                                                private_keys_in_state=CERT_MODE != 'csr')
+            except bulk_registration.BulkRegistrationError as e:
+                if e.registered:  # devices exist in AWS, they must not be lost from state
+                    logging.warning(f'Recording {len(e.registered)} devices registered before the failure')
+                    record(e.registered)
+                raise
+        if registered:
+            record(registered)
+        tfb.unlock(shard.state_file_path)
     except Exception as e:
-        logging.error(f'Failed to pull file {TERRAFORM_STATE_FILE_PATH_LOCAL}. Reason: {str(e)}')
-        return
+        tfb.unlock(shard.state_file_path)
+        logging.error(f'Bulk registration failed. Reason: {str(e)}')
+        raise Exception(f'Bulk registration failed. Reason: {str(e)}')
+    return list(registered)
 
-    manage_thing.extract_certs_from_state_file(TERRAFORM_STATE_FILE_PATH_LOCAL)  # get json from state file
 
-    device_cert_dir = os.path.join(AWS_CERTS_DIRECTORY, device_name)
-    if not os.path.isdir(device_cert_dir):
-        raise Exception(f'Certificates for a specified device not created!')
-    else:
-        logging.info(f'Extracted certificate for {device_name}.')
+def bulk_register_devices(device_names, group=None, role_arn=None):
+    """ Register many devices with AWS IoT bulk registration and record them in Terraform state """
+    config = shards.load_config()
+    if group:
+        config = _pin_new_devices_to_groups(config, {device_name: group for device_name in device_names})
 
-    if not os.path.isdir(dest_dir):
-        os.mkdir(dest_dir)
+    registered = []
+    for shard, shard_device_names in config.route(device_names).items():
+        # only one bulk registration task can run at a time in an account, so shards go one by one
+        registered.extend(_bulk_register_shard_devices(shard, shard_device_names, role_arn))
 
-    shutil.copyfile(os.path.join(device_cert_dir, 'certificate_pem'), os.path.join(dest_dir, 'cert.crt'))
-    logging.info(f'{device_name} certificate copied to "{dest_dir}/cert.crt".')
+    not_registered = [device_name for device_name in device_names if device_name not in set(registered)]
+    if not_registered:
+        logging.warning(f'Devices not registered: {not_registered}')
+    logging.info(f'{len(registered)} devices registered successfully!')
+    return registered
 
-    shutil.copyfile(os.path.join(device_cert_dir, 'private_key'), os.path.join(dest_dir, 'priv.key'))
-    logging.info(f'{device_name} private key copied to "{dest_dir}/priv.key".')
 
-    # download amazon root ca
-    logging.info(f'Donloading Amazon root CA to "{dest_dir}/cacert.pem"')
-    ca_dest_path = os.path.join(dest_dir, 'cacert.pem')
+def _reconcile_shard(shard: Shard):
+    try:
+        tfb.lock(shard.state_file_path, wait=LOCK_WAIT)
+        _pull_state(shard)
+        _sync_registry_from_state(shard)
+        apply_changes_in_terraform(shard=shard)
+        manage_thing.extract_certs_from_state_file(shard.state_file_path, shard.certs_dir)
+    except Exception as e:
+        tfb.unlock(shard.state_file_path)
+        logging.error(f'Reconciling devices in AWS failed. Reason: {str(e)}')
+        raise Exception(f'Reconciling devices in AWS failed. Reason: {str(e)}')
 
-    response = requests.get(AWS_ROOT_CA_CERTIFICATE_URL)
-    response.raise_for_status()
 
-    with open(ca_dest_path, "w") as file:
-        file.write(response.content.decode('utf-8'))
+def reconcile_devices_in_aws():
+    """ Full plan and apply over all devices, fixes drift that targeted applies do not look at """
+    config = shards.load_config()
+    _run_on_shards(_reconcile_shard, {shard: () for shard in config.shards()})
+    logging.info('Devices reconciled successfully!')
 
 
-def get_device_cert(device_name: str):
-    manage_thing.extract_certs_from_state_file(TERRAFORM_STATE_FILE_PATH_LOCAL)  # get json from state file
+def _move_devices_between_shards(source: Shard, destination: Shard, device_names: list, groups=None):
+    """ Move device resources (with their certificates and keys) from one shard state to another.
 
-    device_cert_dir = os.path.join(AWS_CERTS_DIRECTORY, device_name)
-    if not os.path.isdir(device_cert_dir):
-        raise Exception(f'Certificates for a specified device not created!')
+    States are edited directly, one read and write of each file for all devices. terraform state mv takes a single
+    address and rewrites both states every time, which for a large fleet means hundreds of thousands of runs.
+    """
+    from aws_architecture import iot_provisioning
 
-    cert_path = os.path.join(device_cert_dir, 'certificate_pem')
+    with instrumentation.span('aws_tools.move_devices', source=source.workspace, destination=destination.workspace,
+                              devices=len(device_names)) as metrics:
+        moved = iot_provisioning.move_devices_between_states(source.state_file_path, destination.state_file_path,
+                                                             device_names)
+        metrics.add('resources_moved', moved)
+    manage_thing.remove_devices(device_names, source.devices_file_path)
+    manage_thing.add_devices(device_names, destination.devices_file_path, groups)
+    logging.info(f'Moved {len(device_names)} devices from {source.workspace} to {destination.workspace}')
 
-    with open(cert_path, 'r') as file:
-        device_cert = file.read()
 
-    return device_cert
+def _copy_state(shard: Shard):
+    """ Copy of pulled state, to put back when moving devices fails. None when shard has no state """
+    if not shard.has_state():
+        return None
+    copy_path = shard.state_file_path + '.before_rebalance'
+    shutil.copy2(shard.state_file_path, copy_path)
+    return copy_path
 
 
-def get_device_priv_key(device_name: str):
-    manage_thing.extract_certs_from_state_file(TERRAFORM_STATE_FILE_PATH_LOCAL)  # get json from state file
+def _restore_state(shard: Shard, copy_path):
+    if copy_path is not None:
+        os.replace(copy_path, shard.state_file_path)
+    elif shard.has_state():
+        os.remove(shard.state_file_path)  # created by moving devices to it
+
+
+def _push_after_failure(shards_to_push):
+    """ Upload states changed locally before an error, so they are not lost when lock is released """
+    for shard in shards_to_push:
+        try:
+            tfb.push(shard.state_file_path)
+        except Exception:
+            logging.exception(f'Uploading state of {shard.workspace} failed, upload it from '
+                              f'{shard.state_file_path} before running wist again')
+
+
+def rebalance_shards(count: int):
+    """ Change number of shards and migrate devices which now belong to another shard """
+    if count < 1:
+        raise Exception('Number of shards must be at least 1')
+    old_config = shards.load_config()
+    new_config = shards.ShardsConfig(count, dict(old_config.groups))
+    all_shards = [Shard(index) for index in range(max(old_config.count, count))]
+
+    locked = []
+    copies = {}  # shard -> copy of its state as pulled
+    try:
+        for shard in all_shards:
+            tfb.lock(shard.state_file_path, wait=LOCK_WAIT)
+            locked.append(shard)
+            _pull_state(shard)
+            _sync_registry_from_state(shard)
+            copies[shard] = _copy_state(shard)
+
+        moves = {}  # (source, destination) -> device names
+        for shard in all_shards:
+            for device_name in manage_thing.get_devices(shard.devices_file_path):
+                destination = new_config.shard_for(device_name)
+                if destination != shard:
+                    moves.setdefault((shard, destination), []).append(device_name)
+
+        moved_to = {}
+        moved = []
+        try:
+            for (source, destination), device_names in moves.items():
+                _move_devices_between_shards(source, destination, device_names, new_config.groups)
+                moved.append((source, destination, device_names))
+                moved_to.setdefault(destination, []).extend(device_names)
+        except BaseException:
+            # moving changes only local states, nothing changed in AWS yet: put everything back as it was pulled
+            logging.error('Moving devices between shards failed, restoring states as they were before')
+            for shard, copy_path in copies.items():
+                _restore_state(shard, copy_path)
+            for source, destination, device_names in moved:
+                manage_thing.remove_devices(device_names, destination.devices_file_path)
+                manage_thing.add_devices(device_names, source.devices_file_path, old_config.groups)
+            copies = {}
+            raise
+
+        # moved things get thing type and policy of their new shard
+        touched = {shard for pair in moves for shard in pair}
+        try:
+            for destination, device_names in moved_to.items():
+                apply_changes_in_terraform(upload_backup=False, shard=destination,
+                                           targets=manage_thing.get_device_resource_addresses(device_names))
+        except BaseException:
+            # apply may have changed moved things already, local states record that and the moves, keep them
+            logging.error('Applying moved devices failed, uploading states of all shards they were moved between')
+            _push_after_failure(touched)
+            try:
+                shards.update_config(count=count)  # devices are in states of their new shards now
+            except Exception:
+                logging.exception(f'Updating shards config failed, run "wist rebalance --shards {count}" again')
+            raise
+
+        for shard in touched:
+            manage_thing.extract_certs_from_state_file(shard.state_file_path, shard.certs_dir)
+            tfb.push(shard.state_file_path)
+        shards.update_config(count=count)
+    finally:
+        for copy_path in copies.values():
+            if copy_path is not None and os.path.isfile(copy_path):
+                os.remove(copy_path)
+        for shard in locked:
+            tfb.unlock(shard.state_file_path)
+
+    for shard in all_shards[count:]:
+        logging.info(f'{shard.workspace} is not used anymore. Its thing type and policy can be removed with '
+                     f'"terraform destroy" in that workspace.')
+    logging.info(f'Fleet rebalanced to {count} shards, {sum(len(names) for names in moves.values())} devices moved.')
+
+
+def copy_device_certs_to(device_name: str, dest_dir: str):
+    from wist import cert_bundles
 
-    device_cert_dir = os.path.join(AWS_CERTS_DIRECTORY, device_name)
-    if not os.path.isdir(device_cert_dir):
+    # reading only: shards config as synced by the last command, no extra S3 call per device
+    shard = shards.load_config(download_backup=False).shard_for(device_name)
+    try:
+        _pull_state(shard)
+    except Exception as e:
+        logging.error(f'Failed to pull file {shard.state_file_path}. Reason: {str(e)}')
+        return
+
+    cert = _get_device_certificate(device_name, shard)  # only this device is looked up, no fleet-wide extraction
+    logging.info(f'Found certificate for {device_name}.')
+
+    cert_bundles.write_bundle(cert, dest_dir)
+    logging.info(f'{device_name} certificate, private key and Amazon root CA copied to "{dest_dir}" '
+                 f'({cert_bundles.CERT_FILE_NAME}, {cert_bundles.PRIVATE_KEY_FILE_NAME}, '
+                 f'{cert_bundles.ROOT_CA_FILE_NAME}).')
+
+
+def copy_devices_certs_to(device_names, dest_dir: str, archive_format=None, archive_per='device'):
+    """ Write certificate bundles of many devices, or of the whole fleet when device_names is None """
+    from wist import cert_bundles
+
+    config = shards.load_config(download_backup=False)
+    shards_to_read = config.shards() if device_names is None else list(config.route(device_names))
+    _run_on_shards(_pull_state, {shard: () for shard in shards_to_read})
+
+    certs, missing = {}, []
+    for shard in shards_to_read:
+        if not shard.has_state():
+            continue
+        index = state_index.get_state_index(shard.state_file_path)
+        names = index.thing_names() if device_names is None else \
+            [device_name for device_name in device_names if config.shard_for(device_name) == shard]
+        for device_name in names:
+            device = index.get(device_name)
+            try:
+                if device is None or device['certificate'] is None:
+                    raise Exception(f'Certificates for {device_name} not created!')
+                certs[device_name] = _complete_certificate(device_name, device['certificate'])
+            except Exception as e:
+                logging.error(str(e))
+                missing.append(device_name)
+
+    written = cert_bundles.write_bundles(certs, dest_dir, archive_format, archive_per)
+    if missing:
+        logging.warning(f'No certificate bundles for {len(missing)} devices: {missing}')
+    return written
+
+
+def _complete_certificate(device_name: str, cert: dict) -> dict:
+    from aws_architecture import device_keys
+
+    if not cert['private_key']:
+        # certificate created from CSR, private key is only on the machine which generated it
+        local_key = device_keys.read_device_key(device_name)
+        if local_key is None:
+            raise Exception(f'Private key of {device_name} is not stored in state. It is kept only on the machine '
+                            f'which added the device ({device_keys.DEVICE_KEYS_DIR})')
+        cert = dict(cert, private_key=local_key['private_key'], public_key=cert['public_key'] or local_key['public_key'])
+    return cert
+
+
+def _get_device_certificate(device_name: str, shard: Shard = None) -> dict:
+    shard = shard or shards.load_config(download_backup=False).shard_for(device_name)
+    device = None
+    if shard.has_state():
+        device = state_index.find_device(shard.state_file_path, device_name)
+    if device is None or device['certificate'] is None:
         raise Exception(f'Certificates for a specified device not created!')
+    return _complete_certificate(device_name, device['certificate'])
+
 
-    key_path = os.path.join(device_cert_dir, 'private_key')
+def get_device_cert(device_name: str):
+    return _get_device_certificate(device_name)['certificate_pem']
 
-    with open(key_path, 'r') as file:
-        device_key = file.read()
 
-    return device_key
+def get_device_priv_key(device_name: str):
+    return _get_device_certificate(device_name)['private_key']
 
 
 def untrack_device_from_terraform(device_name):
-    devices = get_all_available_aws_devices()
-    dev_key = None
-    for key, name in enumerate(devices):
-        if name == device_name:
-            dev_key = key
-            break
-
-    # because Terraform documentation does not mention any DIR parameter in "terraform state" command,
-    # we are assuming the need to change current dir for this:
-    cwd = os.getcwd()
-    os.chdir(_TERRAFORM_STATE_LOCAL_DIR)
-    cmd = [common.cfg.terraform_exec_path, "state", "rm", f"module.iot_core_publisher.aws_iot_thing.iot_thing[{dev_key}]"]
-    logging.info(f"Calling: {' '.join(cmd)}")
-    rc = subprocess.call(cmd)
-    if rc != 0:
-        raise Exception(f'Calling terraform state rm ended with an error: {rc}.')
-
-    manage_thing.extract_things_from_state_file(TERRAFORM_STATE_FILE_PATH_LOCAL)  # get json from state file
-    tfb.push(TERRAFORM_STATE_FILE_PATH_LOCAL)
-    if tfb.is_locked(TERRAFORM_STATE_FILE_PATH_LOCAL):
-        tfb.unlock(TERRAFORM_STATE_FILE_PATH_LOCAL)
-
-    os.chdir(cwd)
+    """ Remove resources of a device from terraform state without destroying them in AWS """
+    shard = shards.load_config().shard_for(device_name)
+    tfb.lock(shard.state_file_path, wait=LOCK_WAIT)
+    try:
+        if device_name not in _get_shard_devices(shard):
+            raise Exception(f'There is no device with such name: [{device_name}]')
+
+        # resources are keyed by device name (for_each), not by position in things file
+        cmd = [common.cfg.terraform_exec_path, "state", "rm"] + \
+            manage_thing.get_device_resource_addresses([device_name])
+        logging.info(f"Calling: {' '.join(cmd)}")
+        rc = _timed_call('state_rm', cmd, {}, shard)['returncode']
+        if rc != 0:
+            raise Exception(f'Calling terraform state rm ended with an error: {rc}.')
+
+        manage_thing.remove_devices([device_name], shard.devices_file_path)
+        tfb.push(shard.state_file_path)
+    finally:
+        tfb.unlock(shard.state_file_path)
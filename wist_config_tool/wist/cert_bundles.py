@@ -0,0 +1,107 @@
+import os
+import io
+import time
+import zipfile
+import tarfile
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from wist import downloads
+
+
+AWS_ROOT_CA_CERTIFICATE_URL = "https://www.amazontrust.com/repository/AmazonRootCA1.pem"
+
+CERT_FILE_NAME = 'cert.crt'
+PRIVATE_KEY_FILE_NAME = 'priv.key'
+ROOT_CA_FILE_NAME = 'cacert.pem'
+
+ARCHIVE_FORMATS = ('tar', 'zip')
+ARCHIVE_PER_DEVICE = 'device'
+ARCHIVE_PER_BATCH = 'batch'
+
+_MAX_WORKERS = 16
+
+_root_ca = None
+_root_ca_lock = threading.Lock()
+
+
+def get_root_ca() -> str:
+    """ Root CA never changes, it is downloaded once to the cache dir (checked by sha256) and read once per process """
+    global _root_ca
+    with _root_ca_lock:
+        if _root_ca is None:
+            _root_ca = downloads.read_immutable(AWS_ROOT_CA_CERTIFICATE_URL).decode('utf-8')
+    return _root_ca
+
+
+def _bundle_files(cert: dict) -> dict:
+    return {CERT_FILE_NAME: cert['certificate_pem'], PRIVATE_KEY_FILE_NAME: cert['private_key'],
+            ROOT_CA_FILE_NAME: get_root_ca()}
+
+
+def write_bundle(cert: dict, dest_dir: str):
+    """ Write certificate, private key and root CA of one device to dest_dir """
+    os.makedirs(dest_dir, exist_ok=True)
+    for file_name, content in _bundle_files(cert).items():
+        with open(os.path.join(dest_dir, file_name), 'w') as file:
+            file.write(content)
+
+
+def _add_to_tar(archive: tarfile.TarFile, name: str, content: str):
+    data = content.encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    info.mode = 0o600 if name.endswith(PRIVATE_KEY_FILE_NAME) else 0o644
+    archive.addfile(info, io.BytesIO(data))
+
+
+def _write_archive(path: str, archive_format: str, files: dict):
+    """ files: name in archive -> content """
+    if archive_format == 'zip':
+        with zipfile.ZipFile(path + '.tmp', 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+    else:
+        with tarfile.open(path + '.tmp', 'w:gz') as archive:
+            for name, content in files.items():
+                _add_to_tar(archive, name, content)
+    os.replace(path + '.tmp', path)
+
+
+def _archive_extension(archive_format: str):
+    return '.zip' if archive_format == 'zip' else '.tar.gz'
+
+
+def write_bundles(certs: dict, dest_dir: str, archive_format=None, archive_per=ARCHIVE_PER_DEVICE) -> list:
+    """ Write bundles of many devices (device name -> certificate). Returns paths of written dirs or archives.
+
+    Without archive_format every device gets its own directory, otherwise its own archive, or all devices
+    go into one archive (archive_per='batch').
+    """
+    start = time.time()
+    os.makedirs(dest_dir, exist_ok=True)
+    get_root_ca()  # once, before workers start
+
+    if archive_format is not None and archive_per == ARCHIVE_PER_BATCH:
+        path = os.path.join(dest_dir, f"certs_{time.strftime('%Y%m%d_%H%M%S')}{_archive_extension(archive_format)}")
+        _write_archive(path, archive_format, {f'{device_name}/{file_name}': content
+                                              for device_name, cert in certs.items()
+                                              for file_name, content in _bundle_files(cert).items()})
+        paths = [path]
+    else:
+        def write(device_name):
+            if archive_format is None:
+                path = os.path.join(dest_dir, device_name)
+                write_bundle(certs[device_name], path)
+            else:
+                path = os.path.join(dest_dir, device_name + _archive_extension(archive_format))
+                _write_archive(path, archive_format, _bundle_files(certs[device_name]))
+            return path
+
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+            paths = list(executor.map(write, certs))
+
+    logging.info(f'Wrote certificate bundles of {len(certs)} devices to "{dest_dir}" in {time.time() - start:.1f}s')
+    return paths
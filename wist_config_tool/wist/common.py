@@ -25,6 +25,23 @@ def get_terraform_dir():
         return os.path.join(sys._MEIPASS, _TERRAFORM_STR)
 
 
+def get_aws_architecture_dir():
+    if _running_from_source():
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'aws_architecture')
+    else:
+        return os.path.join(sys._MEIPASS, 'aws_architecture')
+
+
+def get_cache_dir():
+    """ Per user cache shared by all wist installs: WIST_CACHE_DIR, XDG cache dir or LOCALAPPDATA on Windows """
+    if os.environ.get('WIST_CACHE_DIR'):
+        return os.environ['WIST_CACHE_DIR']
+    if sys.platform.startswith('win32') and os.environ.get('LOCALAPPDATA'):
+        return os.path.join(os.environ['LOCALAPPDATA'], 'wist', 'cache')
+    xdg_cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(xdg_cache_home, 'wist')
+
+
 def get_aws_config_path():
     if _running_from_source():
         return os.path.join(os.path.dirname(os.path.abspath(__file__)), _AWS_CONFIG)
@@ -46,6 +63,14 @@ def setup_config(devel=False):
     cfg.aws_config_file_path = get_aws_config_path()
 
     os.environ["TF_IN_AUTOMATION"] = "1"  # this will prevent Terraform from producing too much output, or asking for input
+    os.environ["CHECKPOINT_DISABLE"] = "1"  # no version check requests to Hashicorp on every Terraform call
+
+    # providers downloaded once are shared by all wist installs
+    os.environ.setdefault("TF_PLUGIN_CACHE_DIR", os.path.join(get_cache_dir(), 'plugins'))
+    os.makedirs(os.environ["TF_PLUGIN_CACHE_DIR"], exist_ok=True)
+    if not _running_from_source():
+        # frozen app may be unpacked to new temp dir on every run, keep initialized working dir in cache instead
+        os.environ.setdefault("TF_DATA_DIR", os.path.join(get_cache_dir(), 'terraform_data'))
 
 def setup_logger(level=logging.INFO):
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -0,0 +1,119 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from wist.common import get_cache_dir
+
+
+# air-gapped provisioning lines: nothing is downloaded, everything has to be in the cache already
+OFFLINE = os.environ.get('WIST_OFFLINE', '').lower() in ('1', 'true', 'yes')
+
+TIMEOUT = (10, 60)  # seconds: connect, read (between bytes, not for the whole download)
+_RETRIES = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                 allowed_methods=('GET', 'HEAD'), raise_on_status=False)
+_CHUNK_SIZE = 1024 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class OfflineError(Exception):
+    pass
+
+
+def get_session() -> requests.Session:
+    """ One session per process, so all downloads share kept-alive connections and retry policy """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(max_retries=_RETRIES, pool_connections=4, pool_maxsize=16)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    if OFFLINE:
+        raise OfflineError(f'Cannot download {url} in offline mode (WIST_OFFLINE)')
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().get(url, **kwargs)
+
+
+def _get_cache_path(url: str):
+    url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(get_cache_dir(), 'downloads', f"{url_hash}-{url.rstrip('/').rsplit('/', 1)[-1]}")
+
+
+def _file_sha256(path: str):
+    sha256_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(_CHUNK_SIZE), b''):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+def _read_cached(path: str, expected_sha256=None):
+    """ Path of cached file when it matches its checksum (and expected one, if given), None otherwise """
+    try:
+        with open(path + '.sha256', 'r') as file:
+            cached_sha256 = file.read().strip()
+        actual_sha256 = _file_sha256(path)
+    except FileNotFoundError:
+        return None
+    if actual_sha256 != cached_sha256 or (expected_sha256 is not None and actual_sha256 != expected_sha256):
+        logging.warning(f'Cached {path} does not match its checksum, ignoring it')
+        return None
+    return path
+
+
+def _write_atomically(path: str, write):
+    """ Other wist processes may fetch the same file, each writes its own temporary file and renames it """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def fetch_immutable(url: str, expected_sha256=None) -> str:
+    """ Path to cached copy of a file which never changes under its URL (release archives, checksums, root CA).
+
+    Downloaded once and verified by sha256 on every use. In offline mode only the cache is used.
+    """
+    path = _get_cache_path(url)
+    if _read_cached(path, expected_sha256) is not None:
+        return path
+    if OFFLINE:
+        raise OfflineError(f'{url} is not in the download cache and cannot be downloaded in offline mode '
+                           f'(WIST_OFFLINE). Copy the cache dir {get_cache_dir()} from a machine which has it')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sha256_hash = hashlib.sha256()
+
+    def download(file):
+        with get(url, stream=True) as response:
+            response.raise_for_status()
+            for data in response.iter_content(chunk_size=_CHUNK_SIZE):
+                sha256_hash.update(data)
+                file.write(data)
+        if expected_sha256 is not None and sha256_hash.hexdigest() != expected_sha256:
+            raise Exception(f'Sha256 of {url} is incorrect!')
+
+    _write_atomically(path, download)
+    _write_atomically(path + '.sha256', lambda file: file.write(sha256_hash.hexdigest().encode('ascii')))
+    return path
+
+
+def read_immutable(url: str, expected_sha256=None) -> bytes:
+    with open(fetch_immutable(url, expected_sha256), 'rb') as file:
+        return file.read()
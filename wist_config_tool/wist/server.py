@@ -0,0 +1,309 @@
+import os
+import sys
+import hmac
+import json
+import time
+import queue
+import logging
+import ipaddress
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from aws_architecture import instrumentation
+
+
+DEFAULT_SERVER_ADDRESS = '127.0.0.1:8765'
+DEFAULT_APPLY_WINDOW = 5  # seconds during which add/remove jobs are collected into a single terraform apply
+# shared secret of server and its clients, required when server listens on other than loopback address
+TOKEN = os.environ.get('WIST_SERVER_TOKEN')
+# get_cert jobs may copy certificates only into this dir (and its subdirs), server working dir by default
+CERTS_ROOT = os.environ.get('WIST_SERVER_CERTS_ROOT')
+
+ADD_DEVICES = 'add_devices'
+REMOVE_DEVICES = 'remove_devices'
+GET_CERT = 'get_cert'
+LIST_DEVICES = 'list_devices'
+
+_DEVICE_CHANGE_COMMANDS = {ADD_DEVICES, REMOVE_DEVICES}
+_COMMANDS = _DEVICE_CHANGE_COMMANDS | {GET_CERT, LIST_DEVICES}
+
+
+class ServerError(Exception):
+    pass
+
+
+class Job():
+    def __init__(self, command: str, params: dict):
+        self.command = command
+        self.params = params
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+
+
+class JobQueue():
+    """ Runs jobs one by one in a worker thread. Add/remove jobs queued within apply window share one apply """
+
+    def __init__(self, apply_window=DEFAULT_APPLY_WINDOW):
+        self.apply_window = apply_window
+        self._jobs = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='wist-jobs', daemon=True)
+        self._key_pool_lock = threading.Lock()
+
+    def start(self):
+        self._worker.start()
+        self._refill_key_pool()
+
+    def stop(self):
+        self._jobs.put(None)
+        self._worker.join()
+
+    def submit(self, command: str, params: dict) -> Job:
+        job = Job(command, params)
+        self._jobs.put(job)
+        return job
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            if job.command in _DEVICE_CHANGE_COMMANDS:
+                if not self._run_device_changes(self._collect_device_changes(job)):
+                    return
+            else:
+                self._run_single(job)
+
+    def _collect_device_changes(self, first_job: Job) -> list:
+        batch = [first_job]
+        deadline = time.time() + self.apply_window
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return batch
+            try:
+                job = self._jobs.get(timeout=timeout)
+            except queue.Empty:
+                return batch
+            if job is None:
+                batch.append(None)
+                return batch
+            if job.command in _DEVICE_CHANGE_COMMANDS:
+                batch.append(job)
+            else:
+                self._run_single(job)  # read only jobs do not have to wait for the apply
+
+    def _refill_key_pool(self):
+        """ In CSR mode keys used by the last batch are generated in background, while waiting for next one """
+        from wist.aws_tools import CERT_MODE, warm_key_pool
+
+        if CERT_MODE != 'csr' or not self._key_pool_lock.acquire(blocking=False):
+            return
+
+        def refill():
+            try:
+                warm_key_pool()
+            except Exception:
+                logging.exception('Refilling key pool failed')
+            finally:
+                self._key_pool_lock.release()
+
+        threading.Thread(target=refill, name='wist-key-pool', daemon=True).start()
+
+    def _run_device_changes(self, batch: list) -> bool:
+        """ Run batch in one apply. Returns False when stop was requested while collecting it """
+        stop_requested = batch[-1] is None
+        jobs = [job for job in batch if job is not None]
+
+        # last request for a device wins
+        changes = {}
+        groups = {}
+        engines = {}
+        for job in jobs:
+            for device_name in job.params['dev_names']:
+                changes.pop(device_name, None)
+                changes[device_name] = job.command
+                if job.command == ADD_DEVICES and job.params.get('group'):
+                    groups[device_name] = job.params['group']
+                if job.command == ADD_DEVICES:
+                    engines[device_name] = job.params.get('engine')
+        to_add = [name for name, command in changes.items() if command == ADD_DEVICES]
+        to_remove = [name for name, command in changes.items() if command == REMOVE_DEVICES]
+        groups = {name: group for name, group in groups.items() if name in to_add}
+        logging.info(f'Applying {len(jobs)} queued jobs: {len(to_add)} devices to add, {len(to_remove)} to remove')
+
+        # devices added with different engines are updated separately, removals go with the first update
+        to_add_by_engine = {}
+        for device_name in to_add:
+            to_add_by_engine.setdefault(engines[device_name], []).append(device_name)
+
+        try:
+            from wist.aws_tools import update_devices_in_aws
+
+            added, removed = [], []
+            with instrumentation.span('server.device_changes', jobs=len(jobs), to_add=len(to_add),
+                                      to_remove=len(to_remove)):
+                for index, (engine, engine_to_add) in enumerate(list(to_add_by_engine.items()) or [(None, [])]):
+                    engine_groups = {name: groups[name] for name in engine_to_add if name in groups}
+                    engine_added, engine_removed = update_devices_in_aws(
+                        to_add=engine_to_add, to_remove=to_remove if index == 0 else [], groups=engine_groups or None,
+                        engine=engine)
+                    added.extend(engine_added)
+                    removed.extend(engine_removed)
+        except Exception as e:
+            for job in jobs:
+                job.finish(error=str(e))
+        else:
+            for job in jobs:
+                job.finish(result={'added': added, 'removed': removed})
+        self._refill_key_pool()
+        return not stop_requested
+
+    def _run_single(self, job: Job):
+        metrics = instrumentation.start_span(f'server.{job.command}')
+        try:
+            if job.command == GET_CERT:
+                from wist.aws_tools import copy_device_certs_to
+
+                copy_device_certs_to(job.params['dev_name'], job.params['dest_dir'])
+                result = {'dest_dir': job.params['dest_dir']}
+            elif job.command == LIST_DEVICES:
+                from wist.aws_tools import iter_aws_devices
+
+                result = {'devices': list(iter_aws_devices(**job.params))}
+            else:
+                raise ServerError(f'Unknown command {job.command}')
+        except Exception as e:
+            logging.exception(f'Job {job.command} failed')
+            metrics.end(e)
+            job.finish(error=str(e))
+        else:
+            metrics.end()
+            job.finish(result=result)
+
+
+def is_within(path: str, root: str) -> bool:
+    """ Whether path is root or inside of it, after resolving symlinks and '..' """
+    path, root = os.path.realpath(path), os.path.realpath(root)
+    return os.path.commonpath([path, root]) == root
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    job_queue = None  # type: JobQueue
+    token = None
+    certs_root = None
+
+    def do_POST(self):
+        if self.token is not None and not hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'),
+                                                               f'Bearer {self.token}'.encode('utf-8')):
+            self._reply(401, {'error': 'Missing or invalid token (WIST_SERVER_TOKEN)'})
+            return
+        command = self.path.strip('/')
+        if command not in _COMMANDS:
+            self._reply(404, {'error': f'Unknown command {command}'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self._reply(400, {'error': f'Invalid request: {e}'})
+            return
+        if command == GET_CERT and not is_within(str(params.get('dest_dir', '')), self.certs_root):
+            self._reply(403, {'error': f'Destination directory must be inside {self.certs_root} '
+                                       f'(WIST_SERVER_CERTS_ROOT of wist server)'})
+            return
+        if command == GET_CERT:
+            params['dest_dir'] = os.path.realpath(params['dest_dir'])  # the path which was checked
+
+        job = self.job_queue.submit(command, params)
+        job.wait()
+        if job.error is not None:
+            self._reply(500, {'error': job.error})
+        else:
+            self._reply(200, job.result)
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(f'{self.address_string()} - {format % args}')
+
+
+def _split_address(address: str):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host.strip('[]')).is_loopback
+    except ValueError:
+        return False  # host name, may resolve to any interface
+
+
+def serve(address=DEFAULT_SERVER_ADDRESS, apply_window=DEFAULT_APPLY_WINDOW, certs_root=None):
+    """ Run wist server until interrupted. Process stays warm: S3 client, state index and terraform workdir.
+
+    Server reachable from other machines requires WIST_SERVER_TOKEN, the same token has to be set for clients.
+    """
+    host, port = _split_address(address)
+    if not _is_loopback(host) and not TOKEN:
+        raise ServerError(f'Refusing to listen on {address} without authentication. Set WIST_SERVER_TOKEN (for '
+                          f'server and its clients) or use a loopback address, e.g. {DEFAULT_SERVER_ADDRESS}')
+    certs_root = os.path.abspath(certs_root or CERTS_ROOT or os.getcwd())
+
+    job_queue = JobQueue(apply_window)
+    handler = type('RequestHandler', (_RequestHandler,), {'job_queue': job_queue, 'token': TOKEN or None,
+                                                          'certs_root': certs_root})
+    http_server = ThreadingHTTPServer((host, port), handler)
+
+    job_queue.start()
+    logging.info(f'wist server listening on http://{address} (apply window: {apply_window}s, '
+                 f'certificates copied only into {certs_root})')
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info('Stopping wist server...')
+        # terraform runs in its own process group and does not get Ctrl+C, interrupt it (if any job started it)
+        if 'wist.aws_tools' in sys.modules:
+            sys.modules['wist.aws_tools'].cancel_terraform_runs()
+    finally:
+        http_server.server_close()
+        job_queue.stop()
+
+
+def send_job(address: str, command: str, params: dict) -> dict:
+    """ Send job to running wist server and wait for its result """
+    headers = {'Content-Type': 'application/json'}
+    if TOKEN:
+        headers['Authorization'] = f'Bearer {TOKEN}'
+    request = urllib.request.Request(f'http://{address}/{command}', data=json.dumps(params).encode('utf-8'),
+                                     headers=headers, method='POST')
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        try:
+            error = json.loads(e.read()).get('error', str(e))
+        except ValueError:
+            error = str(e)
+        raise ServerError(f'wist server failed to run {command}: {error}') from e
+    except urllib.error.URLError as e:
+        raise ServerError(f'Cannot connect to wist server at {address}: {e.reason}') from e
@@ -0,0 +1,136 @@
+import os
+import json
+import zlib
+import logging
+
+import botocore.exceptions
+
+from wist.common import get_aws_architecture_dir
+
+from aws_architecture import manage_thing
+import aws_architecture.tfstates_backup as tfb
+
+
+_TERRAFORM_STATE_FILE_NAME = 'terraform.tfstate'
+TERRAFORM_ENVIRONMENT_DIR = os.path.join(get_aws_architecture_dir(), 'environments', 'things_management')
+
+# shared by all operators through S3, the same way as state files
+SHARDS_CONFIG_FILE_PATH = os.path.join(manage_thing.DATA_DIR, 'shards.json')
+
+DEFAULT_WORKSPACE = 'default'
+
+
+class Shard():
+    """ Part of the fleet living in its own Terraform workspace: own state file, things registry, certs dir and lock.
+
+    Shard 0 is the default workspace, so setup with a single shard is the same as without sharding.
+    """
+
+    def __init__(self, index: int):
+        self.index = index
+        if index == 0:
+            self.workspace = DEFAULT_WORKSPACE
+            self.state_file_path = os.path.join(TERRAFORM_ENVIRONMENT_DIR, _TERRAFORM_STATE_FILE_NAME)
+            self.devices_file_path = manage_thing.DEVICES_FILE
+            self.csrs_file_path = os.path.join(manage_thing.DATA_DIR, 'csrs.json')
+            self.certs_dir = os.path.join(manage_thing.DATA_DIR, 'iot_certs')
+        else:
+            self.workspace = f'shard-{index}'
+            self.state_file_path = os.path.join(TERRAFORM_ENVIRONMENT_DIR, 'terraform.tfstate.d', self.workspace,
+                                                _TERRAFORM_STATE_FILE_NAME)
+            self.devices_file_path = os.path.join(manage_thing.DATA_DIR, f'things.{self.workspace}.json')
+            self.csrs_file_path = os.path.join(manage_thing.DATA_DIR, f'csrs.{self.workspace}.json')
+            self.certs_dir = os.path.join(manage_thing.DATA_DIR, f'iot_certs.{self.workspace}')
+
+    def __repr__(self):
+        return f'Shard({self.index}, {self.workspace})'
+
+    def __eq__(self, other):
+        return isinstance(other, Shard) and other.index == self.index
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def terraform_env(self) -> dict:
+        env = os.environ.copy()
+        if self.workspace != DEFAULT_WORKSPACE:
+            env['TF_WORKSPACE'] = self.workspace
+        return env
+
+    def prepare(self):
+        """ Make sure workspace and registry of this shard exist locally """
+        os.makedirs(os.path.dirname(self.state_file_path), exist_ok=True)  # local backend workspace is just a dir
+        manage_thing.export_devices_file(self.devices_file_path)  # things file read by terraform
+
+    def has_state(self):
+        return os.path.isfile(self.state_file_path)
+
+
+class ShardsConfig():
+    """ Number of shards and devices pinned to user chosen groups. Device goes to shard by hash of its group or name """
+
+    def __init__(self, count=1, groups=None):
+        self.count = count
+        self.groups = groups or {}  # device name -> group name
+
+    def shard_index_for(self, device_name: str) -> int:
+        key = self.groups.get(device_name, device_name)
+        return zlib.crc32(key.encode('utf-8')) % self.count
+
+    def shard_for(self, device_name: str) -> Shard:
+        return Shard(self.shard_index_for(device_name))
+
+    def shards(self) -> list:
+        return [Shard(index) for index in range(self.count)]
+
+    def route(self, device_names) -> dict:
+        """ Shard -> device names, keeping order """
+        routed = {}
+        for device_name in device_names:
+            routed.setdefault(self.shard_for(device_name), []).append(device_name)
+        return routed
+
+    def to_dict(self):
+        return {'count': self.count, 'groups': self.groups}
+
+
+def _read_config_file():
+    try:
+        with open(SHARDS_CONFIG_FILE_PATH, 'r') as file:
+            data = json.load(file)
+    except FileNotFoundError:
+        return ShardsConfig()
+    return ShardsConfig(count=data.get('count', 1), groups=data.get('groups'))
+
+
+def _pull_config():
+    try:
+        tfb.pull(SHARDS_CONFIG_FILE_PATH)
+    except botocore.exceptions.ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            raise
+        logging.debug('No shards config on S3, fleet is not sharded')
+
+
+def load_config(download_backup=True) -> ShardsConfig:
+    if download_backup:
+        _pull_config()
+    return _read_config_file()
+
+
+def update_config(count=None, groups=None) -> ShardsConfig:
+    """ Change shards config under lock, so concurrent changes are not lost """
+    tfb.lock(SHARDS_CONFIG_FILE_PATH, wait=60)
+    try:
+        _pull_config()
+        config = _read_config_file()
+        if count is not None:
+            config.count = count
+        if groups:
+            config.groups.update(groups)
+        with open(SHARDS_CONFIG_FILE_PATH, 'w') as file:
+            json.dump(config.to_dict(), file, indent=2)
+        tfb.push(SHARDS_CONFIG_FILE_PATH)
+    finally:
+        tfb.unlock(SHARDS_CONFIG_FILE_PATH)
+    return config
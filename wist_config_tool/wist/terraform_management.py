@@ -2,14 +2,21 @@ import os
 import stat
 import re
 import sys
+import json
+import time
+import shutil
 import subprocess
-import requests
 import logging
 import hashlib
 import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 import wist.common as common
-from wist.common import get_terraform_dir
+from wist import downloads
+from wist.common import get_terraform_dir, get_cache_dir
+
+from aws_architecture import instrumentation
 
 
 # this could be used if someone have time to "reverse engineer" Hashicorp's checkpoint-api
@@ -19,27 +26,101 @@ from wist.common import get_terraform_dir
 
 _DEFAULT_TERRAFORM_VERSION_TO_DOWNLOAD = "0.12.24"
 
+_VERSION_LOCK_FILE_NAME = "terraform_version.json"
+_VERIFIED_MARKER_FILE_NAME = ".verified"  # holds sha256 of archive the cached binary was extracted from
+
+TERRAFORM_RELEASES_URL = os.environ.get('WIST_TERRAFORM_RELEASES_URL', 'https://releases.hashicorp.com/terraform')
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def _get_binary_cache_dir(version: str):
+    """ Binaries are shared between wist installs (and CI runs) through user cache dir, keyed by version and platform """
+    platform = _get_archive_name_for_current_platform(version)[len(f'terraform_{version}_'):-len('.zip')]
+    return os.path.join(get_cache_dir(), 'terraform', version, platform)
+
+
+def _get_expected_sha256(version: str, archive_name: str):
+    sha_url = f"{TERRAFORM_RELEASES_URL}/{version}/terraform_{version}_SHA256SUMS"
+    sha_sums = downloads.read_immutable(sha_url)  # released files never change, so checksums are cached
 
-def _download_terraform_zip(version: str):
+    for line in sha_sums.decode('utf-8').splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == archive_name:
+            return parts[0]
+    raise Exception(f'No sha256 sum for {archive_name} in {sha_url}!')
+
+
+@instrumentation.timed('terraform_management.download')
+def _download_terraform_zip(version: str, dest_dir: str):
+    """ Download release archive to dest_dir (private to this process), hashing while streaming.
+
+    Partial download left next to dest_dir by an interrupted run is resumed. It is taken with atomic rename, so only
+    one process continues it, and is put back there when this download is interrupted too.
+    """
 
     archive_name = _get_archive_name_for_current_platform(version)
+    archive_path = os.path.join(dest_dir, archive_name)
+    part_path = archive_path + '.part'
+    shared_part_path = os.path.join(os.path.dirname(os.path.abspath(dest_dir)), archive_name + '.part')
+    try:
+        os.replace(shared_part_path, part_path)
+    except FileNotFoundError:
+        pass
+    try:
+        computed_sha256 = _download_to_part_file(version, archive_name, part_path)
+    except BaseException:
+        if os.path.isfile(part_path):
+            os.replace(part_path, shared_part_path)
+        raise
 
-    full_url = f"https://releases.hashicorp.com/terraform/{version}/{archive_name}"
+    os.replace(part_path, archive_path)
+    return archive_path, computed_sha256
 
-    logging.info(f'Downloading Terraform v{version} from: {full_url}. This may take some time...')
 
-    response = requests.get(full_url, stream=True)
-    response.raise_for_status()
+def _download_to_part_file(version: str, archive_name: str, part_path: str):
+    """ Download (or finish downloading) archive to part_path, returns its verified sha256 """
 
-    with open(archive_name, "wb") as handle:
-        for data in response.iter_content(chunk_size=8*1024):
-            if data:
-                handle.write(data)
+    full_url = f"{TERRAFORM_RELEASES_URL}/{version}/{archive_name}"
 
-    if not (_check_zip_sha256(version, archive_name)):
-        raise Exception(f'Sha256 of downloaded file is incorrect!')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        expected_sha256 = executor.submit(_get_expected_sha256, version, archive_name)
 
-    return archive_name
+        sha256_hash = hashlib.sha256()
+        headers = {}
+        if os.path.isfile(part_path):
+            with open(part_path, 'rb') as part_file:
+                for byte_block in iter(lambda: part_file.read(_DOWNLOAD_CHUNK_SIZE), b""):
+                    sha256_hash.update(byte_block)
+            headers['Range'] = f'bytes={os.path.getsize(part_path)}-'
+
+        logging.info(f'Downloading Terraform v{version} from: {full_url}. This may take some time...')
+        response = downloads.get(full_url, stream=True, headers=headers)
+        if response.status_code == 416:
+            # partial file is already complete (or broken), nothing more to fetch
+            response.close()
+        else:
+            response.raise_for_status()
+            if headers and response.status_code != 206:
+                logging.info('Server does not support resuming, downloading from the beginning')
+                sha256_hash = hashlib.sha256()
+                mode = 'wb'
+            else:
+                mode = 'ab'
+            if headers and response.status_code == 206:
+                logging.info(f'Resuming download from byte {os.path.getsize(part_path)}')
+
+            with open(part_path, mode) as handle:
+                for data in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+                    if data:
+                        sha256_hash.update(data)
+                        handle.write(data)
+                        instrumentation.current_span().add('bytes_downloaded', len(data))
+
+        computed_sha256 = sha256_hash.hexdigest()
+        if computed_sha256 != expected_sha256.result():
+            os.remove(part_path)
+            raise Exception(f'Sha256 of downloaded file is incorrect!')
+    return computed_sha256
 
 
 def _get_archive_name_for_current_platform(version: str):
@@ -58,46 +139,82 @@ def _get_archive_name_for_current_platform(version: str):
     return f'terraform_{version}_{system}_{arch}.zip'
 
 
-def _compute_sha256_sum(filename: str):
-    sha256_hash = hashlib.sha256()
-    with open(filename, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-
-    return sha256_hash.hexdigest()
-
+def _move_into_place(tmp_dir: str, cache_dir: str):
+    """ Rename complete tmp_dir to cache_dir, unless other process has already done it """
+    marker_path = os.path.join(cache_dir, _VERIFIED_MARKER_FILE_NAME)
+    try:
+        os.replace(tmp_dir, cache_dir)
+        return
+    except OSError:
+        if os.path.isfile(marker_path):
+            logging.info(f'Terraform was cached in {cache_dir} by another process meanwhile')
+            return
+    # incomplete dir left by older wist, which downloaded and extracted in place
+    stale_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir), prefix='.stale_')
+    os.replace(cache_dir, os.path.join(stale_dir, 'cache'))
+    if os.path.isfile(os.path.join(stale_dir, 'cache', _VERIFIED_MARKER_FILE_NAME)):
+        os.replace(os.path.join(stale_dir, 'cache'), cache_dir)  # completed by another process meanwhile
+    else:
+        os.replace(tmp_dir, cache_dir)
+    shutil.rmtree(stale_dir, ignore_errors=True)
 
-def _check_zip_sha256(version: str, zip_file_name: str):
 
-    sha_sums_file = f"terraform_{version}_SHA256SUMS"
-    sha_url = f"https://releases.hashicorp.com/terraform/{version}/{sha_sums_file}"
-    r_sha = requests.get(sha_url)
-    r_sha.raise_for_status()
+def _get_cached_terraform(version: str):
+    """ Return cache dir with verified binary of given version or download and verify it first.
 
-    sha_keys = r_sha.content.decode('utf-8')
-    for line in sha_keys.split('\n'):
-        key, file = line.split(' ', 1)
-        if file.lstrip(' ') == zip_file_name:
-            break
+    Other wist processes may be installing the same version, so it is downloaded and extracted into a dir private to
+    this process, which is then renamed to cache dir. Cache dir is either complete or missing.
+    """
+    cache_dir = _get_binary_cache_dir(version)
+    marker_path = os.path.join(cache_dir, _VERIFIED_MARKER_FILE_NAME)
+    if os.path.isfile(marker_path):
+        logging.info(f'Using cached Terraform v{version} from {cache_dir}')
+        return cache_dir
+
+    os.makedirs(os.path.dirname(cache_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(cache_dir), prefix='.tmp_')
+    try:
+        archive_path, sha256 = _download_terraform_zip(version, tmp_dir)
 
-    computed_hash = _compute_sha256_sum(zip_file_name)
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            zip_ref.extractall(tmp_dir)
+        os.remove(archive_path)
 
-    return bool(computed_hash == key)
+        with open(os.path.join(tmp_dir, _VERIFIED_MARKER_FILE_NAME), 'w') as marker_file:
+            marker_file.write(sha256)
+        _move_into_place(tmp_dir, cache_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return cache_dir
 
 
+@instrumentation.timed('terraform_management.install')
 def get_terraform(version: str):
     if version is None:
         version=_DEFAULT_TERRAFORM_VERSION_TO_DOWNLOAD
-
-    new_terraform_archive_file = _download_terraform_zip(version)
-
-    with zipfile.ZipFile(new_terraform_archive_file, 'r') as zip_ref:
-        zip_ref.extractall(get_terraform_dir())
+    instrumentation.current_span().set(version=version)
+
+    cache_dir = _get_cached_terraform(version)
+
+    os.makedirs(get_terraform_dir(), exist_ok=True)
+    for file_name in os.listdir(cache_dir):
+        if file_name != _VERIFIED_MARKER_FILE_NAME:
+            # copied under temporary name and renamed, other processes never run half copied binary
+            fd, tmp_path = tempfile.mkstemp(dir=get_terraform_dir(), prefix='.tmp_')
+            os.close(fd)
+            try:
+                shutil.copy2(os.path.join(cache_dir, file_name), tmp_path)
+                os.replace(tmp_path, os.path.join(get_terraform_dir(), file_name))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
 
     # add permissions to execute
-    if sys.platform.startswith('linux'):
+    if not sys.platform.startswith('win32'):
         os.chmod(common.cfg.terraform_exec_path, 0o777)
 
+    _update_version_lock(installed=version)
+
 
 def check_tf_latest_version():
 
@@ -118,7 +235,10 @@ def check_tf_latest_version():
     """
 
     try:
-        result = subprocess.run([common.cfg.terraform_exec_path, 'version'], stdout=subprocess.PIPE)
+        # checkpoint is disabled for all other terraform calls, this is the only one that should ask for latest version
+        env = os.environ.copy()
+        env.pop('CHECKPOINT_DISABLE', None)
+        result = subprocess.run([common.cfg.terraform_exec_path, 'version'], stdout=subprocess.PIPE, env=env)
 
     except FileNotFoundError:
         logging.warning('Terraform not installed')
@@ -150,9 +270,87 @@ def check_tf_latest_version():
             return True, tf_version
 
 
+def _get_version_lock_path():
+    return os.path.join(get_terraform_dir(), _VERSION_LOCK_FILE_NAME)
+
+
+def read_version_lock() -> dict:
+    """ Lockfile keeps pinned 'version' and 'installed' version """
+    try:
+        with open(_get_version_lock_path(), 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _update_version_lock(**values):
+    version_lock = read_version_lock()
+    version_lock.update(values)
+    os.makedirs(get_terraform_dir(), exist_ok=True)
+    with open(_get_version_lock_path(), 'w') as file:
+        json.dump(version_lock, file, indent=2)
+
+
+def get_latest_terraform_version():
+    """ Latest Terraform version, as reported by installed terraform. None when it cannot be told """
+    if downloads.OFFLINE:
+        return None
+    up_to_date, version = check_tf_latest_version()
+    return version
+
+
+@instrumentation.timed('terraform_management.ensure')
+def ensure_terraform():
+    """ Make sure pinned Terraform version is installed, without calling terraform or network when it is.
+
+    Pinned version comes from lockfile, falls back to already installed binary and then to default version.
+    Upgrading to newer version happens only through upgrade_terraform().
+    """
+    version_lock = read_version_lock()
+    binary_exists = os.path.isfile(common.cfg.terraform_exec_path)
+
+    if binary_exists and 'installed' not in version_lock:
+        # binary installed by older wist, check once which version it is and pin it
+        installed = _get_installed_terraform_version()
+        if installed is not None:
+            version_lock = dict(version_lock, installed=installed)
+            _update_version_lock(installed=installed)
+
+    pinned = version_lock.get('version') or version_lock.get('installed') or _DEFAULT_TERRAFORM_VERSION_TO_DOWNLOAD
+    if not binary_exists or version_lock.get('installed') != pinned:
+        logging.info(f'Installing pinned Terraform v{pinned}...')
+        get_terraform(pinned)
+    if version_lock.get('version') != pinned:
+        _update_version_lock(version=pinned)
+    instrumentation.current_span().set(version=pinned)
+    return pinned
+
+
+def upgrade_terraform(version: str = None):
+    """ Install given or latest Terraform version and pin it. Pin is not changed when latest version is unknown """
+    if version is None:
+        version = get_latest_terraform_version()
+        if version is None:
+            raise Exception('Could not check latest Terraform version (offline or Terraform not installed), '
+                            'pinned version not changed. Give version to install with --tf_version')
+    if read_version_lock().get('installed') != version or not os.path.isfile(common.cfg.terraform_exec_path):
+        get_terraform(version)
+    _update_version_lock(version=version)
+    logging.info(f'Terraform v{version} pinned.')
+    return version
+
+
+@instrumentation.timed('terraform.version')
+def _get_installed_terraform_version():
+    try:
+        result = subprocess.run([common.cfg.terraform_exec_path, 'version'], stdout=subprocess.PIPE)
+    except FileNotFoundError:
+        return None
+    match = re.match(r'Terraform v(\S+)', result.stdout.decode('utf-8'))
+    return match.group(1) if match else None
+
 
 if __name__ == '__main__':
-    import time
     from wist.common import setup_config
     logging.getLogger(None).setLevel(logging.INFO)
     setup_config(devel=True)
@@ -0,0 +1,271 @@
+""" Runs terraform commands with their output streamed and parsed while they run.
+
+Terraform >= 0.15.3 is run with -json (machine readable UI), older versions print human readable text which is
+parsed line by line. Either way output is turned into the same events, e.g.
+{'type': 'apply_complete', 'address': 'module.x.aws_iot_thing.iot_thing["d1"]', 'action': 'create', 'elapsed': 2.0},
+which are passed to progress callback as they come, and summed up in the result of the run: return code, planned or
+applied changes, duration of every resource and diagnostics (errors and warnings).
+"""
+import collections
+import subprocess
+import threading
+import logging
+import signal
+import json
+import time
+import sys
+import re
+
+
+JSON_OUTPUT_MIN_VERSION = (0, 15, 3)
+INTERRUPT_GRACE_PERIOD = 5 * 60  # seconds for terraform to finish operations in flight and save state, then killed
+_OUTPUT_TAIL_LINES = 20  # logged when terraform fails without reporting any error diagnostic
+
+# AWS API rate limiting, the same operation succeeds when retried later
+_THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded',
+                      'Rate exceeded', 'SlowDown')
+
+_ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+_ACTIONS = {'Creat': 'create', 'Destr': 'delete', 'Modif': 'update', 'Read': 'read', 'Refresh': 'read'}
+_TEXT_PATTERNS = (
+    ('apply_start', re.compile(r'^(?P<address>\S+): (?P<action>Creating|Destroying|Modifying|Reading)\.\.\.')),
+    ('apply_progress', re.compile(
+        r'^(?P<address>\S+): Still (?P<action>creating|destroying|modifying|reading)\.\.\. \[(?P<elapsed>\S+) elapsed\]')),
+    ('apply_complete', re.compile(
+        r'^(?P<address>\S+): (?P<action>Creation|Destruction|Modifications|Read) complete after (?P<elapsed>\S+)')),
+    ('refresh_start', re.compile(r'^(?P<address>\S+): (?P<action>Refreshing) state\.\.\.')),
+    ('planned_change', re.compile(
+        r'^\s*# (?P<address>\S+) (?:will be|must be) (?P<action>created|destroyed|updated|replaced|read)')),
+    ('plan_summary', re.compile(r'^Plan: (?P<add>\d+) to add, (?P<change>\d+) to change, (?P<remove>\d+) to destroy')),
+    ('apply_summary', re.compile(
+        r'^(?:Apply|Destroy) complete! Resources: (?:(?P<add>\d+) added, (?P<change>\d+) changed, )?'
+        r'(?P<remove>\d+) destroyed')),
+    ('diagnostic', re.compile(r'^(?P<severity>Error|Warning): (?P<summary>.*)')),
+)
+_PLANNED_ACTIONS = {'created': 'create', 'destroyed': 'delete', 'updated': 'update', 'replaced': 'replace',
+                    'read': 'read'}
+
+
+class TerraformTimeout(Exception):
+    pass
+
+
+class TerraformCancelled(Exception):
+    pass
+
+
+def parse_version(version: str) -> tuple:
+    return tuple(int(part) for part in re.findall(r'\d+', version or '')[:3])
+
+
+def supports_json_output(version: str) -> bool:
+    """ -json for plan and apply (streamed machine readable UI) was added in Terraform 0.15.3 """
+    return parse_version(version) >= JSON_OUTPUT_MIN_VERSION
+
+
+def is_throttling_error(message: str) -> bool:
+    return any(error in message for error in _THROTTLING_ERRORS)
+
+
+def _parse_duration(text: str) -> float:
+    """ Terraform durations: '2s', '1m30s', '1h2m3s' """
+    units = {'h': 3600, 'm': 60, 's': 1}
+    return float(sum(int(value) * units[unit] for value, unit in re.findall(r'(\d+)([hms])', text or '')))
+
+
+def _action(verb: str) -> str:
+    return next((action for prefix, action in _ACTIONS.items() if verb.capitalize().startswith(prefix)), verb.lower())
+
+
+def parse_json_line(line: str):
+    """ Event of a line of terraform -json output, None for lines which are not events """
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        message = json.loads(line)
+    except ValueError:
+        return {'type': 'output', 'message': line}
+    if not isinstance(message, dict):
+        return None
+    event = {'type': message.get('type', 'log'), 'message': message.get('@message', ''),
+             'level': message.get('@level')}
+    hook = message.get('hook') or message.get('change') or {}
+    if 'resource' in hook:
+        event['address'] = hook['resource'].get('addr')
+        event['action'] = hook.get('action')
+    if 'elapsed_seconds' in hook:
+        event['elapsed'] = float(hook['elapsed_seconds'])
+    if event['type'] == 'change_summary':
+        changes = message.get('changes', {})
+        event['type'] = 'plan_summary' if changes.get('operation') == 'plan' else 'apply_summary'
+        event['changes'] = {key: int(changes.get(key, 0)) for key in ('add', 'change', 'remove')}
+    elif event['type'] == 'diagnostic':
+        diagnostic = message.get('diagnostic', {})
+        event.update(severity=diagnostic.get('severity', 'error'), summary=diagnostic.get('summary', ''),
+                     detail=diagnostic.get('detail', ''), address=diagnostic.get('address'))
+    return event
+
+
+def parse_text_line(line: str):
+    """ Event of a line of human readable terraform output (Terraform < 0.15.3) """
+    line = _ANSI_ESCAPE.sub('', line).rstrip()
+    if not line.strip():
+        return None
+    for event_type, pattern in _TEXT_PATTERNS:
+        match = pattern.match(line)
+        if match is None:
+            continue
+        fields = match.groupdict()
+        event = {'type': event_type, 'message': line}
+        if 'address' in fields:
+            event['address'] = fields['address']
+            event['action'] = _PLANNED_ACTIONS.get(fields['action']) if event_type == 'planned_change' \
+                else _action(fields['action'])
+        if fields.get('elapsed'):
+            event['elapsed'] = _parse_duration(fields['elapsed'])
+        if event_type.endswith('_summary'):
+            event['changes'] = {key: int(fields[key] or 0) for key in ('add', 'change', 'remove')}
+        if event_type == 'diagnostic':
+            event.update(severity=fields['severity'].lower(), summary=fields['summary'], detail='')
+        return event
+    return {'type': 'output', 'message': line}
+
+
+class _Run():
+    """ State of one terraform run, updated by output reader thread """
+
+    def __init__(self, step: str, json_output: bool, progress=None):
+        self.step = step
+        self.json_output = json_output
+        self.progress = progress
+        self.changes = None
+        self.resources = {}  # address -> {'action', 'status', 'duration'}
+        self.diagnostics = []
+        self.output_tail = collections.deque(maxlen=_OUTPUT_TAIL_LINES)
+        self._diagnostic = None  # text output: error which following lines describe
+        self._started = {}  # address -> start time, for terraform versions which do not report elapsed time
+
+    def read(self, stream):
+        for line in stream:
+            event = parse_json_line(line) if self.json_output else parse_text_line(line)
+            if event is not None:
+                event['step'] = self.step
+                self.handle(event)
+
+    def handle(self, event: dict):
+        event_type = event['type']
+        address = event.get('address')
+        self.output_tail.append(event.get('message', ''))
+        logging.debug(f"terraform {self.step}: {event.get('message', '')}")
+
+        if event_type == 'output':
+            if self._diagnostic is not None:
+                self._diagnostic['detail'] = (self._diagnostic['detail'] + '\n' + event['message'].strip()).strip()
+            return
+        self._diagnostic = event if event_type == 'diagnostic' and not self.json_output else None
+
+        if event_type == 'diagnostic':
+            self.diagnostics.append(event)
+        elif event_type == 'apply_start':
+            self._started[address] = time.monotonic()
+            self.resources[address] = {'action': event.get('action'), 'status': 'started', 'duration': None}
+        elif event_type in ('apply_complete', 'apply_errored'):
+            resource = self.resources.setdefault(address, {'action': event.get('action')})
+            started = self._started.pop(address, None)
+            resource['status'] = 'complete' if event_type == 'apply_complete' else 'errored'
+            resource['duration'] = event.get('elapsed', time.monotonic() - started if started else None)
+            if resource['duration'] is not None:
+                event.setdefault('elapsed', resource['duration'])
+        elif event_type.endswith('_summary'):
+            self.changes = event['changes']
+
+        if self.progress is not None:
+            try:
+                self.progress(event)
+            except Exception:
+                logging.exception('Terraform progress callback failed')
+
+    def throttled(self) -> bool:
+        return any(is_throttling_error(f"{diagnostic.get('summary', '')} {diagnostic.get('detail', '')}")
+                   for diagnostic in self.diagnostics if diagnostic.get('severity') == 'error')
+
+
+def _start(cmd: list, cwd: str, env: dict):
+    """ Terraform gets its own process group, so Ctrl+C reaches only wist, which then interrupts terraform once
+    (second interrupt would make terraform exit immediately, without saving state) """
+    if sys.platform.startswith('win32'):
+        options = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        options = {'start_new_session': True}
+    return subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, encoding='utf-8', errors='replace', bufsize=1, **options)
+
+
+def _interrupt(process: subprocess.Popen):
+    """ Ask terraform to stop gracefully, kill it if it does not stop within grace period """
+    if process.poll() is not None:
+        return
+    logging.warning('Interrupting terraform, waiting for it to finish operations in progress and save state...')
+    process.send_signal(signal.CTRL_BREAK_EVENT if sys.platform.startswith('win32') else signal.SIGINT)
+    try:
+        process.wait(INTERRUPT_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
+        logging.error('Terraform did not stop in time, killing it. State may need to be fixed manually')
+        process.kill()
+        process.wait()
+
+
+def run(cmd: list, cwd: str, env: dict = None, step: str = None, json_output=False, progress=None, timeout=None,
+        cancel=None) -> dict:
+    """ Run terraform command (with -json already in cmd when json_output), streaming its output.
+
+    progress(event) is called from reader thread for every event. After timeout (seconds) or when cancel event (or
+    any of a list of events) is set terraform is interrupted, like with Ctrl+C, and TerraformTimeout or
+    TerraformCancelled is raised.
+    Returns {'returncode', 'duration', 'changes', 'resources', 'diagnostics', 'throttled'}.
+    """
+    step = step or cmd[1]
+    cancel_events = [cancel] if isinstance(cancel, threading.Event) else [event for event in cancel or () if event]
+    terraform_run = _Run(step, json_output, progress)
+    start = time.monotonic()
+    process = _start(cmd, cwd, env)
+    reader = threading.Thread(target=terraform_run.read, args=(process.stdout,), name=f'terraform-{step}',
+                              daemon=True)
+    reader.start()
+
+    try:
+        while True:
+            try:
+                process.wait(0.5)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if any(event.is_set() for event in cancel_events):
+                _interrupt(process)
+                raise TerraformCancelled(f'terraform {step} cancelled')
+            if timeout and time.monotonic() - start > timeout:
+                _interrupt(process)
+                raise TerraformTimeout(f'terraform {step} did not finish in {timeout}s')
+    except KeyboardInterrupt:
+        _interrupt(process)
+        raise
+    finally:
+        reader.join()
+        process.stdout.close()
+
+    for diagnostic in terraform_run.diagnostics:
+        log = logging.error if diagnostic.get('severity') == 'error' else logging.warning
+        log(f"terraform {step}: {diagnostic.get('summary')}" +
+            (f"\n{diagnostic['detail']}" if diagnostic.get('detail') else ''))
+    if process.returncode not in (0, 2) and not any(diagnostic.get('severity') == 'error'
+                                                   for diagnostic in terraform_run.diagnostics):
+        logging.error(f'terraform {step} failed, last output:\n' + '\n'.join(terraform_run.output_tail))
+    return {
+        'returncode': process.returncode,
+        'duration': time.monotonic() - start,
+        'changes': terraform_run.changes,
+        'resources': terraform_run.resources,
+        'diagnostics': terraform_run.diagnostics,
+        'throttled': process.returncode not in (0, 2) and terraform_run.throttled(),
+    }